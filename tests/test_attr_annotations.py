@@ -104,7 +104,41 @@ def test_events():
     assert len(annot.event_types) == 1
     assert len(annot.get_events()) == 0
     
-        
+
+
+def test_events_query():
+    d = Dataset(ns2_file)
+    create_empty_annotations(annot_file, d)
+
+    annot = Annotations(annot_file)
+    annot.add_rater('test')
+    annot.set_stage_for_epoch(30, 'NREM2')
+    annot.add_event('spindle', (40, 41), chan=('FP1', ))
+    annot.add_event('spindle', (10, 12), chan=('FP1', 'FP2'))
+    annot.add_event('spindle', (31, 35))
+
+    # events are returned in the order of the file
+    assert [x['start'] for x in annot.get_events()] == [40, 10, 31]
+    assert [x['start'] for x in annot.get_events(time=(11, 32))] == [10, 31]
+    assert len(annot.get_events(time=(12.5, 30))) == 0
+    assert annot.get_events(chan=('FP1', 'FP2'))[0]['chan'] == ['FP1', 'FP2']
+    assert annot.get_events(chan='')[0]['chan'] == ['']
+    assert len(annot.get_events(chan='XXX')) == 0
+
+    events = annot.get_events(stage=('NREM2', ))
+    assert [x['start'] for x in events] == [40, 31]
+    assert events[0]['stage'] == 'NREM2'
+
+    # the events are updated after changing the file
+    annot.set_stage_for_epoch(30, 'REM')
+    assert len(annot.get_events(stage=('NREM2', ))) == 0
+    annot.add_event('spindle', (33, 34), chan=('FP1', ))
+    annot.remove_event('spindle', chan=('FP1', ))
+    assert [x['start'] for x in annot.get_events()] == [10, 31]
+
+    assert Annotations(annot_file).get_events() == annot.get_events()
+
+
 def test_import_domino():
     annot = Annotations(annot_file)
     record_start = datetime(2015, 9, 21, 21, 40, 30)
@@ -0,0 +1,111 @@
+from numpy import asarray, random
+from pytest import approx
+
+from wonambi.detect import merge_close, merge_intervals
+from wonambi.detect.merge import merge_table
+from wonambi.graphoelement import Spindles
+
+
+def _merge_close_loop(events, min_interval):
+    """Merge the events one at the time, as it used to be done."""
+    merged = []
+    for higher in sorted(events, key=lambda x: x['start']):
+        higher = dict(higher)
+        if not merged:
+            merged.append(higher)
+
+        else:
+            lower = merged[-1]
+            if higher['start'] - lower['end'] <= min_interval:
+                if (higher['end'] - higher['start'] >
+                   lower['end'] - lower['start']):
+                    higher['start'] = min(lower['start'], higher['start'])
+                    merged[-1] = higher
+                else:
+                    lower['end'] = max(lower['end'], higher['end'])
+            else:
+                merged.append(higher)
+
+    return merged
+
+
+def _random_events(n_events, n_chan=3, seed=0):
+    rng = random.RandomState(seed)
+    start = rng.uniform(0, n_events, n_events).round(2)
+    dur = rng.uniform(.1, 3, n_events).round(2)
+    chan = rng.randint(n_chan, size=n_events)
+    return [{'start': s, 'end': s + d, 'chan': 'chan' + str(c), 'id': i}
+            for i, (s, d, c) in enumerate(zip(start, dur, chan))]
+
+
+def test_merge_intervals():
+    kept, start, end = merge_intervals([0, 4, 9, 20], [5, 10, 16.5, 21], 1)
+    assert kept.tolist() == [1, 3]
+    assert start.tolist() == [0, 20]
+    assert end.tolist() == [16.5, 21]
+
+    kept, start, end = merge_intervals([], [], 1)
+    assert len(kept) == len(start) == len(end) == 0
+
+
+def test_merge_intervals_group():
+    kept, start, end = merge_intervals([0, 0.5, 2, 2.55], [1, 4, 2.5, 4],
+                                       min_interval=0.1, group=[0, 1, 0, 0])
+    assert kept.tolist() == [0, 1, 3]
+    assert start.tolist() == [0, 0.5, 2]
+    assert end.tolist() == [1, 4, 4]
+
+
+def test_merge_close_as_loop():
+    events = _random_events(2000)
+    for min_interval in (0, .5, 2):
+        merged = merge_close(events, min_interval)
+        expected = _merge_close_loop(events, min_interval)
+        assert [x['id'] for x in merged] == [x['id'] for x in expected]
+        assert [x['start'] for x in merged] == [x['start'] for x in expected]
+        assert [x['end'] for x in merged] == approx([x['end'] for x in
+                                                     expected])
+
+    assert 'id' in events[0] and events[0]['id'] == 0  # input not modified
+
+
+def test_merge_close_within_chan():
+    events = _random_events(2000)
+    merged = merge_close(events, .5, by='chan')
+
+    for chan in ('chan0', 'chan1', 'chan2'):
+        expected = _merge_close_loop([x for x in events if x['chan'] == chan],
+                                     .5)
+        merged_chan = [x for x in merged if x['chan'] == chan]
+        assert [x['id'] for x in merged_chan] == [x['id'] for x in expected]
+
+    assert [x['start'] for x in merged] == sorted(x['start'] for x in merged)
+
+
+def test_merge_close_list_chan():
+    """Channels in the annotations are lists."""
+    events = [{'start': 0, 'end': 1, 'chan': ['Fz']},
+              {'start': 1.5, 'end': 3, 'chan': ['Cz']},
+              {'start': 2, 'end': 4, 'chan': ['Fz']}]
+    assert len(merge_close(events, 1)) == 1
+    merged = merge_close(events, 1, by='chan')
+    assert [x['start'] for x in merged] == [0, 1.5]
+    assert [x['end'] for x in merged] == [4, 3]
+    assert merge_close([], 1) == []
+
+
+def test_merge_table():
+    events = _random_events(500)
+    spindles = Spindles()
+    spindles.chan_name = asarray(['chan0', 'chan1', 'chan2'])
+    spindles.events = events
+
+    merged = merge_table(spindles.table, .5)
+    assert merged['id'].tolist() == [x['id'] for x in merge_close(events, .5)]
+
+    merged = merge_table(spindles.table, .5, by='chan')
+    expected = merge_close(events, .5, by='chan')
+    assert merged['id'].tolist() == [x['id'] for x in expected]
+    assert merged['end'] == approx([x['end'] for x in expected])
+
+    assert len(merge_table(spindles.table[:0], .5)) == 0
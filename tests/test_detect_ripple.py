@@ -1,4 +1,80 @@
-from wonambi.detect.ripple import DetectRipple
+from numpy import asarray, concatenate, exp, pi, random, sin
+from pytest import approx, raises
+
+from wonambi import Dataset
+from wonambi.detect.ripple import DetectRipple, count_peaks
+from wonambi.ioeeg import write_wonambi
+from wonambi.utils import create_data
+
+from .paths import wonambi_file
+
+
+def _synthetic_ripples(n_chan=2):
+    data = create_data(n_trial=1, s_freq=1000, time=(0, 60), n_chan=n_chan)
+    t = data.time[0]
+    rng = random.RandomState(0)
+    for i in range(n_chan):
+        x = rng.randn(len(t)) * 5
+        for t0 in (5 + i, 20 + 2 * i, 40):
+            x += 30 * sin(2 * pi * 90 * t) * exp(-((t - t0) / .03) ** 2)
+        data.data[0][i] = x
+    return data
+
 
 def test_detect_ripple():
-    DetectRipple()
+    data = _synthetic_ripples()
+    ripple = DetectRipple()(data)
+
+    assert len(ripple.events) == 6
+    peaks = sorted(ev['peak_time'] for ev in ripple.events)
+    assert peaks == approx([5, 6, 20, 22, 40, 40], abs=.01)
+    assert all(ev['dur'] >= .038 for ev in ripple.events)
+    assert ripple.density == approx([1.5, 1.5])
+
+
+def test_detect_ripple_unknownmethod():
+    with raises(ValueError):
+        DetectRipple(method='xxx')
+
+
+def test_detect_ripple_n_jobs():
+    data = _synthetic_ripples()
+    detrip = DetectRipple()
+    assert detrip(data, n_jobs=2).events == detrip(data).events
+
+
+def test_count_peaks():
+    rng = random.RandomState(0)
+    dat = rng.randn(1000)
+    events = asarray([[0, 0, 50], [100, 100, 180], [900, 900, 1000]])
+
+    n_max, n_min = count_peaks(events, dat, n_smp=3)
+
+    padded = concatenate((dat[:1], dat, dat[-1:]))
+    smooth = (padded[:-2] + padded[1:-1] + padded[2:]) / 3
+    for ev, one_max, one_min in zip(events, n_max, n_min):
+        exp_max = exp_min = 0
+        for i in range(max(ev[0], 1), min(ev[2], 999)):
+            if smooth[i - 1] < smooth[i] >= smooth[i + 1]:
+                exp_max += 1
+            if smooth[i - 1] > smooth[i] <= smooth[i + 1]:
+                exp_min += 1
+        assert one_max == exp_max
+        assert one_min == exp_min
+
+
+def test_detect_ripple_dataset():
+    data = _synthetic_ripples()
+    write_wonambi(data, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    detrip = DetectRipple()
+    ripple = detrip(data)
+    ripple_chunks = detrip.detect_dataset(d, data.chan[0], chunk=19.5)
+
+    assert ripple_chunks.det_value == approx(ripple.det_value, rel=1e-2)
+    assert ripple_chunks.density == approx(ripple.density)
+    assert len(ripple_chunks.events) == len(ripple.events)
+    for ev, ev_chunks in zip(ripple.events, ripple_chunks.events):
+        assert ev_chunks['chan'] == ev['chan']
+        assert ev_chunks['peak_time'] == approx(ev['peak_time'])
@@ -1,7 +1,13 @@
+from numpy import argmax, asarray, random, zeros
+
 from wonambi import Dataset
-from wonambi.detect.slowwave import DetectSlowWave
+from wonambi.detect.slowwave import (DetectSlowWave, _find_next_negative,
+                                     select_peaks)
+from wonambi.detect.spindle import detect_events
+from wonambi.ioeeg import write_wonambi
+from wonambi.utils import create_data
 
-from .paths import psg_file
+from .paths import psg_file, wonambi_file
 
 d = Dataset(psg_file)
 data = d.read_data(chan=('EEG Fpz-Cz', 'EEG Pz-Oz'), begtime=27930, endtime=27960)
@@ -21,3 +27,58 @@ def test_detect_spindle_AASM_Massimini2004():
 
     sw = detsw(data)
     assert len(sw.events) == 0
+
+
+def test_select_peaks():
+    dat = asarray([-1, -3, -1, 2, 5, 2, -1, -2, 1, 3, 1, -1, 0, 0, 1])
+    events = asarray([[0, 1, 3], [6, 7, 8], [11, 11, 12]])
+
+    assert select_peaks(dat, events, -2).tolist() == [[0, 1, 3], [6, 7, 8]]
+    assert select_peaks(dat, events, -3).tolist() == [[0, 1, 3]]
+
+
+def test_find_next_negative():
+    rng = random.RandomState(0)
+    dat = rng.randn(2000)
+    troughs = detect_events(dat, 'below_thresh', value=0.)
+
+    for window in (3, 5, 20):
+        ends = _find_next_negative(dat, troughs, window)
+        # loop over events, with the zero crossing if there is no next sample
+        exp_ends = [ev[2] + argmax(dat[ev[2]:ev[0] + window] < 0)
+                    if ev[2] < min(len(dat), ev[0] + window) else ev[2]
+                    for ev in troughs]
+        assert ends.tolist() == exp_ends
+
+
+def _detect_below(dat, s_freq, time, opts):
+    """Detect the periods below -10, instead of detect_Massimini2004."""
+    events = detect_events(dat, 'below_thresh', value=-10.)
+    if events is None:
+        return []
+    return [{'start': time[ev[0]], 'end': time[ev[2] - 1]} for ev in events]
+
+
+def test_detect_slowwave_dataset(monkeypatch):
+    data = create_data(n_trial=1, s_freq=256, time=(0, 60), n_chan=2)
+    t = data.time[0]
+    for i in range(2):
+        x = zeros(len(t))
+        for t0 in (10 + i, 19.5, 30, 45 + 2 * i):  # 19.5 is across 2 chunks
+            x[(t >= t0) & (t < t0 + 1)] = -20
+        data.data[0][i] = x
+    write_wonambi(data, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    monkeypatch.setattr('wonambi.detect.slowwave.detect_Massimini2004',
+                        _detect_below)
+    sw = DetectSlowWave().detect_dataset(d, data.chan[0], chunk=20, pad=10)
+
+    exp_events = []
+    for one_chan, dat in zip(data.chan[0], data.data[0]):
+        for ev in _detect_below(dat, data.s_freq, t, None):
+            exp_events.append((ev['start'], one_chan))
+    exp_events = sorted(exp_events, key=lambda x: x[0])
+
+    assert len(sw.events) == 8
+    assert [(ev['start'], ev['chan']) for ev in sw.events] == exp_events
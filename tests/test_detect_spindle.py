@@ -1,9 +1,24 @@
+from numpy import (argmax, argmin, asarray, c_, diff, empty, exp, isnan,
+                   maximum, mean, minimum, nan, ones, pi, random, sin, sqrt,
+                   square, zeros)
 from pytest import approx, raises
+from scipy.signal import periodogram
 
 from wonambi import Dataset
-from wonambi.detect.spindle import DetectSpindle
+from wonambi.attr import Annotations, create_empty_annotations
+from wonambi.detect.spindle import (DetectSpindle, SIGNAL_CACHE, SignalCache,
+                                    _arg_reduce_in_segments,
+                                    _detect_start_end, _reduce_in_segments,
+                                    _remove_duplicate,
+                                    avg_power, detection_signals,
+                                    peak_in_power, power_ratio,
+                                    transform_signal)
+from wonambi.ioeeg import write_wonambi
+from wonambi.utils import create_data
 
-from .paths import psg_file
+from .paths import psg_file, EXPORTED_PATH, wonambi_file
+
+annot_detect_file = EXPORTED_PATH / 'annot_detect.xml'
 
 d = Dataset(psg_file)
 data = d.read_data(chan=('EEG Fpz-Cz', 'EEG Pz-Oz'), begtime=35790, endtime=35820)
@@ -53,3 +68,227 @@ def test_detect_spindle_to_data():
     sp_freq = sp.to_data('peak_freq')
     assert approx(sp_freq(0)[0]) == 14.49166667
 
+
+def test_transform_signal_moving_rms():
+    dat = random.RandomState(0).randn(2000)
+    s_freq = 256
+    halfdur = int(s_freq * 0.2 / 2)
+
+    ldat = len(dat)
+    expected = zeros((ldat))
+    for i in range(ldat):
+        expected[i] = sqrt(mean(square(dat[max(0, i - halfdur):min(ldat, i + halfdur)])))
+
+    rms = transform_signal(dat, s_freq, 'moving_rms', {'dur': 0.2})
+    assert rms == approx(expected)
+
+    # odd number of samples in the window: halfdur is rounded down to 11
+    rms = transform_signal(dat, 100, 'moving_rms', {'dur': 0.23})
+    expected = [sqrt(mean(square(dat[:i + 11]))) for i in range(5)]
+    assert rms[:5] == approx(expected)
+
+
+def _synthetic_spindles(n_chan=4):
+    data = create_data(n_trial=1, s_freq=256, time=(0, 60), n_chan=n_chan)
+    t = data.time[0]
+    rng = random.RandomState(0)
+    for i in range(n_chan):
+        x = rng.randn(len(t)) * 5
+        for t0 in (5 + i, 20 + 2 * i, 40):
+            x += 40 * sin(2 * pi * 13 * t) * exp(-((t - t0) / .3) ** 2)
+        data.data[0][i] = x
+    return data
+
+
+def test_detect_spindle_n_jobs():
+    data = _synthetic_spindles()
+    detsp = DetectSpindle()
+    sp = detsp(data)
+    sp_parallel = detsp(data, n_jobs=2)
+
+    assert len(sp.events) == 9
+    assert sp_parallel.events == sp.events
+    assert (sp_parallel.det_value == sp.det_value).all()
+
+
+def test_detect_spindle_cache():
+    data = _synthetic_spindles()
+    SIGNAL_CACHE.clear()
+
+    for method in ('Moelle2011', 'Nir2011', 'UCSD'):
+        detsp = DetectSpindle(method=method)
+        sp = detsp(data)
+        n_cached = len(SIGNAL_CACHE)
+        assert sp.events == detsp(data).events
+        assert len(SIGNAL_CACHE) == n_cached
+
+        # only the threshold changes, the signals are reused
+        detsp.det_thresh *= 2
+        fewer = detsp(data)
+        assert len(SIGNAL_CACHE) == n_cached
+        assert len(fewer.events) <= len(sp.events)
+
+        # the transformation changes, the signals are computed again
+        detsp.det_thresh /= 2
+        if method == 'UCSD':
+            detsp.det_wavelet['width'] = .4
+        else:
+            detsp.det_butter['order'] = 3
+        detsp(data)
+        assert len(SIGNAL_CACHE) == n_cached + data.number_of('chan')[0]
+
+    expected = DetectSpindle()(data).events
+    SIGNAL_CACHE.clear()
+    SIGNAL_CACHE.max_bytes = 0  # disable the cache
+    assert DetectSpindle()(data).events == expected
+    assert len(SIGNAL_CACHE) == 0
+    SIGNAL_CACHE.max_bytes = SignalCache().max_bytes
+
+
+def test_signal_cache():
+    x = ones(100)  # 800 bytes
+    dat_det, dat_sel = detection_signals(x, 100, DetectSpindle())
+    assert not dat_det.flags.writeable
+    assert dat_sel is None
+
+    cache = SignalCache(max_bytes=2000)
+    cache.put('a', (ones(100), None))
+    cache.put('b', (ones(100), None))
+    assert cache.get('a') is not None  # now 'b' is the least recently used
+    cache.put('c', (ones(100), None))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.nbytes == 1600
+
+    cache.put('d', (ones(300), None))  # larger than the cache
+    assert cache.get('d') is None
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_spectral_features_batched():
+    rng = random.RandomState(0)
+    dat = rng.randn(5000)
+    s_freq = 256
+    x0 = rng.randint(-50, 4500, 200)
+    x1 = x0 + rng.choice([128, 129, 200, 256], 200)
+    x1[-1] = 5000  # beyond the end
+    events = c_[x0, (x0 + x1) // 2, x1]
+
+    ratio = empty(len(events))
+    peak = empty(len(events))
+    avg = empty(len(events))
+    ddat = diff(dat)
+    for i, (e0, _, e1) in enumerate(events):
+        if e0 < 0 or e1 >= len(dat):
+            ratio[i] = 0
+        else:
+            f, Pxx = periodogram(dat[e0:e1], s_freq, scaling='spectrum')
+            Pxx = sqrt(Pxx)
+            ratio[i] = (mean(Pxx[(f >= 11) & (f <= 18)]) /
+                        mean(Pxx[f <= 18]))
+
+        if e0 < 0 or e1 >= len(ddat):
+            peak[i] = avg[i] = nan
+        else:
+            f, Pxx = periodogram(ddat[e0:e1], s_freq)
+            peak[i] = f[Pxx[f < 50].argmax()]
+            b0 = asarray([abs(x - 11) for x in f]).argmin()
+            b1 = asarray([abs(x - 18) for x in f]).argmin()
+            avg[i] = mean(Pxx[b0:b1])
+
+    selected = power_ratio(events, dat, s_freq, (11, 18), .5)
+    assert (selected == events[ratio > .5, :]).all()
+
+    p = peak_in_power(events, dat, s_freq, 'interval')
+    assert (isnan(p) == isnan(peak)).all()
+    assert p[~isnan(p)] == approx(peak[~isnan(peak)])
+
+    a = avg_power(events, dat, s_freq, (11, 18))
+    assert a[~isnan(a)] == approx(avg[~isnan(avg)])
+
+
+def test_detect_spindle_dataset():
+    data = _synthetic_spindles()
+    write_wonambi(data, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    detsp = DetectSpindle()
+    sp = detsp(data)
+    sp_chunks = detsp.detect_dataset(d, data.chan[0], chunk=19.5, pad=10)
+
+    assert sp_chunks.det_value == approx(sp.det_value)
+    assert sp_chunks.density == approx(sp.density)
+    assert len(sp_chunks.events) == len(sp.events)
+    for ev, ev_chunks in zip(sp.events, sp_chunks.events):
+        assert ev_chunks['chan'] == ev['chan']
+        assert ev_chunks['start'] == approx(ev['start'])
+
+
+def test_detect_spindle_dataset_stage():
+    data = _synthetic_spindles()
+    write_wonambi(data, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    create_empty_annotations(annot_detect_file, d)
+    annot = Annotations(annot_detect_file)
+    annot.add_rater('test', epoch_length=30)
+    annot.set_stage_for_epoch(0, 'NREM2', save=False)
+    annot.set_stage_for_epoch(30, 'Wake', save=False)
+
+    sp = DetectSpindle().detect_dataset(d, data.chan[0], annot=annot,
+                                        stage=['NREM2'])
+    assert len(sp.events) == 8
+    assert all(ev['start'] < 30 for ev in sp.events)
+
+
+def test_detect_spindle_dataset_UCSD():
+    data = _synthetic_spindles()
+    write_wonambi(data, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    detsp = DetectSpindle(method='UCSD')
+    sp = detsp(data)
+    sp_chunks = detsp.detect_dataset(d, data.chan[0], chunk=19.5, pad=10)
+
+    assert sp_chunks.det_value == approx(sp.det_value, rel=1e-2)
+    assert len(sp_chunks.events) == len(sp.events)
+    for ev, ev_chunks in zip(sp.events, sp_chunks.events):
+        assert ev_chunks['start'] == approx(ev['start'], abs=.05)
+
+
+def test_segment_reductions():
+    rng = random.RandomState(0)
+    dat = rng.randn(1000)
+    beg = asarray([0, 100, 120, 900])
+    end = asarray([50, 101, 300, 1000])  # overlapping and up to the end
+
+    for ufunc, func, argfunc in ((maximum, max, argmax),
+                                 (minimum, min, argmin)):
+        values = _reduce_in_segments(ufunc, dat, beg, end)
+        assert list(values) == [func(dat[b:e]) for b, e in zip(beg, end)]
+
+        idx = _arg_reduce_in_segments(ufunc, dat, beg, end)
+        assert list(idx) == [b + argfunc(dat[b:e]) for b, e in zip(beg, end)]
+
+    assert len(_arg_reduce_in_segments(maximum, dat, beg[:0], end[:0])) == 0
+
+
+def test_detect_start_end():
+    x = asarray([True, True, False, True, False, False, True])
+    assert _detect_start_end(x).tolist() == [[0, 2], [3, 4], [6, 7]]
+    assert _detect_start_end(~x).tolist() == [[2, 3], [4, 6]]
+    assert _detect_start_end(x[:0]) is None
+    assert _detect_start_end(zeros(5, dtype=bool)) is None
+
+
+def test_remove_duplicate():
+    dat = asarray([0., 3, 1, 5, 5, 2, 0, 0])
+    events = asarray([[0, 1, 4], [0, 3, 4], [0, 4, 4], [2, 2, 6],
+                      [5, 5, 8], [5, 6, 8]])
+    idx, new_events = _remove_duplicate(events, dat)
+    assert idx.tolist() == [0, 3, 4]
+    assert new_events.tolist() == [[0, 3, 4], [2, 2, 6], [5, 5, 8]]
+
+    idx, new_events = _remove_duplicate(events[:0], dat)
+    assert len(idx) == 0 and len(new_events) == 0
@@ -0,0 +1,105 @@
+from numpy import array_split, mean, median, random, sort, std
+from pytest import approx, raises
+
+from wonambi.detect.spindle import define_threshold
+from wonambi.detect.stats import QuantileSketch, RunningStats, SignalStats
+
+
+random.seed(0)
+x = random.lognormal(size=10001)
+
+
+def test_running_stats_chunks():
+    stats = RunningStats()
+    for one_x in array_split(x, 7):
+        stats.update(one_x)
+    stats.update(x[:0])
+
+    assert stats.n == len(x)
+    assert stats.mean == approx(mean(x))
+    assert stats.std == approx(std(x))
+
+
+def test_running_stats_merge():
+    stats = []
+    for one_x in array_split(x, 3):
+        one_stats = RunningStats()
+        one_stats.update(one_x)
+        stats.append(one_stats)
+
+    stats[0].merge(stats[1])
+    stats[0].merge(stats[2])
+    stats[0].merge(RunningStats())
+    assert stats[0].mean == approx(mean(x))
+    assert stats[0].std == approx(std(x))
+
+
+def test_quantile_sketch():
+    sketch = QuantileSketch()
+    for one_x in array_split(x, 5):
+        sketch.update(one_x)
+
+    sorted_x = sort(x)
+    for q in (0, .01, .5, .99, 1):
+        exact = sorted_x[int(q * (len(x) - 1))]
+        assert sketch.quantile(q) == approx(exact, rel=1e-3)
+
+    assert sketch.median == approx(median(x), rel=1e-3)
+
+
+def test_quantile_sketch_negative():
+    y = random.randn(1000)
+    y[:10] = 0
+
+    sketch = QuantileSketch(relative_accuracy=.01)
+    sketch.update(y)
+
+    sorted_y = sort(y)
+    for q in (0, .2, .4, .6, 1):
+        exact = sorted_y[int(q * (len(y) - 1))]
+        assert sketch.quantile(q) == approx(exact, rel=.01, abs=1e-12)
+
+
+def test_quantile_sketch_merge():
+    sketch = QuantileSketch()
+    sketch.update(x)
+
+    sketches = []
+    for one_x in array_split(x, 3):
+        one_sketch = QuantileSketch()
+        one_sketch.update(one_x)
+        sketches.append(one_sketch)
+    sketches[0].merge(sketches[1])
+    sketches[0].merge(sketches[2])
+
+    assert sketches[0].n == sketch.n
+    for q in (.1, .5, .9):
+        assert sketches[0].quantile(q) == sketch.quantile(q)
+
+    with raises(ValueError):
+        sketch.merge(QuantileSketch(relative_accuracy=.01))
+
+
+def test_quantile_sketch_errors():
+    with raises(ValueError):
+        QuantileSketch(relative_accuracy=0)
+
+    sketch = QuantileSketch()
+    with raises(ValueError):
+        sketch.update([1, float('nan')])
+
+    assert sketch.median != sketch.median  # nan
+
+
+def test_define_threshold_signal_stats():
+    stats = SignalStats()
+    for one_x in array_split(x, 4):
+        stats.update(one_x)
+
+    for method in ('mean', 'std', 'mean+std'):
+        assert define_threshold(stats, 100, method, 2) == approx(
+            define_threshold(x, 100, method, 2))
+
+    for method in ('median', 'median+std'):
+        assert define_threshold(stats, 100, method, 2) == approx(
+            define_threshold(x, 100, method, 2), rel=1e-3)
@@ -0,0 +1,73 @@
+from numpy import isnan, median, random
+from pytest import approx, raises
+
+from wonambi.graphoelement import Spindles
+
+
+def _spindles(n_events=100):
+    rng = random.RandomState(0)
+    events = []
+    for i in range(n_events):
+        start = rng.rand() * 1000
+        events.append({'start': start,
+                       'end': start + 1 + rng.rand(),
+                       'peak_val': rng.rand() * 50,
+                       'chan': ('Fz', 'Cz', 'Pz')[i % 3],
+                       })
+
+    sp = Spindles()
+    sp.chan_name = ['Fz', 'Cz', 'Pz', 'Oz']
+    sp.events = events
+    return sp, events
+
+
+def test_graphoelement_events():
+    sp, events = _spindles()
+
+    assert len(sp) == len(events)
+    assert sp.table['chan'][:3].tolist() == [0, 1, 2]
+    assert sp.events == events
+    assert list(sp) == events
+
+
+def test_graphoelement_chan_not_in_chan_name():
+    sp = Spindles()
+    sp.chan_name = ['Fz']
+    with raises(ValueError):
+        sp.events = [{'start': 0, 'end': 1, 'chan': 'Cz'}]
+
+
+def test_graphoelement_select():
+    sp, events = _spindles()
+
+    sp_mask = sp(sp.table['peak_val'] > 25)
+    sp_func = sp(lambda x: x['peak_val'] > 25)
+
+    exp_events = [ev for ev in events if ev['peak_val'] > 25]
+    assert sp_mask.events == exp_events
+    assert sp_func.events == exp_events
+    assert len(sp) == len(events)
+
+    sp.det_value = [1, 2]
+    sp_mask = sp(sp.table['chan'] == 0)
+    sp_mask.det_value.append(3)
+    assert sp.det_value == [1, 2]
+
+
+def test_graphoelement_to_data():
+    sp, events = _spindles()
+
+    count = sp.to_data('count')
+    assert count.data[0].tolist() == [34, 33, 33, 0]
+
+    avg = sp.to_data('peak_val')(0)
+    exp_avg = [sum(ev['peak_val'] for ev in events if ev['chan'] == chan) /
+               sum(1 for ev in events if ev['chan'] == chan)
+               for chan in ('Fz', 'Cz', 'Pz')]
+    assert avg[:3] == approx(exp_avg)
+    assert isnan(avg[3])
+
+    med = sp.to_data('peak_val', operator=median)(0)
+    exp_med = [median([ev['peak_val'] for ev in events if ev['chan'] == chan])
+               for chan in ('Fz', 'Cz', 'Pz')]
+    assert med[:3] == approx(exp_med)
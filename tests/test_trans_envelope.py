@@ -0,0 +1,65 @@
+from numpy import (absolute, allclose, complex64, float32, isnan, mean, sqrt,
+                   square, zeros)
+from pytest import raises
+from scipy.signal import hilbert
+
+from wonambi.trans import analytic, moving_window
+from wonambi.trans.envelope import compute_analytic, compute_moving
+from wonambi.utils import create_data
+
+
+data = create_data(n_trial=2, s_freq=256, time=(0, 4))
+
+
+def _loop(x, halfwidth, func):
+    n_smp = len(x)
+    out = zeros(n_smp)
+    for i in range(n_smp):
+        out[i] = func(x[max(0, i - halfwidth):min(n_smp, i + halfwidth)])
+    return out
+
+
+def test_analytic():
+    env = analytic(data)
+    assert env.data[1].shape == data.data[1].shape
+    # 1024 samples is already a fast length, so no padding
+    assert allclose(env.data[1], absolute(hilbert(data.data[1], axis=1)))
+
+    phase = analytic(data, output='phase', axis='time')
+    assert abs(phase.data[0]).max() <= 3.1416
+
+    with raises(ValueError):
+        analytic(data, output='power')
+
+
+def test_analytic_float32():
+    x = compute_analytic(data.data[0].astype(float32))
+    assert x.dtype == complex64
+
+    x = compute_analytic(data.data[0][:, :1021], axis=1)  # padded to 1024
+    assert x.shape == (8, 1021)
+    assert allclose(x.real, data.data[0][:, :1021])
+
+
+def test_moving_rms_mean_max():
+    rms = moving_window(data, 0.1, method='rms')
+    expected = _loop(data.data[0][3], 12, lambda x: sqrt(mean(square(x))))
+    assert allclose(rms.data[0][3], expected)
+
+    avg = moving_window(data, 0.1, method='mean', dtype='float32')
+    assert avg.data[1].dtype == float32
+    expected = _loop(data.data[1][5], 12, mean)
+    assert allclose(avg.data[1][5], expected, atol=1e-6)
+
+    x = moving_window(data, 0.1, method='max')
+    expected = _loop(data.data[1][2], 12, max)
+    assert allclose(x.data[1][2], expected)
+
+
+def test_moving_chan_axis():
+    x = compute_moving(data.data[0], 2, method='mean', axis=0)
+    assert allclose(x[:, 10], _loop(data.data[0][:, 10], 2, mean))
+
+    assert isnan(compute_moving(data.data[0], 0)).all()
+    with raises(ValueError):
+        compute_moving(data.data[0], 2, method='median')
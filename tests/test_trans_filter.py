@@ -0,0 +1,84 @@
+from numpy import allclose, float32
+from scipy.signal import fftconvolve, get_window
+from pytest import raises
+
+from wonambi import Dataset
+from wonambi.ioeeg import write_wonambi
+from wonambi.trans import convolve, filter_, filter_dataset
+from wonambi.trans.filter import design_filter
+from wonambi.utils import create_data
+
+from .paths import EXPORTED_PATH, wonambi_file
+
+filtered_file = EXPORTED_PATH / 'filtered.won'
+
+
+data = create_data(n_trial=2, s_freq=256, time=(0, 10))
+
+
+def test_filter_sos_matches_ba():
+    f_sos = filter_(data, low_cut=5, high_cut=20)
+    f_ba = filter_(data, low_cut=5, high_cut=20, sos=False)
+
+    assert f_sos.data[1].shape == data.data[1].shape
+    assert allclose(f_sos.data[1][:, 256:-256], f_ba.data[1][:, 256:-256],
+                    atol=1e-6)
+
+
+def test_filter_float32():
+    fdata = filter_(data, high_cut=30, dtype='float32')
+    assert fdata.data[0].dtype == float32
+
+
+def test_filter_cache():
+    design_filter.cache_clear()
+    filter_(data, low_cut=.3, order=2)
+    filter_(data, low_cut=.3, order=2)
+    assert design_filter.cache_info().hits == 1
+
+
+def test_filter_no_cutoff():
+    with raises(TypeError):
+        filter_(data)
+
+
+def test_filter_dataset():
+    one_trial = create_data(n_trial=1, s_freq=256, time=(0, 20))
+    write_wonambi(one_trial, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    f_full = filter_(one_trial, low_cut=.5, high_cut=35)
+    f_chunk = filter_dataset(d, filtered_file, low_cut=.5, high_cut=35,
+                             duration=3)
+    f_chunk = f_chunk.read_data()
+
+    assert f_chunk.data[0].shape == f_full.data[0].shape
+    assert allclose(f_chunk.data[0], f_full.data[0])
+
+
+def test_filter_dataset_float32():
+    one_trial = create_data(n_trial=1, s_freq=256, time=(0, 20))
+    f_full = filter_(one_trial, high_cut=35)
+    f_chunk = filter_dataset(iter(one_trial), filtered_file, high_cut=35,
+                             dtype='float32')
+
+    assert f_chunk.dataset.dtype == 'float32'
+    assert allclose(f_chunk.read_data().data[0], f_full.data[0], atol=1e-5)
+
+
+def test_convolve():
+    cdata = convolve(data, 'hann', length=.5)
+
+    taper = get_window('hann', 128)
+    taper = taper / sum(taper)
+    for i in range(data.number_of('trial')):
+        assert cdata.data[i].shape == data.data[i].shape
+        expected = fftconvolve(data.data[i][3, :], taper, 'same')
+        assert allclose(cdata.data[i][3, :], expected)
+
+
+def test_convolve_chan():
+    tf = create_data(datatype='ChanTimeFreq', n_trial=2)
+    ctf = convolve(tf, 'boxcar', axis='chan', length=3 / tf.s_freq)
+    expected = fftconvolve(tf.data[1][:, 5, 2], [1 / 3] * 3, 'same')
+    assert allclose(ctf.data[1][:, 5, 2], expected)
@@ -0,0 +1,202 @@
+from numpy import allclose, complex64, float32, isnan, memmap
+from pytest import raises
+from scipy.signal import fftconvolve
+
+from wonambi import Dataset
+from wonambi.attr import Annotations, create_empty_annotations
+from wonambi.ioeeg import write_wonambi
+from wonambi.trans import (epoch_bandpower, frequency, select, timefrequency,
+                           welch_dataset)
+from wonambi.trans.frequency import _create_morlet, _dpss_tapers
+from wonambi.utils import create_data
+
+from .paths import EXPORTED_PATH, wonambi_file
+
+TIMEFREQ_PATH = EXPORTED_PATH / 'timefreq'
+annot_psd_file = EXPORTED_PATH / 'annot_psd.xml'
+bandpower_dir = EXPORTED_PATH / 'bandpower'
+
+
+data = create_data(n_trial=2, s_freq=256, time=(0, 5))
+FOI = (8, 12, 30)
+
+
+def _timefrequency_loop(data, time_skip=1):
+    """Convolve one channel and one wavelet at the time."""
+    wavelets = _create_morlet({'foi': FOI, 'ratio': 5, 'sigma_f': None,
+                               'dur_in_sd': 4, 'dur_in_s': None,
+                               'normalization': 'area', 'zero_mean': False},
+                              data.s_freq)
+    dat = data.data[1][2, :]
+    return [fftconvolve(dat, w, 'same')[::time_skip] for w in wavelets]
+
+
+def test_timefrequency_morlet():
+    tf = timefrequency(data, foi=FOI)
+    assert tf.data[1].shape == (8, 1280, 3)
+
+    expected = _timefrequency_loop(data)
+    for i_f in range(len(FOI)):
+        assert allclose(tf.data[1][2, :, i_f], expected[i_f])
+
+
+def test_timefrequency_morlet_time_skip():
+    tf = timefrequency(data, foi=FOI, time_skip=3, n_jobs=2)
+    assert tf.data[1].shape == (8, 427, 3)
+    assert len(tf.time[1]) == 427
+
+    expected = _timefrequency_loop(data, time_skip=3)
+    for i_f in range(len(FOI)):
+        assert allclose(tf.data[1][2, :, i_f], expected[i_f])
+
+
+def test_timefrequency_complex64():
+    tf = timefrequency(data, foi=FOI, dtype='complex64')
+    assert tf.data[0].dtype == complex64
+
+
+def test_timefrequency_spectrogram():
+    tf = timefrequency(data, method='spectrogram')
+    assert tf.data[0].shape[0] == 8
+
+
+def test_timefrequency_memmap():
+    tf = timefrequency(data, foi=FOI, time_skip=2)
+    tf_mem = timefrequency(data, foi=FOI, time_skip=2, block=.3,
+                           memmap_dir=TIMEFREQ_PATH)
+
+    assert isinstance(tf_mem.data[1], memmap)
+    assert allclose(tf_mem.data[1], tf.data[1])
+
+    # a second call does not overwrite the files of the first one
+    other = create_data(n_trial=2, s_freq=256, time=(0, 5))
+    timefrequency(other, foi=FOI, time_skip=2, memmap_dir=TIMEFREQ_PATH)
+    assert allclose(tf_mem.data[1], tf.data[1])
+
+
+def test_timefrequency_power_bin():
+    tf = timefrequency(data, foi=FOI)
+    tf_pow = timefrequency(data, foi=FOI, output='power', dtype='float32',
+                           time_bin=.5, block=1.2)
+
+    assert tf_pow.data[0].dtype == float32
+    assert tf_pow.data[0].shape == (8, 10, 3)
+    assert len(tf_pow.time[0]) == 10
+
+    power = abs(tf.data[0][:, 128:256, :]) ** 2
+    assert allclose(tf_pow.data[0][:, 1, :], power.mean(axis=1), rtol=1e-5)
+    assert allclose(tf_pow.time[0][1], tf.time[0][128:256].mean())
+
+
+def test_timefrequency_bin_complex():
+    with raises(ValueError):
+        timefrequency(data, foi=FOI, time_bin=1)
+
+
+def test_welch_dataset():
+    one_trial = create_data(n_trial=1, s_freq=256, time=(0, 20))
+    write_wonambi(one_trial, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    psd = welch_dataset(d, chunk=3)
+    expected = frequency(one_trial)
+
+    assert psd.number_of('trial') == 1
+    assert allclose(psd.freq[0], expected.freq[0])
+    assert allclose(psd.data[0], expected.data[0])
+
+
+def test_welch_dataset_stage():
+    one_trial = create_data(n_trial=1, s_freq=256, time=(0, 40))
+    write_wonambi(one_trial, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    create_empty_annotations(annot_psd_file, d)
+    annot = Annotations(annot_psd_file)
+    annot.add_rater('test', epoch_length=10)
+    annot.set_stage_for_epoch(0, 'NREM2', save=False)
+    annot.set_stage_for_epoch(10, 'NREM3', save=False)
+    annot.set_stage_for_epoch(20, 'NREM2', save=False)
+    annot.set_stage_for_epoch(30, 'NREM2', save=False)
+    annot.set_stage_for_epoch(30, 'Bad', attr='quality', save=False)
+
+    psd, epochs = welch_dataset(d, annot=annot, stage=['NREM2', 'NREM3'],
+                                keep_epochs=True, chunk=4)
+    assert psd.attr['stage'] == ['NREM2', 'NREM3']
+    assert epochs.number_of('trial') == 3
+    assert [x['start'] for x in epochs.attr['epochs']] == [0, 10, 20]
+
+    nrem2 = select(one_trial, time=(0, 10))
+    expected = frequency(nrem2)
+    assert allclose(epochs.data[0], expected.data[0])
+    assert allclose(psd.data[0], (epochs.data[0] + epochs.data[2]) / 2)
+
+
+def test_epoch_bandpower():
+    one_trial = create_data(n_trial=1, s_freq=256, time=(0, 45))
+    write_wonambi(one_trial, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    bands = [(1, 4), (4, 8), (8, 30)]
+    bp = epoch_bandpower(d, bands, epoch_length=10, chunk=20)
+    assert bp.data[0].shape == (4, 8, 3)
+    assert list(bp.axis['epoch'][0]) == [0, 10, 20, 30]
+    assert list(bp.axis['band'][0]) == ['1-4', '4-8', '8-30']
+
+    epoch = select(one_trial, time=(20, 30))
+    psd = frequency(epoch, duration=2)
+    f = psd.freq[0]
+    expected = psd.data[0][:, (f >= 4) & (f < 8)].sum(axis=1) * (f[1] - f[0])
+    assert allclose(bp.data[0][2, :, 1], expected)
+
+
+def test_epoch_bandpower_annot():
+    one_trial = create_data(n_trial=1, s_freq=256, time=(0, 40))
+    write_wonambi(one_trial, wonambi_file)
+    d = Dataset(wonambi_file)
+
+    create_empty_annotations(annot_psd_file, d)
+    annot = Annotations(annot_psd_file)
+    annot.add_rater('test', epoch_length=15)
+
+    bp = epoch_bandpower(d, [(1, 4)], chan=['chan01'], annot=annot,
+                         cache_dir=bandpower_dir)
+    assert len(bp.axis['epoch'][0]) == len(list(annot.epochs))
+    assert not isnan(bp.data[0][:2]).any()
+    assert isnan(bp.data[0][2]).all()  # partial epoch at the end
+
+    assert len(list(bandpower_dir.glob('bandpower_*.npy'))) >= 1
+    cached = epoch_bandpower(d, [(1, 4)], chan=['chan01'], annot=annot,
+                             cache_dir=bandpower_dir)
+    assert allclose(cached.data[0], bp.data[0], equal_nan=True)
+
+
+def test_frequency_multitaper():
+    _dpss_tapers.cache_clear()
+    epochs = create_data(n_trial=5, s_freq=256, time=(0, 4))
+    psd = frequency(epochs, method='multitaper')
+    assert _dpss_tapers.cache_info().misses == 1
+
+    assert psd.data[3].shape == (8, 513)
+    assert allclose(psd.freq[3][-1], 128)
+
+    # same density as welch, on average
+    welch = frequency(epochs, duration=4)
+    assert allclose(psd.data[3].mean(), welch.data[3].mean(), rtol=.2)
+
+    # one batch of trials is the same as one trial at the time
+    one_trial = frequency(select(epochs, trial=[3]), method='multitaper')
+    assert allclose(one_trial.data[0], psd.data[3])
+
+
+def test_frequency_multitaper_options():
+    epochs = create_data(n_trial=2, s_freq=256, time=(0, 4))
+    psd = frequency(epochs, method='multitaper', fmin=10, fmax=20,
+                    bandwidth=2)
+    assert psd.freq[0][0] == 10
+    assert psd.freq[0][-1] == 20
+
+    psd_adapt = frequency(epochs, method='multitaper', fmin=10, fmax=20,
+                          bandwidth=2, adaptive=True)
+    assert psd_adapt.data[0].shape == psd.data[0].shape
+    assert allclose(psd_adapt.data[0].mean(), psd.data[0].mean(), rtol=.2)
@@ -1,5 +1,5 @@
 from numpy import power, mean, nanmax, std
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_allclose, assert_array_equal
 from pytest import raises
 
 from wonambi.trans import math
@@ -97,3 +97,29 @@ def test_math_diff():
     dat = data(trial=0, chan='chan01')[2] - data(trial=0, chan='chan01')[1]
     dat1 = data1(trial=0, chan='chan01')[2]
     assert dat == dat1
+
+
+def test_math_unknown_operator_name():
+
+    with raises(ValueError):
+        math(data, operator_name='eval')
+
+
+def test_math_pointwise_chain_does_not_modify_input():
+
+    orig = data.data[0].copy()
+    data1 = math(data, operator_name=('square', 'sqrt'))
+    assert_array_equal(data.data[0], orig)
+    assert_allclose(data1.data[0], abs(orig))
+
+
+def test_math_chunked_rms():
+
+    rms = math(data, operator_name=('square', 'mean', 'sqrt'), axis='time')
+    rms_chunk = math(data, operator_name=('square', 'mean', 'sqrt'),
+                     axis='time', chunk=7)
+    assert_allclose(rms_chunk.data[3], rms.data[3])
+    assert rms_chunk.list_of_axes == ('chan', )
+
+    total = math(data, operator_name='sum', axis='chan', chunk=3)
+    assert_allclose(total.data[0], data.data[0].sum(axis=0))
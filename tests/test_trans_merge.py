@@ -0,0 +1,39 @@
+from numpy import allclose, float32
+from pytest import raises
+
+from wonambi.trans import concatenate, select
+from wonambi.utils import create_data
+
+
+data = create_data(n_trial=5, s_freq=256, time=(0, 1))
+
+
+def test_concatenate_trial():
+    data1 = concatenate(data, axis='trial')
+
+    assert data1.number_of('trial') == 1
+    assert data1.data[0].shape == (8, 256, 5)
+    assert data1.list_of_axes == ('chan', 'time', 'trial_axis')
+    assert allclose(data1.data[0][:, :, 3], data.data[3])
+    assert data1(trial=0, trial_axis='trial000002').shape == (8, 256)
+
+
+def test_concatenate_trial_dtype():
+    data_f = create_data(n_trial=2, s_freq=256, time=(0, 1))
+    data_f.data[0] = data_f.data[0].astype(float32)
+    data_f.data[1] = data_f.data[1].astype(float32)
+    data1 = concatenate(data_f, axis='trial', check_unique=False)
+    assert data1.data[0].dtype == float32
+
+
+def test_concatenate_trial_shape():
+    data_short = select(data, trial=[0, 1])
+    data_short.data[1] = data_short.data[1][:, :100]
+    with raises(ValueError):
+        concatenate(data_short, axis='trial')
+
+
+def test_concatenate_time():
+    data1 = concatenate(data, axis='time')
+    assert data1.data[0].shape == (8, 256 * 5)
+    assert allclose(data1.data[0][:, 256:512], data.data[1])
@@ -0,0 +1,46 @@
+from numpy import allclose, float32, mean, random
+
+from wonambi.attr import Channels
+from wonambi.trans import montage
+from wonambi.trans.montage import compile_reference, create_bipolar_chan
+from wonambi.utils import create_data
+
+
+def test_montage_ref_chan():
+    data = create_data(n_trial=3, s_freq=256, time=(0, 2))
+    compile_reference.cache_clear()
+    reref = montage(data, ref_chan=['chan02', 'chan05'])
+    montage(data, ref_chan=['chan02', 'chan05'])
+    assert compile_reference.cache_info().hits == 1
+
+    x = data.data[2]
+    assert allclose(reref.data[2], x - mean(x[[2, 5], :], axis=0))
+
+
+def test_montage_avg_float32():
+    data = create_data(n_trial=2, s_freq=256, time=(0, 2))
+    data.data[0] = data.data[0].astype(float32)
+    data.data[1] = data.data[1].astype(float32)
+
+    reref = montage(data, ref_to_avg=True)
+    assert reref.data[0].dtype == float32
+    assert allclose(reref.data[1], data.data[1] - data.data[1].mean(axis=0),
+                    atol=1e-5)
+
+
+def test_montage_bipolar():
+    labels = ['chan{0:02}'.format(i) for i in range(8)]
+    xyz = random.RandomState(0).random_sample((8, 3)) * 20
+    chan = Channels(labels, xyz)
+
+    bipolar, trans = create_bipolar_chan(chan, 15)
+    for label, row in zip(bipolar.return_label(), trans.toarray()):
+        chan0, chan1 = label.split('-')
+        assert row[labels.index(chan0)] == 1
+        assert row[labels.index(chan1)] == -1
+
+    data = create_data(n_trial=2, s_freq=256, time=(0, 2))
+    data.attr['chan'] = chan
+    bip_data = montage(data, bipolar=15)
+    assert bip_data.number_of('chan')[0] == bipolar.n_chan
+    assert allclose(bip_data.data[1], trans.dot(data.data[1]))
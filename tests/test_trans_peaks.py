@@ -0,0 +1,19 @@
+from numpy import argmax
+
+from wonambi.trans import peaks
+from wonambi.utils import create_data
+
+
+data = create_data(n_trial=3, s_freq=256, time=(0, 2))
+
+
+def test_peaks():
+    peak = peaks(data, method='max', axis='time')
+    assert peak.list_of_axes == ('chan', )
+    assert peak.data[2][4] == data.time[2][argmax(data.data[2][4])]
+
+
+def test_peaks_limits():
+    peak = peaks(data, method='min', axis='time', limits=(0.5, 1))
+    for trl in range(3):
+        assert ((peak.data[trl] >= 0.5) & (peak.data[trl] <= 1)).all()
@@ -0,0 +1,79 @@
+from numpy import allclose, arange, isnan, shares_memory
+from pytest import raises
+from scipy.signal import resample_poly
+
+from wonambi.trans import resample, select
+from wonambi.trans.select import _design_poly_filter
+from wonambi.utils import create_data
+
+
+def test_resample_rational():
+    data = create_data(n_trial=2, s_freq=1000, time=(1, 11))
+    res = resample(data, s_freq=256)
+
+    assert res.s_freq == 256
+    assert res.data[0].shape == (8, 2560)
+    assert allclose(res.time[0], 1 + arange(2560) / 256)
+
+    expected = resample_poly(data.data[1], 32, 125, axis=1)
+    assert allclose(res.data[1], expected)
+
+
+def test_resample_up():
+    data = create_data(n_trial=1, s_freq=200, time=(0, 2))
+    res = resample(data, s_freq=500)
+    assert res.data[0].shape == (8, 1000)
+    assert allclose(res.time[0][1], 1 / 500)
+
+
+def test_resample_chunk():
+    _design_poly_filter.cache_clear()
+    data = create_data(n_trial=1, s_freq=512, time=(0, 20))
+    res = resample(data, s_freq=200)
+    res_chunk = resample(data, s_freq=200, chunk=3)
+
+    assert _design_poly_filter.cache_info().hits == 1
+    assert allclose(res.data[0], res_chunk.data[0])
+
+
+def test_resample_iir():
+    data = create_data(n_trial=1, s_freq=512, time=(0, 4))
+    res = resample(data, s_freq=128, ftype='iir')
+    assert res.data[0].shape == (8, 512)
+
+    with raises(ValueError):
+        resample(data, s_freq=200, ftype='iir')
+
+
+def test_select_time_view():
+    data = create_data(n_trial=2, s_freq=256, time=(0, 10))
+    sel = select(data, trial=[1], time=(2, 3))
+
+    assert sel.data[0].shape == (8, 256)
+    assert shares_memory(sel.data[0], data.data[1])
+    assert allclose(sel.time[0], data.time[1][512:768])
+    assert allclose(sel.data[0], data.data[1][:, 512:768])
+
+    sel = select(data, time=(None, 1))
+    assert sel.data[1].shape == (8, 256)
+    sel = select(data, time=(9.5, None))
+    assert sel.data[1].shape == (8, 128)
+    sel = select(data, time=(20, 30))
+    assert sel.data[1].shape == (8, 0)
+
+
+def test_select_chan_and_time():
+    data = create_data(n_trial=1, s_freq=256, time=(0, 4))
+    sel = select(data, chan=['chan05', 'chan01'], time=(1, 2))
+    assert list(sel.chan[0]) == ['chan05', 'chan01']
+    assert allclose(sel.data[0], data.data[0][[5, 1], 256:512])
+
+    sel = select(data, chan=['chan05', 'xxx'])  # missing channel is NaN
+    assert isnan(sel.data[0][1, :]).all()
+
+
+def test_select_invert():
+    data = create_data(n_trial=1, s_freq=256, time=(0, 4))
+    sel = select(data, chan=['chan05', 'chan01'], invert=True)
+    assert sel.data[0].shape == (6, 1024)
+    assert 'chan05' not in sel.chan[0]
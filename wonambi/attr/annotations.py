@@ -1,11 +1,11 @@
 """Module to keep track of the user-made annotations and sleep scoring.
 """
 from logging import getLogger
-from bisect import bisect_left
 from csv import writer
 from datetime import datetime, timedelta
 from itertools import compress
-from numpy import allclose, asarray, in1d, modf, isnan
+from numpy import (allclose, arange, asarray, in1d, isnan, maximum, modf, ones,
+                   searchsorted)
 from math import ceil, inf
 from pathlib import Path
 from re import search, sub
@@ -161,6 +161,8 @@ class Annotations():
 
         self.xml_file = xml_file
         self.root = self.load()
+        self._event_index = {}
+        self._epoch_index = {}
         if rater_name is None:
             self.rater = self.root.find('rater')
         else:
@@ -263,6 +265,9 @@ class Annotations():
                         self.rater = all_raters[idx]
 
                 self.root.remove(rater)
+                self._epoch_index.pop(rater, None)
+                for e_type in rater.iterfind('events/event_type'):
+                    self._event_index.pop(e_type, None)
 
         self.save()
 
@@ -289,6 +294,7 @@ class Annotations():
         # list is necessary so that it does not remove in place
         for s in list(stages):
             stages.remove(s)
+        self._epoch_index.pop(self.rater, None)
 
         with open(filename, 'r') as f:
             domino_lines = f.readlines()
@@ -478,6 +484,7 @@ class Annotations():
         for e in list(events):
             if e.get('type') == name:
                 events.remove(e)
+                self._event_index.pop(e, None)
 
         self.save()
 
@@ -502,6 +509,7 @@ class Annotations():
         events = self.rater.find('events')
         pattern = "event_type[@type='" + name + "']"
         event_type = events.find(pattern)
+        self._event_index.pop(event_type, None)
 
         new_event = SubElement(event_type, 'event')
         event_start = SubElement(new_event, 'event_start')
@@ -534,8 +542,9 @@ class Annotations():
                 chan = ', '.join(chan)
 
         for e_type in list(events.iterfind(pattern)):
+            self._event_index.pop(e_type, None)
 
-            for e in e_type:
+            for e in list(e_type):
 
                 event_start = float(e.find('event_start').text)
                 event_end = float(e.find('event_end').text)
@@ -584,8 +593,14 @@ class Annotations():
         ------
         IndexError
             When there is no rater / epochs at all
+
+        Notes
+        -----
+        The events of each type are stored as columns sorted by start time
+        (see _event_columns), so the events in a time window, in one channel
+        or in some stages are selected with binary search and masks, without
+        reading the xml. Only the selected events are converted to dict.
         """
-        # get events inside window
         events = self.rater.find('events')
         if name is not None:
             pattern = "event_type[@type='" + name + "']"
@@ -596,77 +611,107 @@ class Annotations():
             if isinstance(chan, (tuple, list)):
                 chan = ', '.join(chan)
 
-        if stage or qual:
-            ep_starts = [x['start'] for x in self.epochs]
-            if stage:
-                ep_stages = [x['stage'] for x in self.epochs]
+        if stage is not None or qual:
+            ep_index = self._index_epochs()
+            ep_ok = ones(len(ep_index['start']), dtype=bool)
+            if stage is not None:
+                ep_ok &= asarray([x in stage for x in ep_index['stage']],
+                                 dtype=bool)
             if qual:
-                ep_quality = [x['quality'] for x in self.epochs]
+                ep_ok &= ep_index['quality'] == qual
 
         ev = []
         for e_type in events.iterfind(pattern):
 
             event_name = e_type.get('type')
+            index = self._index_events(e_type)
+            n_events = len(index['start'])
 
-            for e in e_type:
+            if time is None:
+                idx = arange(n_events)
+            else:
+                first = searchsorted(index['end_max'], time[0], side='left')
+                last = searchsorted(index['start'], time[1], side='right')
+                idx = arange(first, max(first, last))
+                idx = idx[index['end'][idx] >= time[0]]
+
+            if chan is not None:
+                if chan not in index['chan_name']:
+                    continue
+                idx = idx[index['chan'][idx] ==
+                          index['chan_name'].index(chan)]
+
+            if stage is not None or qual:
+                # last epoch which starts before (or with) the event
+                pos = searchsorted(ep_index['start'], index['start'][idx],
+                                   side='right') - 1
+                keep = ep_ok[pos]
+                idx = idx[keep]
+                pos = pos[keep]
+
+            # same order as in the xml file
+            in_xml = index['order'][idx].argsort()
+            for i in in_xml:
+                one_idx = idx[i]
+                one_ev = {'name': event_name,
+                          'start': float(index['start'][one_idx]),
+                          'end': float(index['end'][one_idx]),
+                          'chan': index['chan_name'][
+                              index['chan'][one_idx]].split(', '),
+                          'stage': '',
+                          'quality': index['quality'][one_idx]
+                          }
+                if stage is not None:
+                    one_ev['stage'] = ep_index['stage'][pos[i]]
+                ev.append(one_ev)
 
-                event_start = float(e.find('event_start').text)
-                event_end = float(e.find('event_end').text)
-                event_chan = e.find('event_chan').text
-                event_qual = e.find('event_qual').text
-                if event_chan is None:  # xml doesn't store empty string
-                    event_chan = ''
+        return ev
 
-                if stage or qual:
-                    pos = bisect_left(ep_starts, event_start)
-                    if event_start != ep_starts[pos]:
-                        pos -= 1
+    def _index_events(self, e_type):
+        """Return the columns of the events of one type (see _event_columns).
 
-                if stage is None:
-                    stage_cond = True
-                else:
-                    ev_stage = ep_stages[pos]
-                    stage_cond = ev_stage in stage
+        Parameters
+        ----------
+        e_type : instance of Element
+            xml element of one event type of one rater
 
-                if qual is None:
-                    qual_cond = True
-                else:
-                    ev_qual = ep_quality[pos]
-                    qual_cond = ev_qual == qual
-                """
-                if stage is None:
-                    stage_cond = True
-                else:
-                    if event_start == ep_starts[pos]:
-                        ev_stage = ep_stages[pos]
-                    else:
-                        ev_stage = ep_stages[pos - 1]
-                    stage_cond = ev_stage in stage
-                """
+        Returns
+        -------
+        dict
+            columns of the events (see _event_columns)
 
-                if time is None:
-                    time_cond = True
-                else:
-                    time_cond = time[0] <= event_end and time[1] >= event_start
+        Notes
+        -----
+        The columns are computed once and kept until one of the methods which
+        modifies the events of this type is called (or the number of events
+        changes), so repeated queries do not read the xml again. The xml
+        remains the reference, so the file which is saved is always up to
+        date.
+        """
+        index = self._event_index.get(e_type)
+        if index is None or index['n_events'] != len(e_type):
+            index = _event_columns(e_type)
+            self._event_index[e_type] = index
+        return index
 
-                if chan is None:
-                    chan_cond = True
-                else:
-                    chan_cond = event_chan == chan
+    def _index_epochs(self):
+        """Return the columns of the epochs of the current rater (see
+        _epoch_columns), computed once as for the events.
 
-                if time_cond and chan_cond and stage_cond and qual_cond:
-                    one_ev = {'name': event_name,
-                              'start': event_start,
-                              'end': event_end,
-                              'chan': event_chan.split(', '),  # always a list
-                              'stage': '',
-                              'quality': event_qual
-                              }
-                    if stage is not None:
-                        one_ev['stage'] = ev_stage
-                    ev.append(one_ev)
+        Raises
+        ------
+        IndexError
+            When there is no rater / epochs at all
+        """
+        if self.rater is None:
+            raise IndexError('You need to have at least one rater')
 
-        return ev
+        stages = self.rater.find('stages')
+        index = self._epoch_index.get(self.rater)
+        if index is None or index['n_epochs'] != len(stages):
+            index = _epoch_columns(stages)
+            self._epoch_index[self.rater] = index
+        return index
 
     def create_epochs(self, epoch_length=30, first_second=None):
         """Create epochs in annotation file.
@@ -684,6 +729,7 @@ class Annotations():
                         epoch_length) * epoch_length
 
         stages = self.rater.find('stages')
+        self._epoch_index.pop(self.rater, None)
         for epoch_beg in range(first_second, last_sec, epoch_length):
             epoch = SubElement(stages, 'epoch')
 
@@ -818,6 +864,7 @@ class Annotations():
         for one_epoch in self.rater.iterfind('stages/epoch'):
             if int(one_epoch.find('epoch_start').text) == epoch_start:
                 one_epoch.find(attr).text = name
+                self._epoch_index.pop(self.rater, None)
                 if save:
                     self.save()
                 return
@@ -1052,6 +1099,91 @@ class Annotations():
                         csv_file.writerow(info_row + data_row)
 
 
+def _event_columns(e_type):
+    """Read all the events of one type from the xml, as columns.
+
+    Parameters
+    ----------
+    e_type : instance of Element
+        xml element of one event type
+
+    Returns
+    -------
+    dict
+        'start', 'end' (sorted by start time), 'end_max' (the latest end of the
+        events up to each one, which increases monotonically, so that the
+        first event which ends after a time point can be found with binary
+        search), 'chan' (index of the channels in 'chan_name', with the
+        channels as they are stored in the xml), 'quality', 'order' (position
+        of each event in the xml) and 'n_events' (to check that the xml
+        was not modified).
+    """
+    start = []
+    end = []
+    chan = []
+    quality = []
+    for e in e_type:
+        start.append(float(e.findtext('event_start')))
+        end.append(float(e.findtext('event_end')))
+        chan.append(e.findtext('event_chan') or '')  # no empty string in xml
+        quality.append(e.findtext('event_qual'))
+
+    start = asarray(start, dtype=float)
+    end = asarray(end, dtype=float)
+    order = start.argsort(kind='mergesort')
+
+    chan_name = sorted(set(chan))
+    idx_chan = {label: i for i, label in enumerate(chan_name)}
+    chan = asarray([idx_chan[x] for x in chan], dtype=int)
+
+    quality = asarray(quality, dtype='O')
+
+    end = end[order]
+    if len(end):
+        end_max = maximum.accumulate(end)
+    else:
+        end_max = end
+
+    return {'n_events': len(order),
+            'order': order,
+            'start': start[order],
+            'end': end,
+            'end_max': end_max,
+            'chan': chan[order],
+            'chan_name': chan_name,
+            'quality': quality[order],
+            }
+
+
+def _epoch_columns(stages):
+    """Read all the epochs of one rater from the xml, as columns.
+
+    Parameters
+    ----------
+    stages : instance of Element
+        xml element with the epochs of one rater
+
+    Returns
+    -------
+    dict
+        'start' (start time of each epoch), 'stage', 'quality' and 'n_epochs'
+        (to check that the xml was not modified)
+    """
+    start = []
+    stage = []
+    quality = []
+    for one_epoch in stages.iterfind('epoch'):
+        start.append(int(one_epoch.findtext('epoch_start')))
+        stage.append(one_epoch.findtext('stage'))
+        quality.append(one_epoch.findtext('quality'))
+
+    return {'n_epochs': len(stages),
+            'start': asarray(start, dtype=float),
+            'stage': asarray(stage, dtype='O'),
+            'quality': asarray(quality, dtype='O'),
+            }
+
+
 def update_annotation_version(xml_file):
     """Update the fields that have changed over different versions.
 
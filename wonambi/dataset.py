@@ -336,3 +336,38 @@ class Dataset:
             data.data[i] = dat
 
         return data
+
+    def read_chunks(self, chan=None, duration=60, begsam=None, endsam=None):
+        """Read the data in consecutive chunks, to keep memory bounded.
+
+        Parameters
+        ----------
+        chan : list of strings
+            names of the channels to read
+        duration : float
+            duration of each chunk, in s (the last chunk might be shorter)
+        begsam : int
+            first sample (this sample will be included)
+        endsam : int
+            last sample (this sample will NOT be included)
+
+        Yields
+        ------
+        instance of ChanTime
+            data with one trial, for each chunk
+
+        Notes
+        -----
+        The chunks are contiguous and they do not overlap, so that you can
+        process the whole recording in one pass, without loading it all
+        into memory.
+        """
+        if begsam is None:
+            begsam = 0
+        if endsam is None:
+            endsam = self.header['n_samples']
+
+        n_smp = max(int(duration * self.header['s_freq']), 1)
+        for one_begsam in range(begsam, endsam, n_smp):
+            yield self.read_data(chan=chan, begsam=one_begsam,
+                                 endsam=min(one_begsam + n_smp, endsam))
@@ -1,5 +1,6 @@
 """Package to detect spindles, ripples, slow waves.
 """
-from .spindle import DetectSpindle, merge_close
+from .spindle import DetectSpindle
+from .merge import merge_close, merge_intervals
 from .ripple import DetectRipple
 from .slowwave import DetectSlowWave
@@ -0,0 +1,207 @@
+"""Module to merge events which are close in time, within channel, across
+channels or across event types.
+
+The events are sorted once and merged with one sweep over the sorted start
+and end times, so the computation time is O(n log n) in the number of
+events, instead of comparing the events with each other.
+"""
+from numpy import (arange, asarray, diff, empty, flatnonzero, float64,
+                   lexsort, maximum, ones, unique, zeros)
+
+
+def merge_intervals(start, end, min_interval=0, group=None):
+    """Merge intervals which overlap or are separated by less than a minimum
+    interval.
+
+    Parameters
+    ----------
+    start : ndarray
+        start time of each interval
+    end : ndarray
+        end time of each interval
+    min_interval : float
+        intervals separated by this value or less are merged
+    group : ndarray, optional
+        group of each interval (f.e. the channel): only the intervals in the
+        same group are merged. If None, all the intervals are merged together.
+
+    Returns
+    -------
+    ndarray (dtype='int')
+        index of the interval which is kept in each merged interval (the
+        longer one, see Notes)
+    ndarray
+        start time of each merged interval
+    ndarray
+        end time of each merged interval
+
+    Notes
+    -----
+    The merged intervals are sorted by start time (and by the order of the
+    input, if they start at the same time). This is the same as
+    walking through the intervals sorted by start time and comparing each one
+    with the merged interval before it: if they are close, the merged interval
+    is extended and it keeps the information of the longer of the two (the
+    current interval replaces the previous one only if it's longer than the
+    whole merged interval so far). Because the merged interval so far only
+    depends on the running maximum of the end times, all the comparisons are
+    done at once on the sorted arrays.
+    """
+    start = asarray(start, dtype=float64)
+    end = asarray(end, dtype=float64)
+    n_events = len(start)
+    if n_events == 0:
+        return zeros(0, dtype=int), start, end
+
+    if group is None:
+        codes = zeros(n_events, dtype=int)
+    else:
+        codes = unique(asarray(group), return_inverse=True)[1]
+
+    order = lexsort((start, codes))  # stable, so ties keep the input order
+    start = start[order]
+    end = end[order]
+    codes = codes[order]
+
+    # end of the previous intervals, separately for each group
+    first_in_group = ones(n_events, dtype=bool)
+    first_in_group[1:] = diff(codes) != 0
+    group_edges = flatnonzero(first_in_group).tolist() + [n_events]
+    prev_end = empty(n_events)
+    for beg, stop in zip(group_edges[:-1], group_edges[1:]):
+        prev_end[beg + 1:stop] = maximum.accumulate(end[beg:stop - 1])
+
+    is_first = first_in_group.copy()
+    in_group = ~first_in_group
+    is_first[in_group] = start[in_group] - prev_end[in_group] > min_interval
+    firsts = flatnonzero(is_first)
+    cluster = is_first.cumsum() - 1
+
+    new_start = start[firsts]
+    new_end = maximum.reduceat(end, firsts)
+
+    # the last interval longer than the merged interval before it
+    is_longer = is_first | (end - start > prev_end - new_start[cluster])
+    longer = arange(n_events)
+    longer[~is_longer] = -1
+    kept = maximum.reduceat(longer, firsts)
+
+    kept = order[kept]
+    by_start = lexsort((kept, new_start))  # ties in the input order
+    return kept[by_start], new_start[by_start], new_end[by_start]
+
+
+def merge_close(events, min_interval, by=None):
+    """Merge events that are separated by a less than a minimum interval.
+    When merging, longer event is extended and shorter one is discarded.
+
+    Parameters
+    ----------
+    events : list of dict
+        events with 'start' and 'end' times, from one or several channels (or
+        event types)
+    min_interval : float
+        minimum delay between consecutive events, in seconds
+    by : str or list of str, optional
+        only merge the events with the same value for these keys (f.e. 'chan'
+        to merge within channel). If None, events are merged across channels.
+
+    Returns
+    -------
+    list of dict
+        events with close events merged, sorted by start time. Note that in a
+        merger, info (chan, peak, etc.) from the longer of the 2 events is
+        kept.
+
+    Notes
+    -----
+    See merge_intervals for how the events are merged. The input events are
+    not modified: the merged events are copies, with the new start and end.
+    """
+    if not events:
+        return []
+
+    start = [ev['start'] for ev in events]
+    end = [ev['end'] for ev in events]
+    group = None
+    if by is not None:
+        if isinstance(by, str):
+            by = [by]
+        group = _group_codes(events, by)
+
+    kept, new_start, new_end = merge_intervals(start, end, min_interval,
+                                               group)
+
+    merged = []
+    for i, one_start, one_end in zip(kept, new_start, new_end):
+        one_event = dict(events[i])
+        one_event.update({'start': one_start, 'end': one_end})
+        merged.append(one_event)
+
+    return merged
+
+
+def merge_table(table, min_interval, by=None):
+    """Merge the close events in a table (as in Graphoelement.table).
+
+    Parameters
+    ----------
+    table : ndarray (structured array)
+        one row per event, with fields 'start' and 'end'
+    min_interval : float
+        minimum delay between consecutive events, in seconds
+    by : str, optional
+        only merge the events with the same value in this field (f.e. 'chan'
+        to merge within channel). If None, events are merged across channels.
+
+    Returns
+    -------
+    ndarray (structured array)
+        rows of the longer events, with the start and end of the merged
+        events, sorted by start time
+    """
+    if len(table) == 0:
+        return table
+
+    group = None
+    if by is not None:
+        group = table[by]
+
+    kept, new_start, new_end = merge_intervals(table['start'], table['end'],
+                                               min_interval, group)
+
+    merged = table[kept]
+    merged['start'] = new_start
+    merged['end'] = new_end
+    return merged
+
+
+def _group_codes(events, keys):
+    """Assign the same code to the events with the same values for some keys.
+
+    Parameters
+    ----------
+    events : list of dict
+        events
+    keys : list of str
+        keys of the events (the values can be lists, f.e. the channels in the
+        annotations)
+
+    Returns
+    -------
+    ndarray (dtype='int')
+        code of the group of each event
+    """
+    codes = {}
+    group = []
+    for one_event in events:
+        value = tuple(_hashable(one_event.get(k)) for k in keys)
+        group.append(codes.setdefault(value, len(codes)))
+
+    return asarray(group, dtype=int)
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return value
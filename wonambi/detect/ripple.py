@@ -1,29 +1,452 @@
+"""Module to detect ripples.
+
+"""
+from functools import lru_cache
 from logging import getLogger
+from math import floor
+
+from numpy import (asarray, concatenate, cumsum, diff, hstack, inf, maximum,
+                   minimum, sqrt, zeros)
+from scipy.ndimage import uniform_filter1d
+from scipy.signal import fftconvolve, firwin
 
+from .spindle import (_arg_reduce_in_segments, _detect_start_end,
+                      _reduce_in_segments, define_threshold, detect_per_chan,
+                      read_padded_chunks, select_segments, within_duration)
+from .stats import SignalStats
 from ..graphoelement import Ripple
+from ..trans.envelope import compute_moving
 
 lg = getLogger(__name__)
 
 
 class DetectRipple:
-    def __init__(self):
-        """Design ripple detection.
-        Ripples were detected as follows.
-        First, data were filtered between 80–100 Hz (two-pass FIR bandpass filter, order = 3 cycles of the low frequency cut-off),
-        and only artifact-free data from NREM sleep stages 2–4 were used for event detection.
-        Second, the r.m.s. signal was calculated for the filtered signal using
-        a moving average of 20 ms, and
-        the ripple amplitude criterion was defined as the 99% percentile of
-        RMS values. Third, whenever the signal exceeded this threshold
-        for a minimum of 38 ms (encompassing ~3 cycles at 80 Hz) a ripple event
-        was detected. In addition, we required at least three discrete peaks or
-        three discrete troughs to occur in the raw signal segment corresponding
-        to the above-threshold RMS segment. This was accomplished by identifying
-        local maxima or minima in the respective raw signal segments after
-        applying a one-pass moving average filter including the two adjacent
-        data points.
+    """Design ripple detection on a single channel.
+
+    Parameters
+    ----------
+    method : str
+        one of the predefined methods ('Staresina2015')
+    frequency : tuple of float
+        low and high frequency of ripple band
+    duration : tuple of float
+        min and max duration of ripples (by default, there is no maximum)
+
+    Notes
+    -----
+    Staresina2015: ripples were detected as follows. First, data were filtered
+    between 80–100 Hz (two-pass FIR bandpass filter, order = 3 cycles of the
+    low frequency cut-off), and only artifact-free data from NREM sleep stages
+    2–4 were used for event detection. Second, the r.m.s. signal was
+    calculated for the filtered signal using a moving average of 20 ms, and
+    the ripple amplitude criterion was defined as the 99% percentile of RMS
+    values. Third, whenever the signal exceeded this threshold for a minimum
+    of 38 ms (encompassing ~3 cycles at 80 Hz) a ripple event was detected.
+    In addition, we required at least three discrete peaks or three discrete
+    troughs to occur in the raw signal segment corresponding to the
+    above-threshold RMS segment. This was accomplished by identifying local
+    maxima or minima in the respective raw signal segments after applying a
+    one-pass moving average filter including the two adjacent data points.
+
+    To analyze only NREM sleep without artifacts, use detect_dataset with the
+    annotations (stage and reject_bad).
+
+    References
+    ----------
+    Staresina, B. P. et al. Nat Neurosci 18(11) 1679-86 (2015).
+    """
+    def __init__(self, method='Staresina2015', frequency=None, duration=None):
+
+        if frequency is None:
+            frequency = (80, 100)
+        if duration is None:
+            duration = (0.038, inf)
+
+        self.method = method
+        self.frequency = frequency
+        self.duration = duration
+
+        if method == 'Staresina2015':
+            self.det_fir = {'freq': self.frequency,
+                            'cycles': 3,
+                            }
+            self.moving_rms = {'dur': .02}
+            self.det_thresh = 99  # percentile
+            self.smooth = {'n_smp': 3}
+            self.min_peaks = 3
+
+        else:
+            raise ValueError('Unknown method')
+
+    def __repr__(self):
+        return ('detrip_{0}_{1:02}-{2:02}Hz_{3:05.3f}-{4:05.3f}s'
+                ''.format(self.method, self.frequency[0], self.frequency[1],
+                          self.duration[0], self.duration[1]))
+
+    def __call__(self, data, n_jobs=1):
+        """Detect ripples on the data.
+
+        Parameters
+        ----------
+        data : instance of Data
+            data used for detection
+        n_jobs : int
+            number of processes to run the detection on the channels in
+            parallel (the results are identical to n_jobs=1)
+
+        Returns
+        -------
+        instance of graphoelement.Ripple
+            description of the detected ripples
         """
-        pass
+        if self.method != 'Staresina2015':
+            raise ValueError('Unknown method')
+
+        ripple = Ripple()
+        ripple.chan_name = data.axis['chan'][0]
+        ripple.det_value = zeros(data.number_of('chan')[0])
+        ripple.density = zeros(data.number_of('chan')[0])
+
+        all_ripples = []
+        results = detect_per_chan(detect_Staresina2015, data, self, n_jobs)
+        for i, (chan, result) in enumerate(zip(data.axis['chan'][0],
+                                               results)):
+            rip_in_chan, values, density = result
+
+            ripple.det_value[i] = values['det_value']
+            ripple.density[i] = density
+
+            for rip in rip_in_chan:
+                rip.update({'chan': chan})
+            all_ripples.extend(rip_in_chan)
+
+        ripple.events = sorted(all_ripples, key=lambda x: x['start'])
+
+        return ripple
+
+    def detect_dataset(self, dataset, chan, annot=None, stage=None,
+                       reject_bad=True, chunk=300, pad=1):
+        """Detect ripples on a whole recording, reading it in chunks.
+
+        Parameters
+        ----------
+        dataset : instance of Dataset
+            recording to analyze
+        chan : list of str
+            channels to analyze
+        annot : instance of Annotations, optional
+            if specified, only the epochs of interest are analyzed
+        stage : list of str, optional
+            stages of interest (only if annot is specified). If None, all the
+            epochs.
+        reject_bad : bool
+            do not analyze the epochs whose quality is 'Bad'
+        chunk : float
+            duration in s of the data analyzed at once
+        pad : float
+            duration in s of the data read before and after each chunk, so
+            that the filters are not affected by the edges of the chunk
+
+        Returns
+        -------
+        instance of graphoelement.Ripple
+            description of the detected ripples
+
+        Notes
+        -----
+        The recording is read twice. In the first pass, the 99th percentile
+        of the RMS is estimated on all the samples of interest, for each
+        channel (see SignalStats, it's within 0.1% of the exact percentile).
+        In the second pass, the ripples are detected on each chunk with that
+        threshold. Only the ripples which start in the chunk (not in the
+        padding) are kept, so that they are not counted twice.
+        """
+        if self.method != 'Staresina2015':
+            raise ValueError('Unknown method')
+
+        chan = list(chan)
+        s_freq = dataset.header['s_freq']
+        segments = select_segments(dataset, annot, stage, reject_bad)
+
+        stats = [{'det': SignalStats()} for _ in chan]
+        for dat, time, core in read_padded_chunks(dataset, chan, segments,
+                                                  chunk, pad):
+            for i in range(len(chan)):
+                dat_det = ripple_signals(dat[i], s_freq, self)[0]
+                stats[i]['det'].update(dat_det[core])
+
+        ripple = Ripple()
+        ripple.chan_name = asarray(chan, dtype='U')
+        ripple.det_value = zeros(len(chan))
+        ripple.density = zeros(len(chan))
+
+        all_ripples = []
+        n_smp = 0
+        for dat, time, core in read_padded_chunks(dataset, chan, segments,
+                                                  chunk, pad):
+            t_beg = time[core.start]
+            t_end = time[core.stop - 1] + 1 / s_freq
+            n_smp += core.stop - core.start
+
+            for i, one_chan in enumerate(chan):
+                rip_in_chan, values, _ = detect_Staresina2015(
+                    dat[i], s_freq, time, self, stats=stats[i])
+                ripple.det_value[i] = values['det_value']
+
+                for rip in rip_in_chan:
+                    if t_beg <= rip['start'] < t_end:
+                        rip.update({'chan': one_chan})
+                        all_ripples.append(rip)
+                        ripple.density[i] += 1
+
+        if n_smp:
+            ripple.density *= s_freq * 30 / n_smp
+
+        ripple.events = sorted(all_ripples, key=lambda x: x['start'])
+
+        return ripple
+
+
+def detect_Staresina2015(dat_orig, s_freq, time, opts, stats=None):
+    """Ripple detection based on Staresina et al. 2015.
+
+    Parameters
+    ----------
+    dat_orig : ndarray (dtype='float')
+        vector with the data for one channel
+    s_freq : float
+        sampling frequency
+    time : ndarray (dtype='float')
+        vector with the time points for each sample
+    opts : instance of 'DetectRipple'
+        'det_fir' : dict
+            parameters for the FIR filter ('freq', 'cycles')
+        'moving_rms' : dict
+            parameters for the moving RMS ('dur')
+        'det_thresh' : float
+            percentile of the RMS used as threshold
+        'smooth' : dict
+            length of the moving average on the raw signal ('n_smp')
+        'min_peaks' : int
+            min number of peaks (or troughs) in the raw signal
+        'duration' : tuple of float
+            min and max duration of ripples
+    stats : dict, optional
+        statistics to compute the threshold, with key 'det', passed to
+        define_threshold. If None, they are computed on the RMS of this data
+        (see detect_dataset).
+
+    Returns
+    -------
+    list of dict
+        list of detected ripples
+    dict
+        'det_value' with detection value
+    float
+        ripple density, per 30-s epoch
+
+    References
+    ----------
+    Staresina, B. P. et al. Nat Neurosci 18(11) 1679-86 (2015).
+    """
+    dat_det, dat_filt = ripple_signals(dat_orig, s_freq, opts)
+    if stats is None:
+        stats = {'det': dat_det}
+
+    det_value = define_threshold(stats['det'], s_freq, 'percentile',
+                                 opts.det_thresh)
+
+    events = _detect_start_end(dat_det >= det_value)
+
+    rip_in_chan = []
+    if events is not None:
+        events = hstack((events[:, :1], events))  # start, peak, end
+        events = within_duration(events, time, opts.duration)
+
+        n_peaks, n_troughs = count_peaks(events, dat_orig,
+                                         opts.smooth['n_smp'])
+        good = (n_peaks >= opts.min_peaks) | (n_troughs >= opts.min_peaks)
+        events = events[good, :]
+
+        if len(events):
+            events[:, 1] = _arg_reduce_in_segments(maximum, dat_det,
+                                                   events[:, 0], events[:, 2])
+            rip_in_chan = make_ripples(events, n_peaks[good], dat_det,
+                                       dat_filt, dat_orig, time, s_freq)
+
+    if not rip_in_chan:
+        lg.info('No ripple found')
+
+    values = {'det_value': det_value}
+
+    density = len(rip_in_chan) * s_freq * 30 / len(dat_orig)
+
+    return rip_in_chan, values, density
+
+
+def ripple_signals(dat_orig, s_freq, opts):
+    """Compute the signal used to detect ripples.
+
+    Parameters
+    ----------
+    dat_orig : ndarray (dtype='float')
+        vector with the data for one channel
+    s_freq : float
+        sampling frequency
+    opts : instance of 'DetectRipple'
+        options of the detection
+
+    Returns
+    -------
+    ndarray (dtype='float')
+        RMS of the filtered data, used for detection
+    ndarray (dtype='float')
+        data after bandpass filtering
+    """
+    h = design_ripple_filter(tuple(opts.det_fir['freq']),
+                             opts.det_fir['cycles'], s_freq)
+    dat_filt = fftconvolve(dat_orig, h, mode='same')
+
+    halfwidth = int(floor(s_freq * opts.moving_rms['dur'] / 2))
+    dat_det = compute_moving(dat_filt, halfwidth, method='rms')
+
+    return dat_det, dat_filt
+
+
+@lru_cache(maxsize=32)
+def design_ripple_filter(freq, cycles, s_freq):
+    """Design the two-pass FIR bandpass filter and keep it in memory.
+
+    Parameters
+    ----------
+    freq : tuple of float
+        low and high cutoff, in Hz
+    cycles : float
+        filter order, in cycles of the low cutoff
+    s_freq : float
+        sampling frequency
+
+    Returns
+    -------
+    ndarray
+        impulse response of the filter applied forward and backward (it's
+        symmetric, so it has zero phase). It's shared between calls, so it's
+        read-only.
+
+    Notes
+    -----
+    Applying the FIR filter forward and then backward (as filtfilt) is the
+    same as convolving once with the filter convolved with its time-reversed
+    copy, which can be done with one FFT convolution, independent of the
+    filter order. The filter is only affected by the edges of the data, so use
+    some padding if you analyze the data in chunks.
+    """
+    order = int(cycles * s_freq / freq[0])
+    b = firwin(order + 1, freq, pass_zero=False, fs=s_freq)
+    h = fftconvolve(b, b[::-1])
+    h.setflags(write=False)
+    return h
+
+
+def count_peaks(events, dat, n_smp=3):
+    """Count the local maxima and minima of the smoothed data in each event.
+
+    Parameters
+    ----------
+    events : ndarray (dtype='int')
+        N x 3 matrix with start, peak, end samples
+    dat : ndarray (dtype='float')
+        vector with the raw data
+    n_smp : int
+        number of samples of the moving average applied to the data (3 means
+        the sample with the two adjacent samples)
+
+    Returns
+    -------
+    ndarray (dtype='int')
+        number of local maxima in each event
+    ndarray (dtype='int')
+        number of local minima in each event
+
+    Notes
+    -----
+    The local extrema are computed once on the whole signal and their
+    cumulative sum is used to count them in all the events at once.
+    """
+    dat = uniform_filter1d(dat, n_smp, mode='nearest')
+    slope = diff(dat)
+    is_max = (slope[:-1] > 0) & (slope[1:] <= 0)
+    is_min = (slope[:-1] < 0) & (slope[1:] >= 0)
+
+    # number of maxima (minima) before each sample, the first sample is never
+    # an extremum
+    n_max = concatenate(([0, 0], cumsum(is_max), [is_max.sum()]))
+    n_min = concatenate(([0, 0], cumsum(is_min), [is_min.sum()]))
+
+    return (n_max[events[:, 2]] - n_max[events[:, 0]],
+            n_min[events[:, 2]] - n_min[events[:, 0]])
+
+
+def make_ripples(events, n_peaks, dat_det, dat_filt, dat_orig, time, s_freq):
+    """Create dict for each ripple, based on events of time points.
+
+    Parameters
+    ----------
+    events : ndarray (dtype='int')
+        N x 3 matrix with start, peak, end samples
+    n_peaks : ndarray (dtype='int')
+        number of peaks in the raw data for each event
+    dat_det : ndarray (dtype='float')
+        vector with the RMS of the filtered data (to compute peak)
+    dat_filt : ndarray (dtype='float')
+        vector with the filtered data
+    dat_orig : ndarray (dtype='float')
+        vector with the raw data on which detection was performed
+    time : ndarray (dtype='float')
+        vector with time points
+    s_freq : float
+        sampling frequency
+
+    Returns
+    -------
+    list of dict
+        list of all the ripples, with information about start, end,
+        peak_time (s), peak_val (RMS), peak_val_orig (signal units), dur (s),
+        rms and ptp of the raw data and of the filtered data (signal units),
+        n_peaks (number of peaks in the smoothed raw data).
+    """
+    beg, peak, end = events[:, 0], events[:, 1], events[:, 2]
+    n_smp = end - beg
+    dur = n_smp / s_freq
+
+    rms_orig = _rms_in_events(events, dat_orig)
+    rms_filt = _rms_in_events(events, dat_filt)
+    ptp_orig = (_reduce_in_segments(maximum, dat_orig, beg, end) -
+                _reduce_in_segments(minimum, dat_orig, beg, end))
+    ptp_filt = (_reduce_in_segments(maximum, dat_filt, beg, end) -
+                _reduce_in_segments(minimum, dat_filt, beg, end))
+
+    ripples = []
+    for i in range(events.shape[0]):
+        one_ripple = {'start': time[beg[i]],
+                      'end': time[end[i] - 1],
+                      'peak_time': time[peak[i]],
+                      'peak_val': dat_det[peak[i]],
+                      'peak_val_orig': dat_orig[peak[i]],
+                      'dur': dur[i],
+                      'rms': rms_orig[i],
+                      'rms_filt': rms_filt[i],
+                      'ptp': ptp_orig[i],
+                      'ptp_filt': ptp_filt[i],
+                      'n_peaks': int(n_peaks[i]),
+                      }
+        ripples.append(one_ripple)
+
+    return ripples
+
 
-    def __call__(self, data):
-        return Ripple()
+def _rms_in_events(events, dat):
+    """Compute the RMS of the data in each event, with the cumulative sum."""
+    csum = concatenate(([0], cumsum(dat.astype('float64') ** 2)))
+    return sqrt((csum[events[:, 2]] - csum[events[:, 0]]) /
+                (events[:, 2] - events[:, 0]))
@@ -2,9 +2,11 @@
 
 """
 from logging import getLogger
-from numpy import argmax, concatenate, hstack, sum, zeros, median, mean
+from numpy import argmax, asarray, concatenate, searchsorted, sum, zeros
 
-from .spindle import detect_events, transform_signal, within_duration
+from .spindle import (_detect_start_end, detect_events, detect_per_chan,
+                      read_padded_chunks, select_segments, transform_signal,
+                      within_duration)
 from ..graphoelement import SlowWaves
 
 lg = getLogger(__name__)
@@ -52,35 +54,31 @@ class DetectSlowWave:
         return ('detsw_{0}_{1:04.2f}-{2:04.2f}Hz_{3:04.2f}-{4:04.2f}s'
                 ''.format(self.method, *self.det_butter['freq'], *self.duration))
 
-    def __call__(self, data):
+    def __call__(self, data, n_jobs=1):
         """Detect slow waves on the data.
 
         Parameters
         ----------
         data : instance of Data
             data used for detection
+        n_jobs : int
+            number of processes to run the detection on the channels in
+            parallel (the results are identical to n_jobs=1)
 
         Returns
         -------
         instance of graphoelement.SlowWaves
             description of the detected SWs
         """
+        if 'Massimini2004' not in self.method:
+            raise ValueError('Unknown method')
+
         slowwave = SlowWaves()
         slowwave.chan_name = data.axis['chan'][0]
 
         all_slowwaves = []
-        for i, chan in enumerate(data.axis['chan'][0]):
-            lg.info('Detecting slow waves on chan %s', chan)
-            time = hstack(data.axis['time'])
-            dat_orig = hstack(data(chan=chan))
-
-            if 'Massimini2004' in self.method:
-                sw_in_chan = detect_Massimini2004(
-                        dat_orig, data.s_freq, time, self)
-
-            else:
-                raise ValueError('Unknown method')
-
+        results = detect_per_chan(detect_Massimini2004, data, self, n_jobs)
+        for chan, sw_in_chan in zip(data.axis['chan'][0], results):
             for sw in sw_in_chan:
                 sw.update({'chan': chan})
             all_slowwaves.extend(sw_in_chan)
@@ -91,6 +89,69 @@ class DetectSlowWave:
 
         return slowwave
 
+    def detect_dataset(self, dataset, chan, annot=None, stage=None,
+                       reject_bad=True, chunk=300, pad=10):
+        """Detect slow waves on a whole recording, reading it in chunks.
+
+        Parameters
+        ----------
+        dataset : instance of Dataset
+            recording to analyze
+        chan : list of str
+            channels to analyze
+        annot : instance of Annotations, optional
+            if specified, only the epochs of interest are analyzed
+        stage : list of str, optional
+            stages of interest (only if annot is specified). If None, all the
+            epochs.
+        reject_bad : bool
+            do not analyze the epochs whose quality is 'Bad'
+        chunk : float
+            duration in s of the data analyzed at once
+        pad : float
+            duration in s of the data read before and after each chunk, so
+            that the filters are not affected by the edges of the chunk
+
+        Returns
+        -------
+        instance of graphoelement.SlowWaves
+            description of the detected SWs
+
+        Notes
+        -----
+        The thresholds of Massimini2004 are absolute, so the recording is read
+        only once. Only the slow waves which start in the chunk (not in the
+        padding) are kept, so that they are not counted twice.
+        """
+        if 'Massimini2004' not in self.method:
+            raise ValueError('Unknown method')
+
+        chan = list(chan)
+        s_freq = dataset.header['s_freq']
+        segments = select_segments(dataset, annot, stage, reject_bad)
+
+        slowwave = SlowWaves()
+        slowwave.chan_name = asarray(chan, dtype='U')
+
+        all_slowwaves = []
+        for dat, time, core in read_padded_chunks(dataset, chan, segments,
+                                                  chunk, pad):
+            t_beg = time[core.start]
+            t_end = time[core.stop - 1] + 1 / s_freq
+
+            for i, one_chan in enumerate(chan):
+                sw_in_chan = detect_Massimini2004(dat[i], s_freq, time, self)
+                for sw in sw_in_chan:
+                    if t_beg <= sw['start'] < t_end:
+                        sw.update({'chan': one_chan})
+                        all_slowwaves.append(sw)
+
+        lg.info('number of SW: ' + str(len(all_slowwaves)))
+        slowwave.events = sorted(all_slowwaves, key=lambda x: x['start'])
+
+        return slowwave
+
+
 def detect_Massimini2004(dat_orig, s_freq, time, opts):
     """Slow wave detection based on Massimini et al., 2004.
 
@@ -125,28 +186,24 @@ def detect_Massimini2004(dat_orig, s_freq, time, opts):
 
     """
     lg.info('detection raw dat: ' + str(len(dat_orig)))
-    lg.info('mean: ' + str(mean(dat_orig)) +' median: ' + str(median(dat_orig)))
     dat_det = transform_signal(dat_orig, s_freq, 'butter', opts.det_butter)
-    lg.info('det filtered data: ' + str(len(dat_det)))
-    lg.info('mean: ' + str(mean(dat_det)) +' median: ' + str(median(dat_det)))
     below_zero = detect_events(dat_det, 'below_thresh', value=0.)
 
     sw_in_chan = []
     if below_zero is not None:
         troughs = within_duration(below_zero, time, opts.trough_duration)
+        troughs = select_peaks(dat_det, troughs, opts.max_trough_amp)
 
-        if troughs is not None:
-            troughs = select_peaks(dat_det, troughs, opts.max_trough_amp)
-
-            if troughs is not None:
-                events = _add_pos_halfwave(dat_det, troughs, s_freq, opts)
+        if len(troughs):
+            events = _add_pos_halfwave(dat_det, troughs, s_freq, opts,
+                                       below_zero[:, 0])
 
-                if len(events):
-                    events = within_duration(events, time, opts.duration)
+            if len(events):
+                events = within_duration(events, time, opts.duration)
 
-                    sw_in_chan = make_slow_waves(events, dat_det, time, s_freq)
+                sw_in_chan = make_slow_waves(events, dat_det, time, s_freq)
 
-    if len(sw_in_chan) == 1:
+    if len(sw_in_chan) == 0:
         lg.info('No slow wave found')
 
     return sw_in_chan
@@ -215,7 +272,7 @@ def make_slow_waves(events, data, time, s_freq):
     return slow_waves
 
 
-def _add_pos_halfwave(data, events, s_freq, opts):
+def _add_pos_halfwave(data, events, s_freq, opts, neg_starts=None):
     """Find the next zero crossing and the intervening positive peak and add
     them to events. If no zero found before max_dur, event is discarded. If
     peak-to-peak is smaller than min_ptp, the event is discarded.
@@ -225,7 +282,7 @@ def _add_pos_halfwave(data, events, s_freq, opts):
     data : ndarray (dtype='float')
         vector with the data
     events : ndarray (dtype='int')
-        N x 3 matrix with start, peak, end samples    
+        N x 3 matrix with start, peak, end samples
     s_freq : float
         sampling frequency
     opts : instance of 'DetectSlowWave'
@@ -233,12 +290,20 @@ def _add_pos_halfwave(data, events, s_freq, opts):
             min and max duration of SW
         'min_ptp' : float
             min peak-to-peak amplitude
+    neg_starts : ndarray (dtype='int'), optional
+        first sample of each period below zero, in the whole data. If None,
+        it's computed from the data.
 
     Returns
     -------
     ndarray (dtype='int')
         N x 5 matrix with start, trough, - to + zero crossing, peak, and end
         samples
+
+    Notes
+    -----
+    The end of the positive half-wave is found for all the events at once (see
+    _find_next_negative), so the data is not scanned again for each event.
     """
     max_dur = opts.duration[1]
 
@@ -248,11 +313,10 @@ def _add_pos_halfwave(data, events, s_freq, opts):
 
     peak_and_end = zeros((events.shape[0], 2), dtype='int')
     events = concatenate((events, peak_and_end), axis=1)
+    events[:, 4] = _find_next_negative(data, events, window, neg_starts)
     selected = []
 
     for ev in events:
-        ev[4] = ev[2] + argmax(data[ev[2]:ev[0] + window] < 0) # quickest way
-
         if ev[2] == ev[4]:
             selected.append(False)
             continue
@@ -266,3 +330,47 @@ def _add_pos_halfwave(data, events, s_freq, opts):
         selected.append(True)
 
     return events[selected, :]
+
+
+def _find_next_negative(data, events, window, neg_starts=None):
+    """Find the first sample below zero after the - to + zero crossing of
+    each event.
+
+    Parameters
+    ----------
+    data : ndarray (dtype='float')
+        vector with the data
+    events : ndarray (dtype='int')
+        N x 3+ matrix with start, peak, end (the - to + zero crossing) samples
+    window : int
+        the sample below zero should come before start + window
+    neg_starts : ndarray (dtype='int'), optional
+        first sample of each period below zero, in the whole data. If None,
+        it's computed from the data.
+
+    Returns
+    -------
+    ndarray (dtype='int')
+        first sample below zero after each event, or the zero crossing itself
+        if there is none before start + window
+
+    Notes
+    -----
+    The samples below zero after a zero crossing are the starts of the
+    following negative periods, so they are found for all the events at once
+    with searchsorted on the sorted starts.
+    """
+    if neg_starts is None:
+        neg_starts = _detect_start_end(data < 0)
+        if neg_starts is None:
+            neg_starts = zeros(0, dtype=int)
+        else:
+            neg_starts = neg_starts[:, 0]
+
+    ends = events[:, 2].copy()
+    idx = searchsorted(neg_starts, ends)
+    found = idx < len(neg_starts)
+    found[found] = neg_starts[idx[found]] < events[found, 0] + window
+    ends[found] = neg_starts[idx[found]]
+
+    return ends
@@ -1,19 +1,40 @@
 """Module to detect spindles.
 """
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
 from logging import getLogger
-from numpy import (absolute, arange, argmax, asarray, concatenate, cos, diff,
-                   exp, empty, floor, hstack, insert, invert, linspace,
-                   mean, median, nan, ones, pi, ptp, sqrt, square,
-                   std, vstack, where, zeros)
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from numpy import (absolute, arange, argmax, asarray, ascontiguousarray,
+                   concatenate, cos, cumsum, diff, exp, empty, flatnonzero,
+                   floor, hstack, insert, invert, isnan, linspace, maximum,
+                   mean, median, memmap, moveaxis, nan, ndarray, ones,
+                   percentile, pi, ptp, repeat, searchsorted, sqrt, square,
+                   std, unique, vstack, where, zeros)
 from scipy.ndimage.filters import gaussian_filter
 from scipy.signal import (argrelmax, butter, cheby2, filtfilt, fftconvolve,
                           hilbert, periodogram, tukey)
 
 from ..graphoelement import Spindles
+from ..trans.envelope import compute_moving
+from .merge import merge_table
+from .stats import SignalStats
 
 lg = getLogger(__name__)
 MAX_FREQUENCY_OF_INTEREST = 50
 MAX_DURATION = 5
+CACHE_BYTES = 512 * 2 ** 20
+
+# options of DetectSpindle used by detection_signals, for each method
+TRANSFORM_OPTIONS = {'Ferrarelli2007': ('det_butter', ),
+                     'Nir2011': ('det_butter', 'smooth'),
+                     'Moelle2011': ('det_butter', 'moving_rms', 'smooth'),
+                     'Wamsley2012': ('det_wavelet', 'smooth'),
+                     'UCSD': ('det_wavelet', 'sel_wavelet'),
+                     }
 
 
 class DetectSpindle:
@@ -113,19 +134,25 @@ class DetectSpindle:
                 ''.format(self.method, self.frequency[0], self.frequency[1],
                           self.duration[0], self.duration[1]))
 
-    def __call__(self, data):
+    def __call__(self, data, n_jobs=1):
         """Detect spindles on the data.
 
         Parameters
         ----------
         data : instance of Data
             data used for detection
+        n_jobs : int
+            number of processes to run the detection on the channels in
+            parallel (the results are identical to n_jobs=1)
 
         Returns
         -------
         instance of graphoelement.Spindles
             description of the detected spindles
         """
+        if self.method not in DETECT_METHODS:
+            raise ValueError('Unknown method')
+
         spindle = Spindles()
         spindle.chan_name = data.axis['chan'][0]
         spindle.det_value = zeros(data.number_of('chan')[0])
@@ -133,36 +160,11 @@ class DetectSpindle:
         spindle.density = zeros(data.number_of('chan')[0])
 
         all_spindles = []
-        for i, chan in enumerate(data.axis['chan'][0]):
-            lg.info('Detecting spindles on chan %s', chan)
-            time = hstack(data.axis['time'])
-            dat_orig = hstack(data(chan=chan))
-
-            if self.method == 'Ferrarelli2007':
-                sp_in_chan, values, density = detect_Ferrarelli2007(dat_orig,
-                                                                    data.s_freq, time,
-                                                                    self)
-
-            elif self.method == 'Nir2011':
-                sp_in_chan, values, density = detect_Nir2011(dat_orig,
-                                                             data.s_freq,
-                                                             time, self)
-
-            elif self.method == 'Wamsley2012':
-                sp_in_chan, values, density = detect_Wamsley2012(dat_orig,
-                                                                 data.s_freq,
-                                                                 time, self)
-
-            elif self.method == 'UCSD':
-                sp_in_chan, values, density = detect_UCSD(dat_orig,
-                                                          data.s_freq, time,
-                                                          self)
-            elif self.method == 'Moelle2011':
-                sp_in_chan, values, density = detect_Moelle2011(dat_orig,
-                                                                data.s_freq,
-                                                                time, self)
-            else:
-                raise ValueError('Unknown method')
+        results = detect_per_chan(DETECT_METHODS[self.method], data, self,
+                                  n_jobs)
+        for i, (chan, result) in enumerate(zip(data.axis['chan'][0],
+                                               results)):
+            sp_in_chan, values, density = result
 
             spindle.det_value[i] = values['det_value']
             spindle.sel_value[i] = values['sel_value']
@@ -177,12 +179,285 @@ class DetectSpindle:
         spindle.events = sorted(all_spindles, key=lambda x: x['start'])
 
         if self.merge and len(data.axis['chan'][0]) > 1:
-            spindle.events = merge_close(spindle.events, self.min_interval)
+            spindle.table = merge_table(spindle.table, self.min_interval)
+
+        return spindle
+
+    def detect_dataset(self, dataset, chan, annot=None, stage=None,
+                       reject_bad=True, chunk=300, pad=10):
+        """Detect spindles on a whole recording, reading it in chunks.
+
+        Parameters
+        ----------
+        dataset : instance of Dataset
+            recording to analyze
+        chan : list of str
+            channels to analyze
+        annot : instance of Annotations, optional
+            if specified, only the epochs of interest are analyzed
+        stage : list of str, optional
+            stages of interest (only if annot is specified). If None, all the
+            epochs.
+        reject_bad : bool
+            do not analyze the epochs whose quality is 'Bad'
+        chunk : float
+            duration in s of the data analyzed at once
+        pad : float
+            duration in s of the data read before and after each chunk, so
+            that the filters are not affected by the edges of the chunk
+
+        Returns
+        -------
+        instance of graphoelement.Spindles
+            description of the detected spindles
+
+        Notes
+        -----
+        The recording is read twice. In the first pass, the statistics of the
+        detection signal (mean, standard deviation and median) are computed on
+        all the samples of interest, for each channel (see SignalStats). In
+        the second pass, the spindles are detected on each chunk with the
+        thresholds based on those statistics, so the thresholds are the same
+        as if the whole recording was analyzed at once (for the methods based
+        on the median, such as UCSD, within 0.1%). Only the spindles which
+        start in the chunk (not in the padding) are kept, so that spindles
+        close to the edges of the chunks are not counted twice. Memory
+        depends on the chunk size, not on the duration of the recording.
+        """
+        if self.method not in DETECT_METHODS:
+            raise ValueError('Unknown method')
+
+        chan = list(chan)
+        s_freq = dataset.header['s_freq']
+        segments = select_segments(dataset, annot, stage, reject_bad)
+
+        stats = [{'det': SignalStats(), 'sel': SignalStats()} for _ in chan]
+        for dat, time, core in read_padded_chunks(dataset, chan, segments,
+                                                  chunk, pad):
+            for i in range(len(chan)):
+                dat_det, dat_sel = detection_signals(dat[i], s_freq, self)
+                stats[i]['det'].update(dat_det[core])
+                if dat_sel is not None:
+                    stats[i]['sel'].update(dat_sel[core])
+
+        spindle = Spindles()
+        spindle.chan_name = asarray(chan, dtype='U')
+        spindle.det_value = zeros(len(chan))
+        spindle.sel_value = zeros(len(chan))
+        spindle.density = zeros(len(chan))
+
+        all_spindles = []
+        n_smp = 0
+        for dat, time, core in read_padded_chunks(dataset, chan, segments,
+                                                  chunk, pad):
+            t_beg = time[core.start]
+            t_end = time[core.stop - 1] + 1 / s_freq
+            n_smp += core.stop - core.start
+
+            for i, one_chan in enumerate(chan):
+                sp_in_chan, values, _ = DETECT_METHODS[self.method](
+                    dat[i], s_freq, time, self, stats=stats[i])
+                spindle.det_value[i] = values['det_value']
+                spindle.sel_value[i] = values['sel_value']
+
+                for sp in sp_in_chan:
+                    if t_beg <= sp['start'] < t_end:
+                        sp.update({'chan': one_chan})
+                        all_spindles.append(sp)
+                        spindle.density[i] += 1
+
+        if n_smp:
+            spindle.density *= s_freq * 30 / n_smp
+
+        spindle.events = sorted(all_spindles, key=lambda x: x['start'])
+
+        if self.merge and len(chan) > 1:
+            spindle.table = merge_table(spindle.table, self.min_interval)
 
         return spindle
 
 
-def detect_Ferrarelli2007(dat_orig, s_freq, time, opts):
+def detect_per_chan(detect_func, data, opts, n_jobs=1):
+    """Run a detection function on each channel, optionally in parallel.
+
+    Parameters
+    ----------
+    detect_func : function
+        function with arguments (dat_orig, s_freq, time, opts), defined at the
+        module level (so that it can be sent to another process)
+    data : instance of Data
+        data used for detection (the trials are concatenated)
+    opts : instance of DetectSpindle, DetectSlowWave or DetectRipple
+        options passed to detect_func
+    n_jobs : int
+        number of processes
+
+    Returns
+    -------
+    list
+        output of detect_func for each channel, in the order of the channels
+
+    Notes
+    -----
+    With more than one process, the data is written once to a temporary
+    memory-mapped file, which all the processes read (without copying the
+    whole recording to each process). The results are collected in the order
+    of the channels, so they are identical to running them one at the time.
+    """
+    chan_name = list(data.axis['chan'][0])
+    time = hstack(data.axis['time'])
+    idx_chan = data.index_of('chan')
+    idx_time = data.index_of('time')
+
+    if n_jobs == 1:
+        results = []
+        for chan in chan_name:
+            lg.info('Running %s on chan %s', detect_func.__name__, chan)
+            dat_orig = hstack([x.take(_index_of_chan(data, trl, [chan])[0],
+                                      axis=idx_chan)
+                               for trl, x in enumerate(data.data)])
+            results.append(detect_func(dat_orig, data.s_freq, time, opts))
+        return results
+
+    tmpdir = mkdtemp()
+    try:
+        dat_file = join(tmpdir, 'dat.dat')
+        time_file = join(tmpdir, 'time.dat')
+        shape = (len(chan_name), len(time))
+        dtype = data.data[0].dtype.str
+
+        dat = memmap(dat_file, dtype=dtype, mode='w+', shape=shape)
+        begsam = 0
+        for trl, x in enumerate(data.data):
+            x = x.take(_index_of_chan(data, trl, chan_name), axis=idx_chan)
+            endsam = begsam + x.shape[idx_time]
+            dat[:, begsam:endsam] = moveaxis(x, idx_chan, 0)
+            begsam = endsam
+        dat.flush()
+        del dat
+
+        mm_time = memmap(time_file, dtype=time.dtype.str, mode='w+',
+                         shape=time.shape)
+        mm_time[:] = time
+        mm_time.flush()
+        del mm_time
+
+        args = [(detect_func, dat_file, time_file, dtype, time.dtype.str,
+                 shape, i, data.s_freq, opts) for i in range(len(chan_name))]
+        lg.info('Running %s on %d channels, with %d processes',
+                detect_func.__name__, len(chan_name), n_jobs)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_detect_one_chan, args))
+
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+    return results
+
+
+def _index_of_chan(data, trl, chan_name):
+    """Return the index of the channels in one trial."""
+    labels = list(data.axis['chan'][trl])
+    return [labels.index(chan) for chan in chan_name]
+
+
+def _detect_one_chan(args):
+    """Run detection on one channel in a separate process."""
+    (detect_func, dat_file, time_file, dtype, time_dtype, shape, i, s_freq,
+     opts) = args
+    dat = memmap(dat_file, dtype=dtype, mode='r', shape=shape)
+    time = memmap(time_file, dtype=time_dtype, mode='r', shape=(shape[1], ))
+    return detect_func(asarray(dat[i]), s_freq, asarray(time), opts)
+
+
+def select_segments(dataset, annot=None, stage=None, reject_bad=True):
+    """Find the contiguous periods of interest in a recording.
+
+    Parameters
+    ----------
+    dataset : instance of Dataset
+        recording to analyze
+    annot : instance of Annotations, optional
+        if specified, only the epochs of interest are used
+    stage : list of str, optional
+        stages of interest (only if annot is specified). If None, all the
+        epochs.
+    reject_bad : bool
+        do not use the epochs whose quality is 'Bad'
+
+    Returns
+    -------
+    list of tuple of int
+        first and last (excluded) sample of each period. Consecutive epochs
+        are joined into one period.
+    """
+    s_freq = dataset.header['s_freq']
+    n_samples = dataset.header['n_samples']
+    if annot is None:
+        return [(0, n_samples)]
+
+    segments = []
+    for ep in annot.epochs:
+        if stage is not None and ep['stage'] not in stage:
+            continue
+        if reject_bad and ep['quality'] == 'Bad':
+            continue
+
+        begsam = int(round(ep['start'] * s_freq))
+        endsam = min(int(round(ep['end'] * s_freq)), n_samples)
+        if begsam >= endsam:
+            continue
+
+        if segments and segments[-1][1] == begsam:
+            segments[-1] = (segments[-1][0], endsam)
+        else:
+            segments.append((begsam, endsam))
+
+    return segments
+
+
+def read_padded_chunks(dataset, chan, segments, chunk=300, pad=10):
+    """Read the periods of interest in chunks, with some padding.
+
+    Parameters
+    ----------
+    dataset : instance of Dataset
+        recording to analyze
+    chan : list of str
+        channels to read
+    segments : list of tuple of int
+        first and last (excluded) sample of each period of interest
+    chunk : float
+        duration in s of each chunk (without padding)
+    pad : float
+        duration in s of the data to read before and after each chunk (if
+        present in the recording, even outside the periods of interest)
+
+    Yields
+    ------
+    ndarray
+        nChan X nSamples matrix with the data, including the padding
+    ndarray
+        time points of each sample (in s from the start of the recording)
+    slice
+        samples which belong to the chunk (without the padding)
+    """
+    s_freq = dataset.header['s_freq']
+    n_samples = dataset.header['n_samples']
+    n_chunk = max(int(chunk * s_freq), 1)
+    n_pad = int(pad * s_freq)
+
+    for begsam, endsam in segments:
+        for chunk_beg in range(begsam, endsam, n_chunk):
+            chunk_end = min(chunk_beg + n_chunk, endsam)
+            pad_beg = max(chunk_beg - n_pad, 0)
+            pad_end = min(chunk_end + n_pad, n_samples)
+            data = dataset.read_data(chan=chan, begsam=pad_beg, endsam=pad_end)
+            yield (data.data[0], data.axis['time'][0],
+                   slice(chunk_beg - pad_beg, chunk_end - pad_beg))
+
+
+def detect_Ferrarelli2007(dat_orig, s_freq, time, opts, stats=None):
     """Spindle detection based on Ferrarelli et al. 2007.
 
     Parameters
@@ -202,6 +477,10 @@ def detect_Ferrarelli2007(dat_orig, s_freq, time, opts):
             selection threshold
         'duration' : tuple of float
             min and max duration of spindles
+    stats : dict, optional
+        statistics to compute the thresholds, with keys 'det' (and 'sel' for
+        UCSD), passed to define_threshold. If None, they are computed on the
+        transformed data (see detect_dataset).
 
     Returns
     -------
@@ -221,12 +500,12 @@ def detect_Ferrarelli2007(dat_orig, s_freq, time, opts):
     ----------
     Ferrarelli, F. et al. Am. J. Psychiatry 164, 483-92 (2007).
     """
-    dat_det = transform_signal(dat_orig, s_freq, 'butter', opts.det_butter)
-    dat_det = transform_signal(dat_det, s_freq, 'hilbert')
-    dat_det = transform_signal(dat_det, s_freq, 'abs')
+    dat_det, _ = detection_signals(dat_orig, s_freq, opts)
+    if stats is None:
+        stats = {'det': dat_det}
 
-    det_value = define_threshold(dat_det, s_freq, 'mean', opts.det_thresh)
-    sel_value = define_threshold(dat_det, s_freq, 'mean', opts.sel_thresh)
+    det_value = define_threshold(stats['det'], s_freq, 'mean', opts.det_thresh)
+    sel_value = define_threshold(stats['det'], s_freq, 'mean', opts.sel_thresh)
 
     events = detect_events(dat_det, 'above_thresh', det_value)
 
@@ -254,7 +533,7 @@ def detect_Ferrarelli2007(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_Moelle2011(dat_orig, s_freq, time, opts):
+def detect_Moelle2011(dat_orig, s_freq, time, opts, stats=None):
     """Spindle detection based on Moelle et al. 2011
 
     Parameters
@@ -276,6 +555,10 @@ def detect_Moelle2011(dat_orig, s_freq, time, opts):
             not used, but keep it for consistency with the other methods
         'duration' : tuple of float
             min and max duration of spindles
+    stats : dict, optional
+        statistics to compute the thresholds, with keys 'det' (and 'sel' for
+        UCSD), passed to define_threshold. If None, they are computed on the
+        transformed data (see detect_dataset).
 
     Returns
     -------
@@ -295,11 +578,12 @@ def detect_Moelle2011(dat_orig, s_freq, time, opts):
     ----------
     Moelle, M. et al. Sleep 34, 1411-21 (2011).
     """
-    dat_det = transform_signal(dat_orig, s_freq, 'butter', opts.det_butter)
-    dat_det = transform_signal(dat_det, s_freq, 'moving_rms', opts.moving_rms)
-    dat_det = transform_signal(dat_det, s_freq, 'moving_avg', opts.smooth)
+    dat_det, _ = detection_signals(dat_orig, s_freq, opts)
+    if stats is None:
+        stats = {'det': dat_det}
 
-    det_value = define_threshold(dat_det, s_freq, 'mean+std', opts.det_thresh)
+    det_value = define_threshold(stats['det'], s_freq, 'mean+std',
+                                 opts.det_thresh)
 
     events = detect_events(dat_det, 'above_thresh', det_value)
 
@@ -324,7 +608,7 @@ def detect_Moelle2011(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_Nir2011(dat_orig, s_freq, time, opts):
+def detect_Nir2011(dat_orig, s_freq, time, opts, stats=None):
     """Spindle detection based on Nir et al. 2011
 
     Parameters
@@ -348,6 +632,10 @@ def detect_Nir2011(dat_orig, s_freq, time, opts):
             minimum interval between consecutive events
         'duration' : tuple of float
             min and max duration of spindles
+    stats : dict, optional
+        statistics to compute the thresholds, with keys 'det' (and 'sel' for
+        UCSD), passed to define_threshold. If None, they are computed on the
+        transformed data (see detect_dataset).
 
     Returns
     -------
@@ -372,13 +660,14 @@ def detect_Nir2011(dat_orig, s_freq, time, opts):
     ----------
     Nir, Y. et al. Neuron 70, 153-69 (2011).
     """
-    dat_det = transform_signal(dat_orig, s_freq, 'butter', opts.det_butter)
-    dat_det = transform_signal(dat_det, s_freq, 'hilbert')
-    dat_det = transform_signal(dat_det, s_freq, 'abs')
-    dat_det = transform_signal(dat_det, s_freq, 'gaussian', opts.smooth)
+    dat_det, _ = detection_signals(dat_orig, s_freq, opts)
+    if stats is None:
+        stats = {'det': dat_det}
 
-    det_value = define_threshold(dat_det, s_freq, 'mean+std', opts.det_thresh)
-    sel_value = define_threshold(dat_det, s_freq, 'mean+std', opts.sel_thresh)
+    det_value = define_threshold(stats['det'], s_freq, 'mean+std',
+                                 opts.det_thresh)
+    sel_value = define_threshold(stats['det'], s_freq, 'mean+std',
+                                 opts.sel_thresh)
 
     events = detect_events(dat_det, 'above_thresh', det_value)
 
@@ -405,7 +694,7 @@ def detect_Nir2011(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_Wamsley2012(dat_orig, s_freq, time, opts):
+def detect_Wamsley2012(dat_orig, s_freq, time, opts, stats=None):
     """Spindle detection based on Wamsley et al. 2012
 
     Parameters
@@ -427,6 +716,10 @@ def detect_Wamsley2012(dat_orig, s_freq, time, opts):
             not used, but keep it for consistency with the other methods
         'duration' : tuple of float
             min and max duration of spindles
+    stats : dict, optional
+        statistics to compute the thresholds, with keys 'det' (and 'sel' for
+        UCSD), passed to define_threshold. If None, they are computed on the
+        transformed data (see detect_dataset).
 
     Returns
     -------
@@ -442,11 +735,11 @@ def detect_Wamsley2012(dat_orig, s_freq, time, opts):
     ----------
     Wamsley, E. J. et al. Biol. Psychiatry 71, 154-61 (2012).
     """
-    dat_det = transform_signal(dat_orig, s_freq, 'morlet', opts.det_wavelet)
-    dat_det = transform_signal(dat_det, s_freq, 'abs')
-    dat_det = transform_signal(dat_det, s_freq, 'moving_avg', opts.smooth)
+    dat_det, _ = detection_signals(dat_orig, s_freq, opts)
+    if stats is None:
+        stats = {'det': dat_det}
 
-    det_value = define_threshold(dat_det, s_freq, 'mean', opts.det_thresh)
+    det_value = define_threshold(stats['det'], s_freq, 'mean', opts.det_thresh)
 
     events = detect_events(dat_det, 'above_thresh', det_value)
 
@@ -471,7 +764,7 @@ def detect_Wamsley2012(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_UCSD(dat_orig, s_freq, time, opts):
+def detect_UCSD(dat_orig, s_freq, time, opts, stats=None):
     """Spindle detection based on the UCSD method
 
     Parameters
@@ -495,6 +788,10 @@ def detect_UCSD(dat_orig, s_freq, time, opts):
             low and high frequency of spindle band (for power ratio)
         ratio_thresh : float
             ratio between power inside and outside spindle band to accept them
+    stats : dict, optional
+        statistics to compute the thresholds, with keys 'det' (and 'sel' for
+        UCSD), passed to define_threshold. If None, they are computed on the
+        transformed data (see detect_dataset).
 
     Returns
     -------
@@ -506,17 +803,16 @@ def detect_UCSD(dat_orig, s_freq, time, opts):
         spindle density, per 30-s epoch
 
     """
-    dat_det = transform_signal(dat_orig, s_freq, 'wavelet_real',
-                               opts.det_wavelet)
+    dat_det, dat_sel = detection_signals(dat_orig, s_freq, opts)
+    if stats is None:
+        stats = {'det': dat_det, 'sel': dat_sel}
 
-    det_value = define_threshold(dat_det, s_freq, 'median+std',
+    det_value = define_threshold(stats['det'], s_freq, 'median+std',
                                  opts.det_thresh)
 
     events = detect_events(dat_det, 'maxima', det_value)
 
-    dat_sel = transform_signal(dat_orig, s_freq, 'wavelet_real',
-                               opts.sel_wavelet)
-    sel_value = define_threshold(dat_sel, s_freq, 'median+std',
+    sel_value = define_threshold(stats['sel'], s_freq, 'median+std',
                                  opts.sel_thresh)
     events = select_events(dat_sel, events, 'above_thresh', sel_value)
 
@@ -539,6 +835,188 @@ def detect_UCSD(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
+DETECT_METHODS = {'Ferrarelli2007': detect_Ferrarelli2007,
+                  'Nir2011': detect_Nir2011,
+                  'Wamsley2012': detect_Wamsley2012,
+                  'UCSD': detect_UCSD,
+                  'Moelle2011': detect_Moelle2011,
+                  }
+
+
+class SignalCache:
+    """Keep the most recently used detection signals in memory.
+
+    Parameters
+    ----------
+    max_bytes : int
+        maximum size of all the signals in memory (0 disables the cache)
+
+    Notes
+    -----
+    The signals are indexed by the key computed by _signal_key and the least
+    recently used ones are removed when the total size is above max_bytes.
+    The signals are shared between calls, so they are read-only.
+    """
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._signals = OrderedDict()
+
+    def __len__(self):
+        return len(self._signals)
+
+    def get(self, key):
+        """Return the signals for key (None if they are not in the cache)."""
+        signals = self._signals.get(key)
+        if signals is not None:
+            self._signals.move_to_end(key)
+        return signals
+
+    def put(self, key, signals):
+        """Add the signals for key, removing the least recently used ones."""
+        nbytes = _nbytes(signals)
+        if nbytes > self.max_bytes:
+            return
+
+        for x in signals:
+            if x is not None:
+                x.setflags(write=False)
+
+        if key in self._signals:
+            self.nbytes -= _nbytes(self._signals.pop(key))
+        self._signals[key] = signals
+        self.nbytes += nbytes
+
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= _nbytes(self._signals.popitem(last=False)[1])
+
+    def clear(self):
+        """Remove all the signals."""
+        self._signals.clear()
+        self.nbytes = 0
+
+
+SIGNAL_CACHE = SignalCache()
+
+
+def detection_signals(dat_orig, s_freq, opts):
+    """Transform the data into the signals used to detect spindles.
+
+    Parameters
+    ----------
+    dat_orig : ndarray (dtype='float')
+        vector with the data for one channel
+    s_freq : float
+        sampling frequency
+    opts : instance of 'DetectSpindle'
+        options of the detection (see the detect_* functions)
+
+    Returns
+    -------
+    ndarray (dtype='float')
+        vector with the data after detection-transformation
+    ndarray (dtype='float') or None
+        vector with the data after selection-transformation, only for methods
+        which use a different transformation for selection (UCSD)
+
+    Notes
+    -----
+    The signals are kept in SIGNAL_CACHE, indexed by the content of the data
+    and by the options of the transformations (see TRANSFORM_OPTIONS), so
+    running the detection again on the same data with different thresholds
+    or duration only repeats the selection of the events. The output is
+    read-only.
+    """
+    if opts.method not in TRANSFORM_OPTIONS:
+        raise ValueError('Unknown method')
+
+    key = _signal_key(dat_orig, s_freq, opts)
+    signals = SIGNAL_CACHE.get(key)
+    if signals is None:
+        signals = _compute_detection_signals(dat_orig, s_freq, opts)
+        SIGNAL_CACHE.put(key, signals)
+
+    return signals
+
+
+def _signal_key(dat_orig, s_freq, opts):
+    """Identify the detection signals of some data.
+
+    Parameters
+    ----------
+    dat_orig : ndarray (dtype='float')
+        vector with the data for one channel
+    s_freq : float
+        sampling frequency
+    opts : instance of 'DetectSpindle'
+        options of the detection
+
+    Returns
+    -------
+    tuple
+        hash of the data (so that the same data read again has the same key),
+        with its dtype and shape, the sampling frequency, the method and the
+        options used by its transformations
+    """
+    dat = ascontiguousarray(dat_orig)
+    digest = blake2b(dat, digest_size=16).hexdigest()
+    options = tuple(_freeze(getattr(opts, x))
+                    for x in TRANSFORM_OPTIONS[opts.method])
+    return (digest, dat.dtype.str, dat.shape, s_freq, opts.method, options)
+
+
+def _freeze(value):
+    """Convert (nested) dict, list and ndarray into tuples, to use them in a
+    key."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    return value
+
+
+def _nbytes(signals):
+    return sum(x.nbytes for x in signals if x is not None)
+
+
+def _compute_detection_signals(dat_orig, s_freq, opts):
+    """Compute the detection signals (see detection_signals)."""
+    dat_sel = None
+
+    if opts.method in ('Ferrarelli2007', 'Nir2011'):
+        dat_det = transform_signal(dat_orig, s_freq, 'butter', opts.det_butter)
+        dat_det = transform_signal(dat_det, s_freq, 'hilbert')
+        dat_det = transform_signal(dat_det, s_freq, 'abs')
+        if opts.method == 'Nir2011':
+            dat_det = transform_signal(dat_det, s_freq, 'gaussian',
+                                       opts.smooth)
+
+    elif opts.method == 'Moelle2011':
+        dat_det = transform_signal(dat_orig, s_freq, 'butter', opts.det_butter)
+        dat_det = transform_signal(dat_det, s_freq, 'moving_rms',
+                                   opts.moving_rms)
+        dat_det = transform_signal(dat_det, s_freq, 'moving_avg', opts.smooth)
+
+    elif opts.method == 'Wamsley2012':
+        dat_det = transform_signal(dat_orig, s_freq, 'morlet',
+                                   opts.det_wavelet)
+        dat_det = transform_signal(dat_det, s_freq, 'abs')
+        dat_det = transform_signal(dat_det, s_freq, 'moving_avg', opts.smooth)
+
+    elif opts.method == 'UCSD':
+        dat_det = transform_signal(dat_orig, s_freq, 'wavelet_real',
+                                   opts.det_wavelet)
+        dat_sel = transform_signal(dat_orig, s_freq, 'wavelet_real',
+                                   opts.sel_wavelet)
+
+    else:
+        raise ValueError('Unknown method')
+
+    return dat_det, dat_sel
+
+
 def transform_signal(dat, s_freq, method, method_opt=None):
     """Transform the data using different methods.
 
@@ -639,7 +1117,7 @@ def transform_signal(dat, s_freq, method, method_opt=None):
         freqs = method_opt['freqs']
         dur = method_opt['dur']
         width = method_opt['width']
-        win = method_opt['win'] * s_freq
+        win = int(method_opt['win'] * s_freq)
 
         wm = _realwavelets(s_freq, freqs, dur, width)
         tfr = empty((dat.shape[0], wm.shape[0]))
@@ -663,12 +1141,7 @@ def transform_signal(dat, s_freq, method, method_opt=None):
     if 'moving_rms' == method:
         dur = method_opt['dur']
         halfdur = int(floor(s_freq * dur / 2))
-        ldat = len(dat)
-        rms = zeros((ldat))
-
-        for i in range(ldat):
-            rms[i] = sqrt(mean(square(dat[max(0, i - halfdur):min(ldat, i + halfdur)])))
-        dat = rms
+        dat = compute_moving(dat, halfdur, method='rms')
 
     if 'gaussian' == method:
         sigma = method_opt['dur']
@@ -683,35 +1156,65 @@ def define_threshold(dat, s_freq, method, value):
 
     Parameters
     ----------
-    dat : ndarray (dtype='float')
-        vector with the data after selection-transformation
+    dat : ndarray (dtype='float') or dict or instance of SignalStats
+        vector with the data after selection-transformation, or the
+        statistics of the data ('mean', 'median', 'std'), if they were
+        computed in advance (f.e. in chunks)
     s_freq : float
         sampling frequency
     method : str
-        one of 'mean', 'median', 'std', 'mean+std', 'median+std'
+        one of 'mean', 'median', 'std', 'mean+std', 'median+std',
+        'percentile'
     value : float
-        value to multiply the values for
+        value to multiply the values for (for 'percentile', the percentile
+        between 0 and 100)
 
     Returns
     -------
     float
         threshold in useful units.
 
+    Notes
+    -----
+    With an instance of SignalStats, the mean and the standard deviation are
+    the same as on the data (to rounding error), while the median is within
+    the relative accuracy of SignalStats (0.1% by default).
     """
     if method == 'mean':
-        value = value * mean(dat)
+        value = value * _get_stat(dat, 'mean')
     elif method == 'median':
-        value = value * median(dat)
+        value = value * _get_stat(dat, 'median')
     elif method == 'std':
-        value = value * std(dat)
+        value = value * _get_stat(dat, 'std')
     elif method == 'mean+std':
-        value = mean(dat) + value * std(dat)
+        value = _get_stat(dat, 'mean') + value * _get_stat(dat, 'std')
     elif method == 'median+std':
-        value = median(dat) + value * std(dat)
+        value = _get_stat(dat, 'median') + value * _get_stat(dat, 'std')
+    elif method == 'percentile':
+        value = _get_percentile(dat, value)
 
     return value
 
 
+def _get_stat(dat, name):
+    """Compute one statistic of the data, or read it if already computed."""
+    if isinstance(dat, dict):
+        return dat[name]
+    if isinstance(dat, SignalStats):
+        return getattr(dat, name)
+    return {'mean': mean, 'median': median, 'std': std}[name](dat)
+
+
+def _get_percentile(dat, q):
+    """Compute one percentile of the data, or estimate it from the
+    statistics computed in advance."""
+    if isinstance(dat, dict):
+        return dat['percentile']
+    if isinstance(dat, SignalStats):
+        return dat.quantile(q / 100)
+    return percentile(dat, q)
+
+
 def detect_events(dat, method, value=None):
     """Detect events using 'above_thresh', 'below_thresh' or
     'maxima' method.
@@ -746,9 +1249,9 @@ def detect_events(dat, method, value=None):
             return None
 
         # add the location of the peak in the middle
-        detected = insert(detected, 1, 0, axis=1)
-        for i in detected:
-            i[1] = i[0] + argmax(dat[i[0]:i[2]])
+        peaks = _arg_reduce_in_segments(maximum, dat, detected[:, 0],
+                                        detected[:, 1])
+        detected = insert(detected, 1, peaks, axis=1)
 
     if method == 'maxima':
         peaks = argrelmax(dat)[0]
@@ -790,53 +1293,6 @@ def select_events(dat, detected, method, value):
     return detected
 
 
-def merge_close(events, min_interval):
-    """Merge events that are separated by a less than a minimum interval.
-    When merging, longer event is extended and shorter one is discarded.
-
-    Parameters
-    ----------
-    events : list of dict
-        events with 'start' and 'end' times, from one or several channels.
-        **Events must be sorted by their start time.**
-    min_interval : float
-        minimum delay between consecutive events, in seconds
-
-    Returns
-    -------
-    list of dict
-        original events list with close events merged. Note that in a merger,
-        info (chan, peak, etc.) from the longer of the 2 events is kept.
-    """
-    half_iv = min_interval / 2
-    merged = []
-
-    for higher in events:
-
-        if not merged:
-            merged.append(higher)
-
-        else:
-            lower = merged[-1]
-
-            if higher['start'] - half_iv <= lower['end'] + half_iv:
-
-                if (higher['end'] - higher['start'] >
-                   lower['end'] - lower['start']):
-                    start = min(lower['start'], higher['start'])
-                    higher.update({'start': start})
-                    merged[-1] = higher
-
-                else:
-                    end = max(lower['end'], higher['end'])
-                    merged[-1].update({'end': end})
-
-            else:
-                merged.append(higher)
-
-    return merged
-
-
 def within_duration(events, time, limits):
     """Check whether event is within time limits.
 
@@ -886,23 +1342,16 @@ def power_ratio(events, dat, s_freq, limits, ratio_thresh):
     In the original matlab script, it uses amplitude, not power.
 
     """
-    ratio = empty(events.shape[0])
-    for i, one_event in enumerate(events):
+    ratio = zeros(events.shape[0])
+    for idx, f, Pxx in _periodogram_by_length(dat, events[:, 0], events[:, 2],
+                                              s_freq, scaling='spectrum'):
+        Pxx = sqrt(Pxx)  # use amplitude
 
-        x0 = one_event[0]
-        x1 = one_event[2]
-
-        if x0 < 0 or x1 >= len(dat):
-            ratio[i] = 0
-
-        else:
-            f, Pxx = periodogram(dat[x0:x1], s_freq, scaling='spectrum')
-            Pxx = sqrt(Pxx)  # use amplitude
+        freq_sp = (f >= limits[0]) & (f <= limits[1])
+        freq_nonsp = (f <= limits[1])
 
-            freq_sp = (f >= limits[0]) & (f <= limits[1])
-            freq_nonsp = (f <= limits[1])
-
-            ratio[i] = mean(Pxx[freq_sp]) / mean(Pxx[freq_nonsp])
+        ratio[idx] = (mean(Pxx[:, freq_sp], axis=1) /
+                      mean(Pxx[:, freq_nonsp], axis=1))
 
     events = events[ratio > ratio_thresh, :]
 
@@ -937,22 +1386,17 @@ def peak_in_power(events, dat, s_freq, method, value=None):
     peak.fill(nan)
 
     if method is not None:
-        for i, one_event in enumerate(events):
-
-            if method == 'peak':
-                x0 = one_event[1] - value / 2 * s_freq
-                x1 = one_event[1] + value / 2 * s_freq
+        if method == 'peak':
+            x0 = (events[:, 1] - value / 2 * s_freq).astype(int)
+            x1 = (events[:, 1] + value / 2 * s_freq).astype(int)
 
-            elif method == 'interval':
-                x0 = one_event[0]
-                x1 = one_event[2]
+        elif method == 'interval':
+            x0 = events[:, 0]
+            x1 = events[:, 2]
 
-            if x0 < 0 or x1 >= len(dat):
-                peak[i] = nan
-            else:
-                f, Pxx = periodogram(dat[x0:x1], s_freq)
-                idx_peak = Pxx[f < MAX_FREQUENCY_OF_INTEREST].argmax()
-                peak[i] = f[idx_peak]
+        for idx, f, Pxx in _periodogram_by_length(dat, x0, x1, s_freq):
+            idx_peak = Pxx[:, f < MAX_FREQUENCY_OF_INTEREST].argmax(axis=1)
+            peak[idx] = f[idx_peak]
 
     return peak
 
@@ -981,21 +1425,57 @@ def avg_power(events, dat, s_freq, frequency):
     avg = empty(events.shape[0])
     avg.fill(nan)
 
-    for i, one_event in enumerate(events):
+    for idx, sf, Pxx in _periodogram_by_length(dat, events[:, 0],
+                                               events[:, 2], s_freq):
+        # find nearest frequencies in sf
+        b0 = abs(sf - frequency[0]).argmin()
+        b1 = abs(sf - frequency[1]).argmin()
+        avg[idx] = mean(Pxx[:, b0:b1], axis=1)
 
-        x0 = one_event[0]
-        x1 = one_event[2]
+    return avg
 
-        if x0 < 0 or x1 >= len(dat):
-            avg[i] = nan
-        else:
-            sf, Pxx = periodogram(dat[x0:x1], s_freq)
-            # find nearest frequencies in sf
-            b0 = asarray([abs(x - frequency[0]) for x in sf]).argmin()
-            b1 = asarray([abs(x - frequency[1]) for x in sf]).argmin()
-            avg[i] = mean(Pxx[b0:b1])
 
-    return avg
+def _periodogram_by_length(dat, x0, x1, s_freq, **options):
+    """Compute the periodogram of all the events with the same length at once.
+
+    Parameters
+    ----------
+    dat : ndarray (dtype='float')
+        vector with the data
+    x0 : ndarray (dtype='int')
+        first sample of each event
+    x1 : ndarray (dtype='int')
+        last sample of each event (excluded)
+    s_freq : float
+        sampling frequency
+    **options
+        additional options passed to scipy.signal.periodogram
+
+    Yields
+    ------
+    ndarray (dtype='int')
+        index of the events with the same length
+    ndarray (dtype='float')
+        frequencies of the periodogram
+    ndarray (dtype='float')
+        events X frequency matrix with the periodogram
+
+    Notes
+    -----
+    Events which start before the data or end at the last sample (or after)
+    are skipped. Grouping by length gives the same frequencies as computing
+    one periodogram per event, but with one FFT for each group.
+    """
+    x0 = asarray(x0, dtype=int)
+    x1 = asarray(x1, dtype=int)
+    valid = (x0 >= 0) & (x1 < len(dat)) & (x1 > x0)
+    lengths = x1 - x0
+
+    for one_length in unique(lengths[valid]):
+        idx = where(valid & (lengths == one_length))[0]
+        segments = dat[x0[idx, None] + arange(one_length)]
+        f, Pxx = periodogram(segments, s_freq, axis=-1, **options)
+        yield idx, f, Pxx
 
 
 def make_spindles(events, power_peaks, power_avgs, dat_det, dat_orig, time,
@@ -1071,31 +1551,31 @@ def _remove_duplicate(old_events, dat):
     end time. When two (or more) events have the same start time and the same
     end time, then it takes the largest peak.
 
-    There is no tolerance, indices need to be identical.
+    There is no tolerance, indices need to be identical. The duplicates are
+    consecutive rows, so they are found with one comparison between each row
+    and the previous one.
     """
+    if len(old_events) == 0:
+        return zeros(0, dtype=int), old_events
+
     diff_events = diff(old_events, axis=0)
-    dupl = where((diff_events[:, 0] == 0) & (diff_events[:, 2] == 0))[0]
-    dupl += 1  # more convenient, it copies old_event first and then compares
-
-    n_nondupl_events = old_events.shape[0] - len(dupl)
-    new_events = zeros((n_nondupl_events, old_events.shape[1]), dtype='int')
-    if len(dupl):
-        lg.debug('Removing ' + str(len(dupl)) + ' duplicate events')
-
-    i = 0
-    indices = []
-    for i_old, one_old_event in enumerate(old_events):
-        if i_old not in dupl:
-            new_events[i, :] = one_old_event
-            i += 1
-            indices.append(i_old)
-        else:
-            peak_0 = new_events[i - 1, 1]
-            peak_1 = one_old_event[1]
-            if dat[peak_0] >= dat[peak_1]:
-                new_events[i - 1, 1] = peak_0
-            else:
-                new_events[i - 1, 1] = peak_1
+    is_new = ones(old_events.shape[0], dtype=bool)
+    is_new[1:] = (diff_events[:, 0] != 0) | (diff_events[:, 2] != 0)
+    indices = flatnonzero(is_new)
+    if len(indices) < len(is_new):
+        lg.debug('Removing ' + str(len(is_new) - len(indices)) +
+                 ' duplicate events')
+
+    # the first of the highest peaks among the duplicates
+    peak_val = dat[old_events[:, 1]]
+    group = is_new.cumsum() - 1
+    highest = flatnonzero(peak_val == maximum.reduceat(peak_val,
+                                                       indices)[group])
+    is_first = ones(len(highest), dtype=bool)
+    is_first[1:] = diff(group[highest]) != 0
+
+    new_events = old_events[indices]
+    new_events[:, 1] = old_events[highest[is_first], 1]
 
     return indices, new_events
 
@@ -1113,12 +1593,18 @@ def _detect_start_end(true_values):
     ndarray (dtype='int')
         N x 2 matrix with starting and ending times.
     """
-    neg = zeros((1), dtype='bool')
-    int_values = asarray(concatenate((neg, true_values, neg)), dtype='int')
-    cross_threshold = diff(int_values)
+    true_values = asarray(true_values, dtype=bool)
+    if len(true_values) == 0:
+        return None
+
+    edges = flatnonzero(true_values[1:] != true_values[:-1]) + 1
+    if true_values[0]:
+        edges = concatenate(([0], edges))
+    if true_values[-1]:
+        edges = concatenate((edges, [len(true_values)]))
 
-    event_starts = where(cross_threshold == 1)[0]
-    event_ends = where(cross_threshold == -1)[0]
+    event_starts = edges[::2]
+    event_ends = edges[1::2]
 
     if len(event_starts):
         events = vstack((event_starts, event_ends)).T
@@ -1129,6 +1615,86 @@ def _detect_start_end(true_values):
     return events
 
 
+def _reduce_in_segments(ufunc, dat, beg, end):
+    """Apply a reduction (f.e. maximum) to all the segments at once.
+
+    Parameters
+    ----------
+    ufunc : numpy.ufunc
+        function with the reduceat method (f.e. numpy.maximum, numpy.add)
+    dat : ndarray
+        vector with the data
+    beg : ndarray (dtype='int')
+        first sample of each segment
+    end : ndarray (dtype='int')
+        last sample (excluded) of each segment, larger than beg
+
+    Returns
+    -------
+    ndarray
+        one value for each segment
+    """
+    if len(beg) == 0:
+        return zeros(0, dtype=dat.dtype)
+
+    idx = empty(2 * len(beg), dtype=int)
+    idx[::2] = beg
+    idx[1::2] = end
+    if idx.max() >= len(dat):
+        dat = concatenate((dat, dat[:1]))  # so that end can be the last sample
+    return ufunc.reduceat(dat, idx)[::2]
+
+
+def _arg_reduce_in_segments(ufunc, dat, beg, end, values=None):
+    """Find the sample with the highest (or lowest) value in all the segments
+    at once.
+
+    Parameters
+    ----------
+    ufunc : numpy.ufunc
+        numpy.maximum (as argmax) or numpy.minimum (as argmin)
+    dat : ndarray
+        vector with the data
+    beg : ndarray (dtype='int')
+        first sample of each segment
+    end : ndarray (dtype='int')
+        last sample (excluded) of each segment, larger than beg
+    values : ndarray, optional
+        highest (or lowest) value of each segment, if already computed with
+        _reduce_in_segments
+
+    Returns
+    -------
+    ndarray (dtype='int')
+        index of the highest (or lowest) value in each segment (the first
+        one, if there are ties, as numpy.argmax)
+
+    Notes
+    -----
+    The maximum of each segment is computed with reduceat and the first sample
+    with that value is found with one search over all the segments, so the
+    computation time is linear in the total length of the segments.
+    """
+    if len(beg) == 0:
+        return zeros(0, dtype=int)
+
+    n_smp = asarray(end) - asarray(beg)
+    first = cumsum(n_smp) - n_smp
+
+    # indices of all the samples in the segments, one segment after the other
+    step = ones(n_smp.sum(), dtype=int)
+    step[0] = beg[0]
+    step[first[1:]] = beg[1:] - end[:-1] + 1
+    idx = cumsum(step)
+
+    if values is None:
+        values = _reduce_in_segments(ufunc, dat, beg, end)
+
+    vals = dat[idx]
+    hits = flatnonzero((vals == repeat(values, n_smp)) | isnan(vals))
+    return idx[hits[searchsorted(hits, first)]]
+
+
 def _select_period(detected, true_values):
     """For the detected values, we check when it goes above/below the
     selection.
@@ -1198,7 +1764,7 @@ def _merge_close(dat, events, time, min_interval):
 
         new_events = vstack((begs, ends)).T
     else:
-        new_events = asarray[[events[0, 0], events[-1, 2]]]
+        new_events = asarray([[events[0, 0], events[-1, 2]]])
 
     # add the location of the peak in the middle
     new_events = insert(new_events, 1, 0, axis=1)
@@ -0,0 +1,298 @@
+"""Module with one-pass statistics, to compute the thresholds for detection
+on data which is read in chunks (or by different processes).
+
+All the classes can be updated with a chunk of data at the time and they can
+be merged, so that the statistics computed on separate parts of the recording
+are identical (or, for the quantiles, within a known tolerance) to the
+statistics computed on the whole recording at once.
+"""
+from math import floor
+
+from numpy import (asarray, bincount, ceil, concatenate, cumsum, exp,
+                   float64, int64, isnan, log, ones, searchsorted, unique,
+                   zeros)
+
+DEFAULT_RELATIVE_ACCURACY = 1e-3
+MIN_ABS_VALUE = 1e-12
+
+
+class RunningStats:
+    """Mean and variance in one pass (Welford / Chan et al. algorithm).
+
+    Attributes
+    ----------
+    n : int
+        number of samples
+    mean : float
+        mean of the samples
+    m2 : float
+        sum of the squared differences from the mean
+
+    Notes
+    -----
+    Each chunk is summarized with its own mean and sum of squared differences,
+    which are then combined with the running values (Chan, Golub, LeVeque
+    1979). This is numerically stable, unlike the difference between the sum
+    of squares and the squared sum, and the results match numpy.mean and
+    numpy.std to rounding error, independent of how the data was split.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, x):
+        """Add the samples in x.
+
+        Parameters
+        ----------
+        x : ndarray
+            values (any shape, all the values are used)
+        """
+        x = asarray(x, dtype=float64).ravel()
+        if x.size == 0:
+            return
+
+        other = RunningStats()
+        other.n = x.size
+        other.mean = x.mean()
+        other.m2 = ((x - other.mean) ** 2).sum()
+        self.merge(other)
+
+    def merge(self, other):
+        """Add the statistics computed on other samples.
+
+        Parameters
+        ----------
+        other : instance of RunningStats
+            statistics computed on different samples
+        """
+        if other.n == 0:
+            return
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+
+    @property
+    def var(self):
+        """Variance (normalized by n, as numpy.var)."""
+        if self.n == 0:
+            return float('nan')
+        return self.m2 / self.n
+
+    @property
+    def std(self):
+        """Standard deviation (normalized by n, as numpy.std)."""
+        return self.var ** .5
+
+
+class QuantileSketch:
+    """Approximate quantiles in one pass, with bounded relative error.
+
+    Parameters
+    ----------
+    relative_accuracy : float
+        maximum relative error of the quantiles (f.e. 1e-3 is 0.1%)
+
+    Notes
+    -----
+    The values are counted in logarithmic bins (as in DDSketch, Masson et al.
+    2019): bin k contains the values between gamma ** (k - 1) and gamma ** k,
+    with gamma = (1 + relative_accuracy) / (1 - relative_accuracy), and its
+    value is the one with the same relative distance from both edges. Positive
+    and negative values are counted separately, values smaller (in absolute
+    terms) than 1e-12 are counted as zero.
+
+    The quantile q returned by the sketch is within relative_accuracy of the
+    sample at rank floor(q * (n - 1)) of the sorted data. For the median of an
+    even number of samples, numpy.median returns the average of the two
+    central samples, so the tolerance is relative_accuracy plus half of the
+    difference between them (which is negligible for long recordings).
+
+    The number of bins only depends on the range of the values (about 7000
+    bins for six orders of magnitude at 0.1%), not on the number of samples,
+    and two sketches are merged by adding their counts, so the result does not
+    depend on how the data was split.
+    """
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy should be between 0 and 1')
+
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = float(log(self.gamma))
+        self.n = 0
+        self.n_zero = 0
+        self._pos = (zeros(0, dtype=int64), zeros(0, dtype=int64))
+        self._neg = (zeros(0, dtype=int64), zeros(0, dtype=int64))
+
+    def update(self, x):
+        """Add the samples in x.
+
+        Parameters
+        ----------
+        x : ndarray
+            values (any shape, all the values are used)
+
+        Raises
+        ------
+        ValueError
+            if x contains NaN
+        """
+        x = asarray(x, dtype=float64).ravel()
+        if isnan(x).any():
+            raise ValueError('Cannot compute quantiles of data with NaN')
+
+        pos = x[x >= MIN_ABS_VALUE]
+        neg = -x[x <= -MIN_ABS_VALUE]
+        self._pos = _add_counts(self._pos, self._bin(pos))
+        self._neg = _add_counts(self._neg, self._bin(neg))
+        self.n_zero += x.size - pos.size - neg.size
+        self.n += x.size
+
+    def merge(self, other):
+        """Add the counts of a sketch computed on other samples.
+
+        Parameters
+        ----------
+        other : instance of QuantileSketch
+            sketch with the same relative_accuracy
+
+        Raises
+        ------
+        ValueError
+            if the two sketches have different accuracy
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different accuracy')
+
+        self._pos = _add_counts(self._pos, *other._pos)
+        self._neg = _add_counts(self._neg, *other._neg)
+        self.n_zero += other.n_zero
+        self.n += other.n
+
+    def quantile(self, q):
+        """Compute one quantile.
+
+        Parameters
+        ----------
+        q : float
+            quantile, between 0 and 1 (0.5 is the median)
+
+        Returns
+        -------
+        float
+            approximate value of the quantile (NaN if there are no samples)
+        """
+        if self.n == 0:
+            return float('nan')
+
+        # from the most negative to the most positive value
+        values = concatenate((-self._value(self._neg[0][::-1]), [0.],
+                              self._value(self._pos[0])))
+        counts = concatenate((self._neg[1][::-1], [self.n_zero],
+                              self._pos[1]))
+
+        rank = int(floor(q * (self.n - 1)))
+        return float(values[searchsorted(cumsum(counts), rank, side='right')])
+
+    @property
+    def median(self):
+        """Approximate median."""
+        return self.quantile(.5)
+
+    def _bin(self, x):
+        """Compute the bin of each positive value."""
+        return ceil(log(x) / self._log_gamma).astype(int64)
+
+    def _value(self, bins):
+        """Compute the value of each bin (with the same relative error from
+        both edges)."""
+        return 2 * exp(bins * self._log_gamma) / (self.gamma + 1)
+
+
+class SignalStats:
+    """Statistics used by define_threshold, computed one chunk at the time.
+
+    Parameters
+    ----------
+    relative_accuracy : float
+        maximum relative error of the median (see QuantileSketch)
+
+    Notes
+    -----
+    'mean' and 'std' match numpy.mean and numpy.std to rounding error, while
+    'median' is within relative_accuracy of numpy.median (see QuantileSketch
+    for the exact tolerance). The instance can be passed directly to
+    define_threshold instead of the data.
+    """
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.moments = RunningStats()
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def update(self, x):
+        """Add the samples in x."""
+        self.moments.update(x)
+        self.sketch.update(x)
+
+    def merge(self, other):
+        """Add the statistics computed on other samples (f.e. by another
+        process)."""
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+
+    @property
+    def n(self):
+        """Number of samples."""
+        return self.moments.n
+
+    @property
+    def mean(self):
+        """Mean of the samples."""
+        return self.moments.mean if self.n else float('nan')
+
+    @property
+    def std(self):
+        """Standard deviation of the samples."""
+        return self.moments.std
+
+    @property
+    def median(self):
+        """Approximate median of the samples."""
+        return self.sketch.median
+
+    def quantile(self, q):
+        """Approximate quantile of the samples (q between 0 and 1)."""
+        return self.sketch.quantile(q)
+
+
+def _add_counts(store, bins, counts=None):
+    """Add the counts of some bins to the sorted bins and counts of a store.
+
+    Parameters
+    ----------
+    store : tuple of ndarray
+        sorted bin indices and their counts
+    bins : ndarray
+        bin indices (unsorted, possibly repeated)
+    counts : ndarray, optional
+        count of each element of bins (if None, each element counts as one)
+
+    Returns
+    -------
+    tuple of ndarray
+        sorted bin indices and their counts, after adding the new ones
+    """
+    if len(bins) == 0:
+        return store
+    if counts is None:
+        counts = ones(len(bins), dtype=int64)
+
+    all_bins = concatenate((store[0], bins))
+    all_counts = concatenate((store[1], counts))
+    new_bins, inverse = unique(all_bins, return_inverse=True)
+    new_counts = bincount(inverse, weights=all_counts).astype(int64)
+    return new_bins, new_counts
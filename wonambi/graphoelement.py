@@ -3,9 +3,10 @@
 These graphoelements can be generated by the package "detect".
 
 """
-from copy import deepcopy
+from copy import copy, deepcopy
 
-from numpy import empty, asarray, sum, mean
+from numpy import (asarray, bincount, cumsum, empty, errstate, mean, nan,
+                   split, sum)
 
 from .datatype import Data
 
@@ -17,52 +18,204 @@ class Graphoelement:
     ----------
     chan_name : ndarray (dtype='U')
         list of channels
-        
+    table : ndarray (structured array)
+        one row per event and one field per feature of the events (f.e.
+        'start', 'end', 'peak_val'), with the field 'chan' containing the
+        index of the channel in chan_name
+    events : list of dict
+        one dict per event, with the channel label in 'chan' (it's a view of
+        table: assigning a list of dict to events fills the table)
+
+    Notes
+    -----
+    The events are stored as columns, so selecting events and computing
+    statistics on all of them are done with numpy on the whole table. Iterating
+    over the instance (or over events) creates the dicts one at the time.
+
+    The channel of each event should be in chan_name, so set chan_name
+    before the events.
     """
     def __init__(self):
         self.chan_name = None
-        self.events = []
+        self.table = _events_to_table([], [])
 
     def __iter__(self):
-        for one_event in self.events:
+        fields = [x for x in self.table.dtype.names if x != 'chan']
+        for row in self.table:
+            one_event = {x: row[x] for x in fields}
+            one_event['chan'] = self.chan_name[row['chan']]
             yield one_event
 
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def events(self):
+        return list(self)
+
+    @events.setter
+    def events(self, events):
+        chan_name = self.chan_name
+        if chan_name is None:
+            chan_name = []
+        self.table = _events_to_table(events, chan_name)
+
     def __call__(self, func=None):
+        """Select some of the events.
+
+        Parameters
+        ----------
+        func : function or ndarray
+            if it's a function, it's called on each event (as dict) and the
+            event is kept if it returns True. Otherwise, it's a boolean mask
+            (or indices) on the rows of table, which is much faster, f.e.
+            spindles(spindles.table['dur'] > 1)
 
-        events = []
-        for one_ev in self.events:
-            if func(one_ev):
-                events.append(one_ev)
+        Returns
+        -------
+        instance of the same class
+            copy of the instance, with only the selected events
+        """
+        if callable(func):
+            selected = asarray([bool(func(one_ev)) for one_ev in self],
+                               dtype=bool)
+        else:
+            selected = asarray(func)
 
-        output = deepcopy(self)
-        output.events = events
+        output = copy(self)
+        for k, v in self.__dict__.items():
+            if k != 'table':
+                setattr(output, k, deepcopy(v))
+        output.table = self.table[selected]
 
         return output
 
     def to_data(self, parameter, operator=mean):
+        """Summarize one feature of the events, for each channel.
+
+        Parameters
+        ----------
+        parameter : str
+            'count' (number of events) or one field of the events
+        operator : function
+            function to apply to the values of each channel (mean and sum
+            are computed on all the channels at once)
 
+        Returns
+        -------
+        instance of Data
+            one value for each channel in chan_name (NaN for mean if there
+            are no events in one channel)
+        """
         data = Data()
         data.axis = {'chan': empty(1, dtype='O')}
         data.axis['chan'][0] = self.chan_name
         data.data = empty(1, dtype='O')
 
-        values = []
-        for one_chan in self.chan_name:
-            if parameter == 'count':
-                value = sum(1 for x in self.events if x['chan'] == one_chan)
-            else:
-                value = operator([x[parameter] for x in self.events
-                                  if x['chan'] == one_chan])
-            values.append(value)
+        n_chan = len(self.chan_name)
+        chan = self.table['chan']
+        count = bincount(chan, minlength=n_chan)
+
+        if parameter == 'count':
+            values = count
+
+        elif operator is mean or operator is sum:
+            values = bincount(chan, weights=self.table[parameter],
+                              minlength=n_chan)
+            if operator is mean:
+                with errstate(invalid='ignore', divide='ignore'):
+                    values = values / count
+
+        else:
+            order = chan.argsort(kind='mergesort')
+            by_chan = split(self.table[parameter][order], cumsum(count)[:-1])
+            values = [operator(x) for x in by_chan]
 
         data.data[0] = asarray(values)
         return data
 
 
+def _events_to_table(events, chan_name):
+    """Convert a list of dict into a structured array.
+
+    Parameters
+    ----------
+    events : list of dict
+        events, with the channel label in 'chan' (the other keys are the
+        fields of the table)
+    chan_name : list of str
+        labels of the channels
+
+    Returns
+    -------
+    ndarray (structured array)
+        one row per event, with the index of the channel in 'chan'. If the
+        events do not all have the same keys, the missing values are NaN.
+
+    Raises
+    ------
+    ValueError
+        if the channel of one event is not in chan_name
+    """
+    idx_chan = {label: i for i, label in enumerate(chan_name)}
+
+    fields = []
+    for one_event in events:
+        for k in one_event:
+            if k != 'chan' and k not in fields:
+                fields.append(k)
+
+    try:
+        chan = asarray([idx_chan[one_event['chan']] for one_event in events],
+                       dtype=int)
+    except KeyError as err:
+        raise ValueError('Channel ' + str(err) + ' of the events is not in '
+                         'chan_name')
+
+    columns = [asarray([one_event.get(k, nan) for one_event in events])
+               for k in fields]
+    dtype = ([('chan', int)] +
+             [(k, col.dtype if col.dtype.kind in 'biuf' else 'O')
+              for k, col in zip(fields, columns)])
+
+    table = empty(len(events), dtype=dtype)
+    table['chan'] = chan
+    for k, col in zip(fields, columns):
+        table[k] = col
+
+    return table
+
+
 class Ripple(Graphoelement):
+    """Class containing all the ripples in one dataset.
+
+    Attributes
+    ----------
+    det_value : ndarray (dtype='float')
+        value used for detection for each channel
+    density : ndarray (dtype='float')
+        number of ripples per 30-s epoch for each channel
+    events : list of dict
+        list of ripples, where each ripple contains:
+            - start : float
+                start time of the ripple
+            - end : float
+                end time of the ripple
+            - peak_time : float
+                time of the highest RMS value
+            - peak_val : float
+                the highest RMS value
+            - dur : float
+                duration of the ripple
+            - n_peaks : int
+                number of peaks in the raw signal
+            - chan : str
+                channel label
+    """
     def __init__(self):
         super().__init__()
-        pass
+        self.det_value = None
+        self.density = None
 
 
 class SlowWaves(Graphoelement):
@@ -72,7 +225,7 @@ class SlowWaves(Graphoelement):
     ----------
     events : list of dict
         list of slow waves, where each SW contains:
-            - start_time : float
+            - start : float
                 start time of the SW
             - trough_time : float
                 time of the lowest value
@@ -80,7 +233,7 @@ class SlowWaves(Graphoelement):
                 time of the neg to pos zero-crossing
             - peak_time : float
                 time of the highest value
-            - end_time : float
+            - end : float
                 end time of the SW
             - trough_val : float
                 the lowest value
@@ -92,26 +245,11 @@ class SlowWaves(Graphoelement):
                 sum of all values divided by duration
             - ptp : float
                 peak-to-peak (difference between highest and lowest value)
-            - chan': str
+            - chan : str
                 channel label
-    
     """
     def __init__(self):
         super().__init__()
-        
-        one_sw = {'start_time': None,
-                  'trough_time': None,
-                  'zero_time': None,
-                  'peak_time': None,
-                  'end_time': None,
-                  'trough_val': None,
-                  'peak_val': None,
-                  'dur': None,
-                  'area_under_curve': None,
-                  'ptp': None,
-                  'chan': [],
-                  }
-        self.events.append(one_sw)
 
 
 class Spindles(Graphoelement):
@@ -129,17 +267,16 @@ class Spindles(Graphoelement):
         value used for selection for each channel
     events : list of dict
         list of spindles, where each spindle contains:
-            - start_time : float
+            - start : float
                 start time of the spindle
-            - end_time : float
+            - end : float
                 end time of the spindle
             - peak_time : float
                 time of the highest value
             - peak_val : float
                 the highest value
-            - chan': str
+            - chan : str
                 channel label
-
     """
     def __init__(self):
         super().__init__()
@@ -148,11 +285,3 @@ class Spindles(Graphoelement):
         self.det_value = None
         self.sel_value = None
         self.density = None
-
-        one_spindle = {'start_time': None,
-                       'end_time': None,
-                       'chan': [],
-                       'peak_val': None,
-                       'peak_time': None,
-                       }
-        self.events.append(one_spindle)
@@ -8,7 +8,7 @@ from .egimff import EgiMff
 from .moberg import Moberg
 from .mnefiff import write_mnefiff
 from .fieldtrip import FieldTrip, write_fieldtrip
-from .wonambi import Wonambi, write_wonambi
+from .wonambi import Wonambi, write_wonambi, write_wonambi_header
 from .ieeg_org import IEEG_org
 from .opbox import OpBox
 from .micromed import Micromed
@@ -143,26 +143,65 @@ def write_wonambi(data, filename, subj_id='', dtype='float64'):
     """
     filename = Path(filename)
 
-    json_file = filename.with_suffix('.won')
     memmap_file = filename.with_suffix('.dat')
 
     start_time = data.start_time + timedelta(seconds=data.axis['time'][0][0])
 
+    dataset = write_wonambi_header(filename, subj_id, start_time, data.s_freq,
+                                   list(data.axis['chan'][0]),
+                                   int(data.number_of('time')[0]), dtype)
+
+    memshape = (len(dataset['chan_name']),
+                dataset['n_samples'])
+
+    mem = memmap(str(memmap_file), dtype, mode='w+', shape=memshape, order='F')
+    mem[:, :] = data.data[0]
+    mem.flush()  # not sure if necessary
+
+
+def write_wonambi_header(filename, subj_id, start_time, s_freq, chan_name,
+                         n_samples, dtype='float64'):
+    """Write only the json file of the Wonambi format.
+
+    Parameters
+    ----------
+    filename : path to file
+        file to export to (the extension .won will be added)
+    subj_id : str
+        subject id
+    start_time : datetime
+        start time of the first sample
+    s_freq : float
+        sampling frequency
+    chan_name : list of str
+        list of all the channels
+    n_samples : int
+        number of samples in the .dat file
+    dtype : str
+        numpy dtype of the .dat file
+
+    Returns
+    -------
+    dict
+        the content of the json file
+
+    Notes
+    -----
+    This is useful when the .dat file is written in chunks, and not all at
+    once as in write_wonambi.
+    """
+    json_file = Path(filename).with_suffix('.won')
+
     start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S.%f')
     dataset = {'subj_id': subj_id,
                'start_time': start_time_str,
-               's_freq': data.s_freq,
-               'chan_name': list(data.axis['chan'][0]),
-               'n_samples': int(data.number_of('time')[0]),
+               's_freq': s_freq,
+               'chan_name': chan_name,
+               'n_samples': n_samples,
                'dtype': dtype,
                }
 
     with json_file.open('w') as f:
         dump(dataset, f, sort_keys=True, indent=4)
 
-    memshape = (len(dataset['chan_name']),
-                dataset['n_samples'])
-
-    mem = memmap(str(memmap_file), dtype, mode='w+', shape=memshape, order='F')
-    mem[:, :] = data.data[0]
-    mem.flush()  # not sure if necessary
+    return dataset
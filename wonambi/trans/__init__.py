@@ -6,12 +6,14 @@ use this package to transform to other classes. If you want to transform to
 basic elements, use the package "detect" for example.
 
 """
-from .filter import filter_, convolve
+from .filter import filter_, filter_dataset, convolve
 from .select import select, resample
-from .frequency import frequency, timefrequency
+from .frequency import (frequency, timefrequency, welch_dataset,
+                        epoch_bandpower)
 from .merge import concatenate
 from .math import math
 from .montage import montage
 from .peaks import peaks
+from .envelope import analytic, moving_window
 from .reject import rejectbadchan
 
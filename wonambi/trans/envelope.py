@@ -0,0 +1,220 @@
+"""Module to compute the envelope and sliding-window statistics of the data,
+on all the channels (and any other dimension) at once.
+"""
+from logging import getLogger
+from math import floor
+
+from numpy import (angle, absolute, arange, cumsum, float64, minimum, maximum,
+                   moveaxis, nan, result_type, sqrt, zeros)
+from scipy.fftpack import fft, ifft, next_fast_len
+from scipy.ndimage import maximum_filter1d
+
+lg = getLogger(__name__)
+
+
+def analytic(data, output='envelope', axis='time', dtype=None):
+    """Compute the analytic signal (Hilbert transform) along one axis.
+
+    Parameters
+    ----------
+    data : instance of Data
+        data to transform (all the dimensions are transformed at once)
+    output : str
+        'complex' (analytic signal), 'envelope' (its absolute value) or
+        'phase' (its angle, in radians)
+    axis : str
+        axis to compute the analytic signal on (most likely 'time')
+    dtype : str or numpy.dtype, optional
+        if 'float32' (or 'complex64'), the FFT is computed in single
+        precision, which is faster and takes half the memory.
+
+    Returns
+    -------
+    instance of Data
+        data with the same shape as the input
+
+    Raises
+    ------
+    ValueError
+        if output is not one of the possible values
+    """
+    if output not in ('complex', 'envelope', 'phase'):
+        raise ValueError('output should be "complex", "envelope" or "phase", '
+                         'not "' + output + '"')
+
+    idx_axis = data.index_of(axis)
+    out = data._copy()
+    for i in range(data.number_of('trial')):
+        x = data.data[i]
+        if dtype is not None:
+            x = x.astype(dtype, copy=False)
+
+        x = compute_analytic(x, axis=idx_axis)
+        if output == 'envelope':
+            x = absolute(x)
+        elif output == 'phase':
+            x = angle(x)
+        out.data[i] = x
+
+    return out
+
+
+def moving_window(data, duration, method='rms', axis='time', dtype=None):
+    """Compute mean, RMS or max in a sliding window centered on each sample.
+
+    Parameters
+    ----------
+    data : instance of Data
+        data to transform (all the dimensions are transformed at once)
+    duration : float
+        duration of the window, in the unit of the axis (s for 'time')
+    method : str
+        'mean', 'rms' or 'max'
+    axis : str
+        axis to slide the window on (most likely 'time')
+    dtype : str or numpy.dtype, optional
+        dtype of the output (f.e. 'float32')
+
+    Returns
+    -------
+    instance of Data
+        data with the same shape as the input
+
+    Notes
+    -----
+    The window has 2 * floor(s_freq * duration / 2) samples (for axes other
+    than 'time', s_freq is computed from the values of the axis). See
+    compute_moving for how the window is defined at the edges.
+    """
+    idx_axis = data.index_of(axis)
+    out = data._copy()
+    for i in range(data.number_of('trial')):
+        if axis == 'time':
+            s_freq = data.s_freq
+        else:
+            values = data.axis[axis][i]
+            s_freq = (len(values) - 1) / (values[-1] - values[0])
+        halfwidth = int(floor(s_freq * duration / 2))
+        x = compute_moving(data.data[i], halfwidth, method=method,
+                           axis=idx_axis)
+        if dtype is not None:
+            x = x.astype(dtype, copy=False)
+        out.data[i] = x
+
+    return out
+
+
+def compute_analytic(x, axis=-1):
+    """Compute the analytic signal of an array along one axis.
+
+    Parameters
+    ----------
+    x : ndarray
+        real data (float32 data is transformed in single precision)
+    axis : int
+        axis to transform
+
+    Returns
+    -------
+    ndarray
+        complex analytic signal, with the same shape as x
+
+    Notes
+    -----
+    The data is zero-padded to next_fast_len along the axis, which makes the
+    FFT much faster for lengths with large prime factors. Because of the
+    padding, the values close to the edges can differ slightly from
+    scipy.signal.hilbert, which does not pad.
+    """
+    n_smp = x.shape[axis]
+    n_fft = next_fast_len(n_smp)
+
+    xf = fft(x, n_fft, axis=axis)
+    h = zeros(n_fft, dtype=xf.real.dtype)
+    if n_fft % 2 == 0:
+        h[0] = h[n_fft // 2] = 1
+        h[1:n_fft // 2] = 2
+    else:
+        h[0] = 1
+        h[1:(n_fft + 1) // 2] = 2
+
+    shape = [1] * x.ndim
+    shape[axis] = n_fft
+    xf *= h.reshape(shape)
+
+    analytic = ifft(xf, axis=axis, overwrite_x=True)
+    index = [slice(None)] * x.ndim
+    index[axis] = slice(0, n_smp)
+    return analytic[tuple(index)]
+
+
+def compute_moving(x, halfwidth, method='rms', axis=-1):
+    """Compute a statistic in a sliding window, along one axis.
+
+    Parameters
+    ----------
+    x : ndarray
+        data
+    halfwidth : int
+        half of the window length, in samples
+    method : str
+        'mean', 'rms' or 'max'
+    axis : int
+        axis to slide the window on
+
+    Returns
+    -------
+    ndarray
+        data with the same shape as x (at least float64 for 'mean' and
+        'rms')
+
+    Raises
+    ------
+    ValueError
+        if method is not one of the possible values
+
+    Notes
+    -----
+    The window for sample i goes from i - halfwidth (included) to
+    i + halfwidth (excluded), cut at the edges of the data, and the statistic
+    is computed on the samples in the window (so it's not zero-padded). If
+    halfwidth is 0, the window is empty and the output is NaN.
+
+    'mean' and 'rms' use the cumulative sum (in double precision), so the
+    computation time does not depend on the window length.
+    """
+    if method not in ('mean', 'rms', 'max'):
+        raise ValueError('method should be "mean", "rms" or "max", not "' +
+                         method + '"')
+
+    n_smp = x.shape[axis]
+    if halfwidth < 1:
+        out = zeros(x.shape)
+        out.fill(nan)
+        return out
+
+    if method == 'max':
+        return maximum_filter1d(x, size=2 * halfwidth, axis=axis,
+                                mode='nearest')
+
+    x = moveaxis(x, axis, -1)
+    if method == 'rms':
+        csum = zeros(x.shape[:-1] + (n_smp + 1, ), dtype=float64)
+        cumsum(absolute(x) ** 2, axis=-1, out=csum[..., 1:])
+    else:
+        csum = zeros(x.shape[:-1] + (n_smp + 1, ),
+                     dtype=result_type(x.dtype, float64))
+        cumsum(x, axis=-1, out=csum[..., 1:])
+
+    idx = arange(n_smp)
+    first = maximum(idx - halfwidth, 0)
+    last = minimum(idx + halfwidth, n_smp)
+
+    out = csum[..., last]
+    out -= csum[..., first]
+    out /= last - first
+    if method == 'rms':
+        maximum(out, 0, out=out)  # rounding errors can make it negative
+        sqrt(out, out=out)
+
+    return moveaxis(out, -1, axis)
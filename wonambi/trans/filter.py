@@ -1,17 +1,24 @@
 """Module to filter the data.
 """
+from datetime import timedelta
+from functools import lru_cache
 from logging import getLogger
+from pathlib import Path
 
-from itertools import product
+from numpy import concatenate, float64, iscomplexobj, memmap
+from numpy.fft import fft, ifft, irfft, rfft
+from scipy.fftpack import next_fast_len
+from scipy.signal import (iirfilter, filtfilt, get_window, sosfilt,
+                          sosfilt_zi, sosfiltfilt)
 
-from numpy import empty, ix_, expand_dims, squeeze
-from scipy.signal import iirfilter, filtfilt, get_window, fftconvolve
+from ..dataset import Dataset
+from ..ioeeg import write_wonambi_header
 
 lg = getLogger(__name__)
 
 
 def filter_(data, axis='time', low_cut=None, high_cut=None, order=4,
-            ftype='butter', Rs=None):
+            ftype='butter', Rs=None, sos=True, dtype=None):
     """Design filter and apply it.
 
     Parameters
@@ -28,6 +35,13 @@ def filter_(data, axis='time', low_cut=None, high_cut=None, order=4,
         the data to filter.
     axis : str, optional
         axis to apply the filter on.
+    sos : bool, optional
+        use second-order sections (sosfiltfilt) instead of the transfer
+        function (filtfilt). It is more stable for high orders and for low
+        cutoffs.
+    dtype : str, optional
+        dtype of the filtered data, such as 'float32' (to save memory). If
+        None, it uses the default of scipy.
 
     Returns
     -------
@@ -45,12 +59,252 @@ def filter_(data, axis='time', low_cut=None, high_cut=None, order=4,
     low_cut and high_cut should be given as ratio of the Nyquist. But if you
     specify s_freq, then the ratio will be computed automatically.
 
+    The filter design is cached, so that the same filter is computed only
+    once, even if you call filter_ on each channel group or on each page.
+
     Raises
     ------
     ValueError
         if the cutoff frequency is larger than the Nyquist frequency.
     """
-    nyquist = data.s_freq / 2.
+    Wn, btype = _compute_cutoff(data.s_freq, low_cut, high_cut)
+
+    if Rs is None:
+        Rs = 40
+
+    lg.debug('order {0: 2}, Wn {1}, btype {2}, ftype {3}'
+             ''.format(order, str(Wn), btype, ftype))
+    coef = design_filter(order, Wn, btype, ftype, Rs, data.s_freq, sos)
+
+    fdata = data._copy()
+    for i in range(data.number_of('trial')):
+        dat = data.data[i]
+        if dtype is not None:
+            dat = dat.astype(dtype, copy=False)
+
+        # the cached coefficients are read-only, which scipy does not accept
+        if sos:
+            dat = sosfiltfilt(coef.copy(), dat, axis=data.index_of(axis))
+        else:
+            dat = filtfilt(coef[0].copy(), coef[1].copy(), dat,
+                           axis=data.index_of(axis))
+
+        if dtype is not None:
+            dat = dat.astype(dtype, copy=False)
+        fdata.data[i] = dat
+
+    return fdata
+
+
+@lru_cache(maxsize=64)
+def design_filter(order, Wn, btype, ftype, Rs, s_freq, sos=True):
+    """Design the IIR filter and keep it in memory.
+
+    Parameters
+    ----------
+    order : int
+        filter order
+    Wn : float or tuple of float
+        cutoff(s) as ratio of the Nyquist frequency
+    btype : str
+        'bandpass', 'highpass' or 'lowpass'
+    ftype : str
+        'butter', 'cheby1', 'cheby2', 'ellip', 'bessel'
+    Rs : float
+        minimum attenuation in the stop band (for cheby2 and ellip)
+    s_freq : float
+        sampling frequency (only used to identify the filter)
+    sos : bool
+        return second-order sections instead of (b, a)
+
+    Returns
+    -------
+    ndarray or tuple of ndarray
+        n_sections X 6 matrix if sos, otherwise numerator and denominator.
+
+    Notes
+    -----
+    The output is shared between calls, so it's read-only. Some functions in
+    scipy.signal (f.e. sosfilt) do not accept read-only arrays, so pass them a
+    copy.
+    """
+    if sos:
+        coef = iirfilter(order, Wn, btype=btype, ftype=ftype, rs=Rs,
+                         output='sos')
+        coef.setflags(write=False)
+    else:
+        coef = iirfilter(order, Wn, btype=btype, ftype=ftype, rs=Rs)
+        for one_coef in coef:
+            one_coef.setflags(write=False)
+
+    return coef
+
+
+def filter_dataset(data, filename, low_cut=None, high_cut=None, order=4,
+                   ftype='butter', Rs=None, chan=None, duration=60,
+                   dtype='float64', subj_id=''):
+    """Filter a whole recording in chunks and write it in Wonambi format.
+
+    Parameters
+    ----------
+    data : instance of Dataset or iterable of ChanTime
+        recording to filter. If it's an iterable, it should return
+        consecutive chunks, with one trial and the same channels.
+    filename : path to file
+        file to write (the extensions .won and .dat will be added)
+    low_cut : float, optional
+        low cutoff for high-pass filter
+    high_cut : float, optional
+        high cutoff for low-pass filter
+    order : int, optional
+        filter order
+    ftype : str
+        'butter', 'cheby1', 'cheby2', 'ellip', 'bessel'
+    Rs : float
+        minimum attenuation in the stop band (for cheby2 and ellip)
+    chan : list of str, optional
+        channels to read (only if data is a Dataset)
+    duration : float
+        duration of each chunk in s (only if data is a Dataset)
+    dtype : str
+        numpy dtype of the filtered data on disk
+    subj_id : str
+        subject id
+
+    Returns
+    -------
+    instance of Dataset
+        the filtered recording, memory-mapped from disk
+
+    Notes
+    -----
+    It gives the same results as filter_ (with sos=True), but the memory
+    depends only on the size of the chunks, not on the length of the
+    recording. The forward pass is written to disk and the backward pass is
+    computed from the end of the file, chunk by chunk. The filter state is
+    carried over from one chunk to the next one, so there are no transients
+    at the chunk boundaries, and the edges of the recordings are padded
+    exactly like in sosfiltfilt.
+    """
+    if isinstance(data, Dataset):
+        s_freq = data.header['s_freq']
+        chunks = data.read_chunks(chan=chan, duration=duration)
+    else:
+        chunks = iter(data)
+        first_chunk = next(chunks)
+        s_freq = first_chunk.s_freq
+        chunks = _chain_chunks(first_chunk, chunks)
+
+    Wn, btype = _compute_cutoff(s_freq, low_cut, high_cut)
+    if Rs is None:
+        Rs = 40
+    # writable copy, because sosfilt does not accept read-only arrays
+    sos = design_filter(order, Wn, btype, ftype, Rs, s_freq, True).copy()
+
+    # same padding as sosfiltfilt
+    edge = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(),
+                                       (sos[:, 5] == 0).sum()))
+    zi = sosfilt_zi(sos)[:, None, :]
+
+    filename = Path(filename)
+    memmap_file = filename.with_suffix('.dat')
+    if dtype == 'float64':
+        fwd_file = memmap_file
+    else:
+        fwd_file = filename.with_suffix('.fwd')
+
+    # forward pass, appended to disk
+    zi_fwd = None
+    tail = None
+    n_samples = 0
+    with fwd_file.open('wb') as f:
+        for chunk in chunks:
+            x = chunk.data[0]
+
+            if zi_fwd is None:
+                if x.shape[1] <= edge:
+                    raise ValueError('The first chunk should be longer than ' +
+                                     str(edge) + ' samples')
+                chan_name = list(chunk.axis['chan'][0])
+                start_time = (chunk.start_time +
+                              timedelta(seconds=chunk.axis['time'][0][0]))
+                left = 2 * x[:, :1] - x[:, edge:0:-1]
+                _, zi_fwd = sosfilt(sos, left, zi=zi * left[:, :1])
+                tail = x[:, :0]
+
+            y, zi_fwd = sosfilt(sos, x, zi=zi_fwd)
+            f.write(y.astype(float64).tobytes(order='F'))
+
+            tail = concatenate((tail, x), axis=1)[:, -(edge + 1):]
+            n_samples += x.shape[1]
+
+    if zi_fwd is None:
+        raise ValueError('There are no data to filter')
+
+    right = 2 * tail[:, -1:] - tail[:, -2::-1]
+    y_right, _ = sosfilt(sos, right, zi=zi_fwd)
+
+    # backward pass, from the end of the file
+    memshape = (len(chan_name), n_samples)
+    fwd = memmap(str(fwd_file), float64, mode='r+', shape=memshape,
+                 order='F')
+    if fwd_file == memmap_file:
+        out = fwd
+    else:
+        out = memmap(str(memmap_file), dtype, mode='w+', shape=memshape,
+                     order='F')
+
+    _, zi_bwd = sosfilt(sos, y_right[:, ::-1], zi=zi * y_right[:, -1:])
+    n_smp = max(int(duration * s_freq), edge + 1)
+    for endsam in range(n_samples, 0, -n_smp):
+        begsam = max(endsam - n_smp, 0)
+        y, zi_bwd = sosfilt(sos, fwd[:, begsam:endsam][:, ::-1], zi=zi_bwd)
+        out[:, begsam:endsam] = y[:, ::-1]
+
+    out.flush()
+    del fwd, out
+    if fwd_file != memmap_file:
+        fwd_file.unlink()
+
+    write_wonambi_header(filename, subj_id, start_time, s_freq, chan_name,
+                         n_samples, dtype)
+
+    return Dataset(filename.with_suffix('.won'))
+
+
+def _chain_chunks(first_chunk, chunks):
+    """Put back the first chunk, which was used to read the header."""
+    yield first_chunk
+    yield from chunks
+
+
+def _compute_cutoff(s_freq, low_cut, high_cut):
+    """Convert the cutoff frequencies into ratio of the Nyquist frequency.
+
+    Parameters
+    ----------
+    s_freq : float
+        sampling frequency
+    low_cut : float or None
+        low cutoff for high-pass filter
+    high_cut : float or None
+        high cutoff for low-pass filter
+
+    Returns
+    -------
+    float or tuple of float
+        cutoff(s) as ratio of the Nyquist frequency
+    str
+        'bandpass', 'highpass' or 'lowpass'
+
+    Raises
+    ------
+    ValueError
+        if the cutoff frequency is larger than the Nyquist frequency.
+    TypeError
+        if neither low_cut nor high_cut are specified.
+    """
+    nyquist = s_freq / 2.
 
     btype = None
     if low_cut is not None and high_cut is not None:
@@ -79,19 +333,7 @@ def filter_(data, axis='time', low_cut=None, high_cut=None, order=4,
     if not btype:
         raise TypeError('You should specify at least low_cut or high_cut')
 
-    if Rs is None:
-        Rs = 40
-
-    lg.debug('order {0: 2}, Wn {1}, btype {2}, ftype {3}'
-             ''.format(order, str(Wn), btype, ftype))
-    b, a = iirfilter(order, Wn, btype=btype, ftype=ftype, rs=Rs)
-
-    fdata = data._copy()
-    for i in range(data.number_of('trial')):
-        fdata.data[i] = filtfilt(b, a,
-                                 data.data[i],
-                                 axis=data.index_of(axis))
-    return fdata
+    return Wn, btype
 
 
 def convolve(data, window, axis='time', length=1):
@@ -115,9 +357,10 @@ def convolve(data, window, axis='time', length=1):
 
     Notes
     -----
-    Most of the code is identical to fftconvolve(axis=data.index_of(axis))
-    but unfortunately fftconvolve in scipy 0.13 doesn't take that argument
-    so we need to redefine it here. It's pretty slow too.
+    The convolution is computed in the frequency domain, on all the other
+    dimensions at once (channels, frequencies, etc). The FFT of the taper is
+    computed only once for each FFT length, so trials with the same number
+    of samples share it.
 
     Taper is normalized such that the integral of the function remains the
     same even after convolution.
@@ -126,37 +369,37 @@ def convolve(data, window, axis='time', length=1):
     --------
     scipy.signal.get_window : function used to create windows
     """
-    taper = get_window(window, length * data.s_freq)
+    taper = get_window(window, int(length * data.s_freq))
     taper = taper / sum(taper)
 
     fdata = data._copy()
     idx_axis = data.index_of(axis)
 
+    taper_fft = {}
     for i in range(data.number_of('trial')):
-        orig_dat = data.data[i]
-
-        sel_dim = []
-        i_dim = []
-        dat = empty(orig_dat.shape, dtype=orig_dat.dtype)
-        for i_axis, one_axis in enumerate(data.list_of_axes):
-            if one_axis != axis:
-                i_dim.append(i_axis)
-                sel_dim.append(range(data.number_of(one_axis)[i]))
-
-        for one_iter in product(*sel_dim):
-            # create the numpy indices for one value per dimension,
-            # except for the dimension of interest
-            idx = [[x] for x in one_iter]
-            idx.insert(idx_axis, range(data.number_of(axis)[i]))
-            indices = ix_(*idx)
-
-            d_1dim = squeeze(orig_dat[indices], axis=i_dim)
-
-            d_1dim = fftconvolve(d_1dim, taper, 'same')
-
-            for to_squeeze in i_dim:
-                d_1dim = expand_dims(d_1dim, axis=to_squeeze)
-                dat[indices] = d_1dim
-        fdata.data[0] = dat
+        dat = data.data[i]
+        n_smp = dat.shape[idx_axis]
+        nfft = next_fast_len(n_smp + len(taper) - 1)
+
+        is_complex = iscomplexobj(dat)
+        if is_complex:
+            fft_func, ifft_func = fft, ifft
+        else:
+            fft_func, ifft_func = rfft, irfft
+
+        if (nfft, is_complex) not in taper_fft:
+            taper_shape = [1] * dat.ndim
+            taper_shape[idx_axis] = -1
+            taper_fft[nfft, is_complex] = fft_func(taper,
+                                                   nfft).reshape(taper_shape)
+
+        conv = ifft_func(fft_func(dat, nfft, axis=idx_axis) *
+                         taper_fft[nfft, is_complex], nfft, axis=idx_axis)
+
+        # same as mode='same' in fftconvolve
+        beg = (len(taper) - 1) // 2
+        idx = [slice(None)] * dat.ndim
+        idx[idx_axis] = slice(beg, beg + n_smp)
+        fdata.data[i] = conv[tuple(idx)]
 
     return fdata
@@ -1,21 +1,33 @@
 """Module to compute frequency representation.
 """
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import lru_cache
+from hashlib import sha1
 from logging import getLogger
+from math import ceil
+from os import close
+from pathlib import Path
+from tempfile import mkstemp
 from warnings import warn
 
-from numpy import (arange, array, empty, exp, inf, max, mean, pi, real, sqrt,
-                   swapaxes)
+from numpy import (absolute, add, append, arange, array, array_split,
+                   ascontiguousarray, asarray, atleast_1d, atleast_2d, diff,
+                   dot, empty, exp, hstack, inf, load, max, mean, memmap,
+                   moveaxis, nan, ones, pi, prod, real, save, sqrt, stack,
+                   swapaxes, trapz, zeros)
+from numpy.fft import fft, ifft, rfft, rfftfreq
+from numpy.lib.stride_tricks import as_strided
 from numpy.linalg import norm
-from scipy.signal import welch, fftconvolve, spectrogram
-try:
-    from mne.time_frequency.multitaper import multitaper_psd
-except ImportError:
-    pass
+from scipy.fftpack import next_fast_len
+from scipy.signal import (detrend as detrend_func, get_window, welch,
+                          spectrogram)
+from scipy.signal.windows import dpss
 
-from ..datatype import ChanFreq, ChanTimeFreq
+from ..datatype import ChanFreq, ChanTimeFreq, Data
 
 lg = getLogger(__name__)
+MAX_MULTITAPER_BYTES = 100 * 1024 ** 2  # memory for one batch of FFTs
 
 
 def frequency(data, method='welch', **options):
@@ -57,6 +69,25 @@ def frequency(data, method='welch', **options):
 
         The output is real PSD, not complex, because of
         https://github.com/scipy/scipy/issues/5757
+
+    For method 'multitaper', the following options should be specified:
+        fmin : float
+            lowest frequency of interest
+        fmax : float
+            highest frequency of interest
+        bandwidth : float
+            frequency bandwidth of the tapers, in Hz (if None, the
+            half-bandwidth in number of frequency bins is 4)
+        adaptive : bool
+            use adaptive weights to combine the tapers
+        low_bias : bool
+            only use tapers with more than 90% spectral concentration
+        normalization : str
+            'full' to get the power spectral density, 'length' to normalize
+            only by the number of time points
+
+        The DPSS tapers are cached and all the trials with the same length
+        (and all their channels and tapers) are transformed with one FFT.
     """
     implemented_methods = ('welch', 'multitaper')
 
@@ -97,8 +128,8 @@ def frequency(data, method='welch', **options):
     freq.axis['freq'] = empty(data.number_of('trial'), dtype='O')
     freq.data = empty(data.number_of('trial'), dtype='O')
 
-    for i in range(data.number_of('trial')):
-        if method == 'welch':
+    if method == 'welch':
+        for i in range(data.number_of('trial')):
             nperseg = int(options['duration'] * data.s_freq)
             noverlap = int(options['overlap'] * nperseg)
             f, Pxx = welch(data(trial=i),
@@ -107,24 +138,597 @@ def frequency(data, method='welch', **options):
                            noverlap=noverlap,
                            scaling=options['scaling'],
                            axis=idx_time)
+            freq.axis['freq'][i] = f
+            freq.data[i] = Pxx
+
+    elif method == 'multitaper':
+        # trials with the same shape are stacked together
+        trial_groups = {}
+        for i in range(data.number_of('trial')):
+            trial_groups.setdefault(data.data[i].shape, []).append(i)
 
-        elif method == 'multitaper':
-            Pxx, f = multitaper_psd(data(trial=i),
-                                    sfreq=data.s_freq,
-                                    fmin=options['fmin'],
-                                    fmax=options['fmax'],
-                                    bandwidth=options['bandwidth'],
-                                    adaptive=options['adaptive'],
-                                    low_bias=options['low_bias'],
-                                    normalization=options['normalization'],
-                                    n_jobs=2)
-        freq.axis['freq'][i] = f
-        freq.data[i] = Pxx
+        for shape, trials in trial_groups.items():
+            n_times = shape[idx_time]
+            n_batch = _multitaper_batch_size(shape, n_times, data.s_freq,
+                                             options)
+            for i_beg in range(0, len(trials), n_batch):
+                batch = trials[i_beg:i_beg + n_batch]
+                x = stack([data.data[i] for i in batch])
+                x = moveaxis(x, idx_time + 1, -1)
+                f, Pxx = _multitaper(x, data.s_freq, **options)
+                Pxx = moveaxis(Pxx, -1, idx_time + 1)
+
+                for i, one_Pxx in zip(batch, Pxx):
+                    freq.axis['freq'][i] = f
+                    freq.data[i] = one_Pxx
 
     return freq
 
 
-def timefrequency(data, method='morlet', time_skip=1, **options):
+def _multitaper(x, s_freq, fmin=0, fmax=inf, bandwidth=None, adaptive=False,
+                low_bias=True, normalization='full'):
+    """Compute the multitaper power spectrum along the last dimension.
+
+    Parameters
+    ----------
+    x : ndarray
+        data, with time as the last dimension
+    s_freq : float
+        sampling frequency
+    fmin, fmax, bandwidth, adaptive, low_bias, normalization
+        see frequency
+
+    Returns
+    -------
+    ndarray
+        vector with the frequencies
+    ndarray
+        power spectrum, with frequency as the last dimension
+    """
+    n_times = x.shape[-1]
+    tapers, eigvals = _dpss_tapers(n_times, *_multitaper_params(n_times,
+                                                                s_freq,
+                                                                bandwidth),
+                                   low_bias)
+
+    f = rfftfreq(n_times, 1 / s_freq)
+    freq_mask = (f >= fmin) & (f <= fmax)
+
+    x = x - x.mean(axis=-1, keepdims=True)
+    x_mt = rfft(x[..., None, :] * tapers, axis=-1)
+
+    # one-sided spectrum: do not double DC and Nyquist
+    one_side = 2 * ones(len(f))
+    one_side[0] = 1
+    if n_times % 2 == 0:
+        one_side[-1] = 1
+
+    sk = (x_mt.real ** 2 + x_mt.imag ** 2) * one_side
+    if adaptive and len(eigvals) > 1:
+        # the variance of the signal needs the whole spectrum
+        x_var = trapz(_psd_weighted(sk, eigvals[:, None]), dx=pi / len(f),
+                      axis=-1) / (2 * pi)
+        psd = _psd_adaptive(sk[..., freq_mask], eigvals, x_var)
+    else:
+        psd = _psd_weighted(sk[..., freq_mask], eigvals[:, None])
+
+    if normalization == 'full':
+        psd /= s_freq
+
+    return f[freq_mask], psd
+
+
+def _multitaper_params(n_times, s_freq, bandwidth):
+    """Return time-halfbandwidth product and number of tapers."""
+    if bandwidth is None:
+        half_nbw = 4.
+    else:
+        half_nbw = float(bandwidth) * n_times / (2 * s_freq)
+    n_tapers = max((int(2 * half_nbw), 1))
+    return half_nbw, n_tapers
+
+
+@lru_cache(maxsize=32)
+def _dpss_tapers(n_times, half_nbw, n_tapers, low_bias):
+    """Compute the DPSS tapers and keep them in memory.
+
+    Parameters
+    ----------
+    n_times : int
+        number of time points
+    half_nbw : float
+        standardized half-bandwidth (NW)
+    n_tapers : int
+        maximum number of tapers (K)
+    low_bias : bool
+        only keep the tapers with more than 90% spectral concentration
+
+    Returns
+    -------
+    ndarray
+        nTapers X nTimes matrix, with unit-energy tapers
+    ndarray
+        vector with the spectral concentration of each taper
+
+    Notes
+    -----
+    The output is shared between calls, so it's read-only.
+    """
+    tapers, eigvals = dpss(n_times, half_nbw, n_tapers, return_ratios=True)
+    tapers = atleast_2d(tapers)
+    eigvals = atleast_1d(eigvals)
+
+    if low_bias:
+        idx = eigvals > 0.9
+        if not idx.any():
+            idx = [eigvals.argmax()]
+        tapers = tapers[idx, :]
+        eigvals = eigvals[idx]
+
+    tapers.setflags(write=False)
+    eigvals.setflags(write=False)
+    return tapers, eigvals
+
+
+def _psd_weighted(sk, weights):
+    """Combine the spectra of the tapers with weights.
+
+    Parameters
+    ----------
+    sk : ndarray
+        spectra for each taper, with dimensions (..., taper, freq)
+    weights : ndarray
+        weights for each taper, with dimensions (taper, freq) or
+        (..., taper, freq)
+
+    Returns
+    -------
+    ndarray
+        power spectrum, with dimensions (..., freq)
+    """
+    return (weights * sk).sum(axis=-2) / weights.sum(axis=-2)
+
+
+def _psd_adaptive(sk, eigvals, x_var, max_iter=150):
+    """Combine the spectra of the tapers with adaptive weights.
+
+    Parameters
+    ----------
+    sk : ndarray
+        spectra for each taper, with dimensions (..., taper, freq)
+    eigvals : ndarray
+        spectral concentration of the tapers
+    x_var : ndarray
+        variance of each signal, with dimensions (...)
+    max_iter : int
+        maximum number of iterations
+
+    Returns
+    -------
+    ndarray
+        power spectrum, with dimensions (..., freq)
+
+    Notes
+    -----
+    Thomson's adaptive weights, where the weights of each taper depend on
+    the ratio between the power spectrum and the broadband bias (estimated
+    from the variance of the signal). All the signals are computed at once,
+    and the iteration stops when all of them have converged.
+
+    References
+    ----------
+    Percival, D. B. & Walden, A. T. Spectral Analysis for Physical
+    Applications (1993).
+    """
+    eigvals = eigvals[:, None]
+    x_var = x_var[..., None, None]
+
+    # start with the first two tapers
+    psd = _psd_weighted(sk[..., :2, :], eigvals[:2])
+    old_weights = zeros(sk.shape)
+    for i in range(max_iter):
+        d_k = psd[..., None, :] / (eigvals * psd[..., None, :] +
+                                   (1 - eigvals) * x_var)
+        weights = d_k ** 2 * eigvals
+        if (((weights - old_weights) ** 2).mean(axis=-2) < 1e-10).all():
+            break
+        psd = _psd_weighted(sk, weights)
+        old_weights = weights
+
+    else:
+        warn('Adaptive multitaper did not converge')
+
+    return psd
+
+
+def _multitaper_batch_size(shape, n_times, s_freq, options):
+    """Number of trials whose multitaper FFT fits in MAX_MULTITAPER_BYTES."""
+    half_nbw, n_tapers = _multitaper_params(n_times, s_freq,
+                                            options['bandwidth'])
+    n_bytes = 16 * n_tapers * prod(shape)
+    return max((int(MAX_MULTITAPER_BYTES // n_bytes), 1))
+
+
+def welch_dataset(dataset, chan=None, annot=None, stage=None,
+                  reject_bad=True, keep_epochs=False, duration=1, overlap=0.5,
+                  window='hann', detrend='constant', scaling='density',
+                  chunk=60):
+    """Compute the Welch power spectrum of a whole recording, in one pass.
+
+    Parameters
+    ----------
+    dataset : instance of Dataset
+        recording to analyze
+    chan : list of str, optional
+        channels of interest (if None, all the channels)
+    annot : instance of Annotations, optional
+        if specified, the power spectrum is computed for each stage, and the
+        Welch segments never cross the edges of the epochs
+    stage : list of str, optional
+        stages of interest (only if annot is specified). If None, all the
+        stages in the annotations.
+    reject_bad : bool
+        do not include the epochs whose quality is 'Bad'
+    keep_epochs : bool
+        also return the power spectrum for each epoch
+    duration : float
+        duration of the window to compute the power spectrum, in s
+    overlap : float
+        amount of overlap (0 -> no overlap, 1 -> full overlap)
+    window : str or tuple or array
+        desired window to use
+    detrend : str or function or False
+        specifies how to detrend each segment
+    scaling : str
+        you can choose between density (V**2/Hz) or spectrum (V**2)
+    chunk : float
+        duration in s of the data which are read at once
+
+    Returns
+    -------
+    instance of ChanFreq
+        one trial for each stage (or one trial for the whole recording, if
+        annot is None). The name of the stages are in attr['stage'].
+    instance of ChanFreq
+        only if keep_epochs, one trial for each epoch. The epochs (with
+        start, end, stage and quality) are in attr['epochs'].
+
+    Notes
+    -----
+    The periodograms of the segments are summed chunk by chunk (the samples
+    at the end of each chunk are carried over to the next chunk), so the
+    memory depends on the size of the chunk, not on the duration of the
+    recording. Without annotations, the results are the same as
+    frequency(method='welch') on the whole recording.
+    """
+    s_freq = dataset.header['s_freq']
+    if chan is None:
+        chan = dataset.header['chan_name']
+
+    nperseg = int(duration * s_freq)
+    step = nperseg - int(overlap * nperseg)
+    n_chunk = max((int(chunk * s_freq) // step, 1)) * step
+
+    win = get_window(window, nperseg)
+    if scaling == 'density':
+        scale = 1 / (s_freq * (win ** 2).sum())
+    elif scaling == 'spectrum':
+        scale = 1 / win.sum() ** 2
+    else:
+        raise ValueError('Unknown scaling: ' + str(scaling))
+    freq_axis = rfftfreq(nperseg, 1 / s_freq)
+
+    if annot is None:
+        epochs = [{'start': 0,
+                   'end': dataset.header['n_samples'] / s_freq,
+                   'stage': None,
+                   'quality': None,
+                   }]
+    else:
+        epochs = [ep for ep in annot.epochs
+                  if (stage is None or ep['stage'] in stage) and
+                  not (reject_bad and ep['quality'] == 'Bad')]
+
+    if stage is None:
+        groups = []
+        for ep in epochs:
+            if ep['stage'] not in groups:
+                groups.append(ep['stage'])
+    else:
+        groups = list(stage)
+
+    psd_sum = zeros((len(groups), len(chan), len(freq_axis)))
+    psd_count = zeros(len(groups))
+    epoch_psd = []
+
+    for ep in epochs:
+        begsam = int(round(ep['start'] * s_freq))
+        endsam = min((int(round(ep['end'] * s_freq)),
+                      dataset.header['n_samples']))
+
+        ep_sum = zeros((len(chan), len(freq_axis)))
+        ep_count = 0
+        carry = None
+        for one_begsam in range(begsam, endsam, n_chunk):
+            x = dataset.read_data(chan=chan, begsam=one_begsam,
+                                  endsam=min((one_begsam + n_chunk,
+                                              endsam))).data[0]
+            if carry is not None:
+                x = hstack((carry, x))
+
+            n_seg = max((x.shape[1] - nperseg) // step + 1, 0)
+            if n_seg > 0:
+                ep_sum += _sum_periodograms(x, n_seg, nperseg, step, win,
+                                            detrend, scale)
+                ep_count += n_seg
+            carry = x[:, n_seg * step:]
+
+        if ep_count == 0:
+            lg.info('Epoch at {0}s is too short for the Welch window'
+                    ''.format(ep['start']))
+            continue
+
+        i_grp = groups.index(ep['stage'])
+        psd_sum[i_grp] += ep_sum
+        psd_count[i_grp] += ep_count
+
+        if keep_epochs:
+            epoch_psd.append((ep, ep_sum / ep_count))
+
+    psd_mean = []
+    for one_sum, one_count in zip(psd_sum, psd_count):
+        if one_count == 0:
+            one_sum.fill(nan)
+            psd_mean.append(one_sum)
+        else:
+            psd_mean.append(one_sum / one_count)
+
+    psd = _make_chanfreq(dataset, chan, freq_axis, psd_mean)
+    if annot is not None:
+        psd.attr['stage'] = groups
+
+    if not keep_epochs:
+        return psd
+
+    ep_freq = _make_chanfreq(dataset, chan, freq_axis,
+                             [x[1] for x in epoch_psd])
+    ep_freq.attr['epochs'] = [x[0] for x in epoch_psd]
+
+    return psd, ep_freq
+
+
+def epoch_bandpower(dataset, bands, chan=None, annot=None, epoch_length=30,
+                    duration=2, overlap=0.5, window='hann', chunk=600,
+                    cache_dir=None):
+    """Compute the power in frequency bands for each epoch of a recording.
+
+    Parameters
+    ----------
+    dataset : instance of Dataset
+        recording to analyze
+    bands : list of tuple of float
+        low and high frequency of each band (low is included, high is not)
+    chan : list of str, optional
+        channels of interest (if None, all the channels)
+    annot : instance of Annotations, optional
+        if specified, use the epochs in the annotations (all of them, so that
+        the output is aligned with Annotations.epochs)
+    epoch_length : float
+        duration of the epochs in s (only if annot is None)
+    duration : float
+        duration of the Welch window inside each epoch, in s
+    overlap : float
+        amount of overlap of the Welch windows
+    window : str or tuple or array
+        desired window to use
+    chunk : float
+        approximate duration in s of the data which are read at once
+    cache_dir : path to directory, optional
+        if specified, the results are stored in this directory and they are
+        read from disk when the same dataset, channels, epochs and bands are
+        requested again
+
+    Returns
+    -------
+    instance of Data
+        one trial, with axes 'epoch' (start time of the epochs, in s), 'chan'
+        and 'band' (as 'low-high'), with the power (V**2) in each band.
+        Epochs which cannot be computed (f.e. outside the recording) are NaN.
+
+    Notes
+    -----
+    Consecutive epochs of the same length are read together, reshaped as
+    nChan X nEpochs X nSamples without copying, and the Welch segments of
+    all the epochs are transformed with one FFT.
+    """
+    s_freq = dataset.header['s_freq']
+    n_samples = dataset.header['n_samples']
+    if chan is None:
+        chan = dataset.header['chan_name']
+    chan = list(chan)
+
+    if annot is None:
+        n_epochs = int(n_samples / s_freq // epoch_length)
+        epochs = [(i * epoch_length, (i + 1) * epoch_length)
+                  for i in range(n_epochs)]
+    else:
+        epochs = [(ep['start'], ep['end']) for ep in annot.epochs]
+
+    nperseg = int(duration * s_freq)
+    step = nperseg - int(overlap * nperseg)
+
+    if cache_dir is not None:
+        key = (str(Path(dataset.filename).resolve()),
+               Path(dataset.filename).stat().st_mtime, n_samples, s_freq,
+               chan, [tuple(b) for b in bands], epochs, nperseg, step,
+               window)
+        cache_file = (Path(cache_dir) / ('bandpower_' +
+                                         sha1(repr(key).encode()).hexdigest() +
+                                         '.npy'))
+        if cache_file.exists():
+            lg.info('Reading band power from ' + str(cache_file))
+            values = load(str(cache_file))
+            return _make_bandpower(dataset, epochs, chan, bands, values)
+
+    win = get_window(window, nperseg)
+    scale = 1 / (s_freq * (win ** 2).sum())
+    f = rfftfreq(nperseg, 1 / s_freq)
+    band_masks = asarray([(f >= b[0]) & (f < b[1]) for b in bands],
+                         dtype=float).T * (s_freq / nperseg)
+
+    values = empty((len(epochs), len(chan), len(bands)))
+    values.fill(nan)
+
+    ep_smp = [(int(round(ep[0] * s_freq)), int(round(ep[1] * s_freq)))
+              for ep in epochs]
+    for idx in _group_contiguous(ep_smp, n_samples, int(chunk * s_freq)):
+        begsam = ep_smp[idx[0]][0]
+        n_smp = ep_smp[idx[0]][1] - begsam
+        n_seg = (n_smp - nperseg) // step + 1
+        if n_seg < 1:
+            continue
+
+        x = dataset.read_data(chan=chan, begsam=begsam,
+                              endsam=begsam + n_smp * len(idx)).data[0]
+        x = x.reshape(len(chan), len(idx), n_smp)
+
+        psd = _sum_periodograms(x, n_seg, nperseg, step, win, 'constant',
+                                scale) / n_seg
+        values[idx, :, :] = swapaxes(dot(psd, band_masks), 0, 1)
+
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        save(str(cache_file), values)
+
+    return _make_bandpower(dataset, epochs, chan, bands, values)
+
+
+def _group_contiguous(ep_smp, n_samples, max_smp):
+    """Group consecutive epochs with the same length, to read them at once.
+
+    Parameters
+    ----------
+    ep_smp : list of tuple of int
+        first and last (excluded) sample of each epoch
+    n_samples : int
+        number of samples in the recording (epochs beyond it are skipped)
+    max_smp : int
+        maximum number of samples in one group
+
+    Yields
+    ------
+    list of int
+        indices of the epochs in one group
+    """
+    group = []
+    for i, (begsam, endsam) in enumerate(ep_smp):
+        if begsam < 0 or endsam > n_samples or endsam <= begsam:
+            continue
+
+        if group:
+            prev_beg, prev_end = ep_smp[group[-1]]
+            first_beg = ep_smp[group[0]][0]
+            if (begsam != prev_end or endsam - begsam != prev_end - prev_beg
+                    or endsam - first_beg > max_smp):
+                yield group
+                group = []
+
+        group.append(i)
+
+    if group:
+        yield group
+
+
+def _make_bandpower(dataset, epochs, chan, bands, values):
+    """Create Data with axes epoch, chan, band."""
+    bp = Data()
+    bp.s_freq = dataset.header['s_freq']
+    bp.start_time = dataset.header['start_time']
+
+    bp.axis['epoch'] = empty(1, dtype='O')
+    bp.axis['epoch'][0] = asarray([ep[0] for ep in epochs], dtype=float)
+    bp.axis['chan'] = empty(1, dtype='O')
+    bp.axis['chan'][0] = asarray(chan, dtype='U')
+    bp.axis['band'] = empty(1, dtype='O')
+    bp.axis['band'][0] = asarray(['{0}-{1}'.format(*b) for b in bands],
+                                 dtype='U')
+    bp.data = empty(1, dtype='O')
+    bp.data[0] = values
+
+    return bp
+
+
+def _sum_periodograms(x, n_seg, nperseg, step, win, detrend, scale):
+    """Sum the one-sided periodograms of overlapping segments.
+
+    Parameters
+    ----------
+    x : ndarray
+        data, with time as the last dimension (f.e. nChan X nSamples)
+    n_seg : int
+        number of segments
+    nperseg : int
+        length of each segment
+    step : int
+        number of samples between the start of consecutive segments
+    win : ndarray
+        window to apply to each segment
+    detrend : str or function or False
+        specifies how to detrend each segment
+    scale : float
+        scaling factor for density or spectrum
+
+    Returns
+    -------
+    ndarray
+        sum of the periodograms, with frequency as the last dimension (f.e.
+        nChan X nFreq)
+    """
+    x = ascontiguousarray(x)
+    segments = as_strided(x, shape=x.shape[:-1] + (n_seg, nperseg),
+                          strides=x.strides[:-1] + (step * x.strides[-1],
+                                                    x.strides[-1]))
+
+    if detrend == 'constant':
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+    elif detrend == 'linear':
+        segments = detrend_func(segments, axis=-1, type='linear')
+    elif callable(detrend):
+        segments = detrend(segments)
+
+    spectrum = rfft(segments * win, axis=-1)
+    pxx = (spectrum.real ** 2 + spectrum.imag ** 2) * scale
+
+    # one-sided, so double all the frequencies, except DC and Nyquist
+    if nperseg % 2:
+        pxx[..., 1:] *= 2
+    else:
+        pxx[..., 1:-1] *= 2
+
+    return pxx.sum(axis=-2)
+
+
+def _make_chanfreq(dataset, chan, freq_axis, values):
+    """Create ChanFreq with one trial for each matrix in values."""
+    freq = ChanFreq()
+    freq.s_freq = dataset.header['s_freq']
+    freq.start_time = dataset.header['start_time']
+
+    n_trial = len(values)
+    freq.axis['chan'] = empty(n_trial, dtype='O')
+    freq.axis['freq'] = empty(n_trial, dtype='O')
+    freq.data = empty(n_trial, dtype='O')
+    for i, one_value in enumerate(values):
+        freq.axis['chan'][i] = asarray(chan, dtype='U')
+        freq.axis['freq'][i] = freq_axis
+        freq.data[i] = one_value
+
+    return freq
+
+
+def timefrequency(data, method='morlet', time_skip=1, dtype=None, n_jobs=1,
+                  output='complex', time_bin=None, memmap_dir=None,
+                  block=None, **options):
     """Compute the power spectrum over time.
 
     Parameters
@@ -133,6 +737,26 @@ def timefrequency(data, method='morlet', time_skip=1, **options):
         the method to compute the time-frequency representation, such as
         'morlet' (wavelet using complex morlet window), 'spectrogram' (relies
         on scipy implementation)
+    time_skip : int, optional
+        number of time points to skip (see Notes)
+    dtype : str, optional
+        dtype of the output, use 'complex64' (or 'float32' for power) to halve
+        the memory. If None, it's 'complex' (or 'float64' for power).
+    n_jobs : int, optional
+        number of threads to run the morlet convolution on groups of channels
+    output : str, optional
+        'complex' (default) or 'power' (squared magnitude)
+    time_bin : float, optional
+        duration in s of the bins used to average the power over time (only
+        for 'morlet', with output='power')
+    memmap_dir : path to directory, optional
+        if specified, the output of each trial is written to a new file in
+        this directory and it is memory-mapped (only for 'morlet'). The files
+        of previous calls are not overwritten.
+    block : float, optional
+        duration in s of the blocks of data which are processed at once (only
+        for 'morlet'). If None, it uses the whole trial, unless memmap_dir is
+        specified, in which case it's 60 s.
     options : dict
         Options depends on the method.
     data : instance of ChanTime
@@ -159,6 +783,18 @@ def timefrequency(data, method='morlet', time_skip=1, **options):
     It uses sampling frequency as specified in s_freq, it does not
     recompute the sampling frequency based on the time axis.
 
+    For method 'morlet', the FFT of each channel is computed only once and it
+    is multiplied by the spectra of all the wavelets (which are shared by
+    trials of the same length). The time points which are skipped because of
+    time_skip are never computed.
+
+    With memmap_dir, the time-frequency representation is computed in blocks
+    (with enough overlap for the longest wavelet, so the results are the same)
+    and each block is written straight to disk, so the memory depends on the
+    duration of the block, not on the duration of the trial. Combine it with
+    output='power', dtype='float32' and time_bin to reduce the size of the
+    output files.
+
     For method 'morlet', the following options should be specified:
         foi : ndarray or list or tuple
             vector with frequency of interest
@@ -223,6 +859,21 @@ def timefrequency(data, method='morlet', time_skip=1, **options):
     default_options.update(options)
     options = default_options
 
+    if output not in ('complex', 'power'):
+        raise ValueError('output should be \'complex\' or \'power\'')
+    if time_bin is not None and output != 'power':
+        raise ValueError('time_bin can only be used with output=\'power\'')
+    if method != 'morlet' and (time_bin is not None or
+                               memmap_dir is not None or block is not None):
+        raise ValueError('time_bin, memmap_dir and block can only be used '
+                         'with method \'morlet\'')
+
+    if dtype is None:
+        if output == 'complex':
+            dtype = 'complex'
+        else:
+            dtype = 'float64'
+
     timefreq = ChanTimeFreq()
     timefreq.s_freq = data.s_freq
     timefreq.start_time = data.start_time
@@ -235,20 +886,49 @@ def timefrequency(data, method='morlet', time_skip=1, **options):
 
         wavelets = _create_morlet(deepcopy(options), data.s_freq)
 
+        # number of output points in each bin
+        if time_bin is None:
+            n_bin = 1
+        else:
+            n_bin = max((int(round(time_bin * data.s_freq / time_skip)), 1))
+
+        if block is None and memmap_dir is not None:
+            block = 60
+
+        if memmap_dir is not None:
+            memmap_dir = Path(memmap_dir)
+            memmap_dir.mkdir(parents=True, exist_ok=True)
+
+        wavelet_bank = {}
         for i in range(data.number_of('trial')):
             lg.info('Processing trial # {0: 6}'.format(i))
             timefreq.axis['freq'][i] = array(options['foi'])
-            timefreq.axis['time'][i] = data.axis['time'][i][::time_skip]
-
-            timefreq.data[i] = empty((data.number_of('chan')[i],
-                                      data.number_of('time')[i] // time_skip,
-                                      len(options['foi'])),
-                                     dtype='complex')
-            for i_c, chan in enumerate(data.axis['chan'][i]):
-                dat = data(trial=i, chan=chan)
-                for i_f, wavelet in enumerate(wavelets):
-                    tf = fftconvolve(dat, wavelet, 'same')
-                    timefreq.data[i][i_c, :, i_f] = tf[::time_skip]
+
+            time = data.axis['time'][i][::time_skip]
+            if n_bin > 1:
+                time = _bin_mean(time, n_bin, 0)
+            timefreq.axis['time'][i] = time
+
+            dat = data.data[i]
+            if data.index_of('chan') != 0:
+                dat = dat.T
+
+            out_shape = (dat.shape[0], len(time), len(options['foi']))
+            if memmap_dir is None:
+                tf = empty(out_shape, dtype=dtype)
+            else:
+                fd, tf_file = mkstemp(suffix='.dat', dir=str(memmap_dir),
+                                      prefix='timefreq_trial{0:06}_'
+                                      ''.format(i))
+                close(fd)
+                tf = memmap(tf_file, dtype=dtype, mode='w+', shape=out_shape)
+
+            _timefrequency_morlet(dat, wavelets, wavelet_bank, tf, time_skip,
+                                  n_bin, output, n_jobs, block, data.s_freq)
+
+            if memmap_dir is not None:
+                tf.flush()
+            timefreq.data[i] = tf
 
         if time_skip != 1:
             warn('sampling frequency in s_freq refers to the input data, '
@@ -269,7 +949,10 @@ def timefrequency(data, method='morlet', time_skip=1, **options):
                                     axis=data.index_of('time'))
 
             # the last axis of Sxx corresponds to the segment times
-            timefreq.data[i] = swapaxes(Sxx[..., ::time_skip], -1, -2)
+            Sxx = swapaxes(Sxx[..., ::time_skip], -1, -2)
+            if output == 'power':
+                Sxx = absolute(Sxx) ** 2
+            timefreq.data[i] = Sxx.astype(dtype, copy=False)
             # add offset
             timefreq.axis['time'][i] = t[::time_skip] + data.axis['time'][i][0]
             timefreq.axis['freq'][i] = f
@@ -303,6 +986,189 @@ def _create_morlet(options, s_freq):
     return wavelets
 
 
+def _timefrequency_morlet(dat, wavelets, wavelet_bank, tf, time_skip, n_bin,
+                          output, n_jobs, block, s_freq):
+    """Compute the morlet time-frequency of one trial, one block at the time.
+
+    Parameters
+    ----------
+    dat : ndarray
+        nChan X nSamples matrix with the data
+    wavelets : list of ndarray
+        complex Morlet wavelets, one for each frequency
+    wavelet_bank : dict
+        spectra of the wavelets for each length of the blocks (it gets updated
+        with the new lengths)
+    tf : ndarray
+        nChan X nTime X nFreq matrix where to store the output (it can be a
+        memmap)
+    time_skip : int
+        number of time points to skip
+    n_bin : int
+        number of output points to average (only for power)
+    output : str
+        'complex' or 'power'
+    n_jobs : int
+        number of threads
+    block : float or None
+        duration of the blocks in s. If None, the whole trial is one block.
+    s_freq : float
+        sampling frequency
+
+    Notes
+    -----
+    Each block is padded on both sides with the data around it (or zeros at
+    the edges of the trial, as in fftconvolve), for the length of the longest
+    wavelet, so that the output is identical to a convolution on the whole
+    trial.
+    """
+    n_smp = dat.shape[1]
+    max_len = max([len(w) for w in wavelets])
+
+    # block and padding are multiple of the points to skip and to bin
+    step = time_skip * n_bin
+    if block is None:
+        n_block = n_smp
+    else:
+        n_block = int(block * s_freq)
+    n_block = max((n_block // step, 1)) * step
+    pad = int(ceil(max_len / time_skip)) * time_skip
+
+    for begsam in range(0, n_smp, n_block):
+        endsam = min((begsam + n_block, n_smp))
+        beg_pad = max((begsam - pad, 0))
+        end_pad = min((endsam + pad, n_smp))
+        n_seg = end_pad - beg_pad
+
+        if n_seg not in wavelet_bank:
+            wavelet_bank[n_seg] = _create_morlet_bank(wavelets, n_seg,
+                                                      time_skip)
+
+        if output == 'power' and n_bin > 1:
+            block_dtype = 'float64'
+        else:
+            block_dtype = tf.dtype
+
+        x = _convolve_morlet(dat[:, beg_pad:end_pad], wavelet_bank[n_seg],
+                             n_seg, time_skip, block_dtype, n_jobs,
+                             power=output == 'power')
+
+        i0 = (begsam - beg_pad) // time_skip
+        i1 = i0 + len(range(begsam, endsam, time_skip))
+        x = x[:, i0:i1, :]
+        if n_bin > 1:
+            x = _bin_mean(x, n_bin, 1)
+
+        i_out = begsam // step
+        tf[:, i_out:i_out + x.shape[1], :] = x
+
+
+def _bin_mean(x, n_bin, axis):
+    """Average consecutive values in bins (the last bin can be shorter)."""
+    idx = arange(0, x.shape[axis], n_bin)
+    counts = diff(append(idx, x.shape[axis]))
+    count_shape = [1] * x.ndim
+    count_shape[axis] = -1
+    return add.reduceat(x, idx, axis=axis) / counts.reshape(count_shape)
+
+
+def _create_morlet_bank(wavelets, n_smp, time_skip):
+    """Compute the spectra of the wavelets, ready to be multiplied.
+
+    Parameters
+    ----------
+    wavelets : list of ndarray
+        complex Morlet wavelets, one for each frequency
+    n_smp : int
+        number of samples in the data
+    time_skip : int
+        number of time points to skip
+
+    Returns
+    -------
+    ndarray
+        nFreq X nFFT matrix with the spectra of the wavelets
+
+    Notes
+    -----
+    The FFT length is a multiple of time_skip and it is long enough to avoid
+    circular convolution. The spectra include the shift to center the output
+    (as in mode='same' of fftconvolve) and the scaling for the decimation
+    (see _convolve_morlet).
+    """
+    max_len = max([len(w) for w in wavelets])
+    n_fold = next_fast_len(ceil((n_smp + max_len - 1) / time_skip))
+    nfft = n_fold * time_skip
+
+    j = arange(nfft)
+    bank = empty((len(wavelets), nfft), dtype='complex')
+    for i_f, w in enumerate(wavelets):
+        beg = (len(w) - 1) // 2
+        bank[i_f, :] = fft(w, nfft) * exp(2j * pi * j * beg / nfft) / time_skip
+
+    return bank
+
+
+def _convolve_morlet(dat, bank, n_smp, time_skip, dtype, n_jobs,
+                     power=False):
+    """Convolve all the channels with all the wavelets.
+
+    Parameters
+    ----------
+    dat : ndarray
+        nChan X nSamples matrix with the data
+    bank : ndarray
+        nFreq X nFFT matrix with the spectra of the wavelets
+    n_smp : int
+        number of samples in the data
+    time_skip : int
+        number of time points to skip
+    dtype : str
+        dtype of the output
+    n_jobs : int
+        number of threads to use, each one takes a group of channels
+    power : bool
+        return the squared magnitude, instead of the complex values
+
+    Returns
+    -------
+    ndarray
+        nChan X nTime X nFreq matrix with the complex output (or its power)
+
+    Notes
+    -----
+    Taking one point every time_skip in the time domain corresponds to
+    summing the spectrum folded time_skip times, so that the inverse FFT is
+    only nFFT / time_skip long.
+    """
+    nfft = bank.shape[1]
+    n_fold = nfft // time_skip
+    n_time = len(range(0, n_smp, time_skip))
+
+    output = empty((dat.shape[0], n_time, bank.shape[0]), dtype=dtype)
+
+    def _convolve_block(idx_chan):
+        n_chan = len(idx_chan)
+        if n_chan == 0:
+            return
+        x = fft(dat[idx_chan, :], nfft, axis=-1)
+        for i_f, w in enumerate(bank):
+            folded = (x * w).reshape(n_chan, time_skip, n_fold).sum(axis=1)
+            tf = ifft(folded, axis=-1)[:, :n_time]
+            if power:
+                tf = tf.real ** 2 + tf.imag ** 2
+            output[idx_chan, :, i_f] = tf
+
+    blocks = array_split(arange(dat.shape[0]), n_jobs)
+    if n_jobs == 1:
+        _convolve_block(blocks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(_convolve_block, blocks))
+
+    return output
+
+
 def morlet(freq, s_freq, ratio=5, sigma_f=None, dur_in_sd=4, dur_in_s=None,
            normalization='peak', zero_mean=False):
     """Create a Morlet wavelet.
@@ -1,20 +1,63 @@
 """Convenient module to convert data based on simple mathematical operations.
 """
-from inspect import getfullargspec
+from inspect import signature
 from logging import getLogger
 
 # for Math
-from numpy import (absolute, angle, diff, exp, log, median, mean, pad, sqrt,
-                   square, sum, std, unwrap)
+from numpy import (absolute, angle, diff, exp, log, may_share_memory, median,
+                   mean, ndarray, pad, sqrt, square, sum, std, ufunc, unwrap,
+                   zeros)
 from scipy.signal import detrend, hilbert
 from scipy.stats import mode
 
 lg = getLogger(__name__)
 
-NOKEEPDIM = (median, mode)
+CHUNKED_REDUCTIONS = (mean, sum)
 
 
-def math(data, operator=None, operator_name=None, axis=None):
+def _operator(func, on_axis=False, keepdims=True, pointwise=False):
+    """Describe one operator.
+
+    Parameters
+    ----------
+    func : function
+        function to run on the data
+    on_axis : bool
+        if the function needs an axis
+    keepdims : bool
+        if the function keeps the axis (only if on_axis)
+    pointwise : bool
+        if the function is a numpy ufunc, which can run in place (with out=)
+
+    Returns
+    -------
+    dict
+        with keys 'func', 'on_axis', 'keepdims', 'pointwise'
+    """
+    return {'func': func, 'on_axis': on_axis, 'keepdims': keepdims,
+            'pointwise': pointwise}
+
+
+OPERATORS = {'absolute': _operator(absolute, pointwise=True),
+             'abs': _operator(absolute, pointwise=True),
+             'angle': _operator(angle),
+             'exp': _operator(exp, pointwise=True),
+             'log': _operator(log, pointwise=True),
+             'sqrt': _operator(sqrt, pointwise=True),
+             'square': _operator(square, pointwise=True),
+             'unwrap': _operator(unwrap, on_axis=True),
+             'hilbert': _operator(hilbert, on_axis=True),
+             'diff': _operator(diff, on_axis=True),
+             'detrend': _operator(detrend, on_axis=True),
+             'mean': _operator(mean, on_axis=True, keepdims=False),
+             'median': _operator(median, on_axis=True, keepdims=False),
+             'mode': _operator(mode, on_axis=True, keepdims=False),
+             'std': _operator(std, on_axis=True, keepdims=False),
+             'sum': _operator(sum, on_axis=True, keepdims=False),
+             }
+
+
+def math(data, operator=None, operator_name=None, axis=None, chunk=None):
     """Apply mathematical operation to each trial and channel individually.
 
     Parameters
@@ -27,6 +70,10 @@ def math(data, operator=None, operator_name=None, axis=None):
         name of the function(s) to run on the data.
     axis : str, optional
         for functions that accept it, which axis you should run it on.
+    chunk : int, optional
+        if specified, point-wise operators followed by 'mean' or 'sum' are
+        computed on chunks of this number of samples along axis, so that
+        only one chunk-sized temporary array is needed (f.e. for RMS).
 
     Returns
     -------
@@ -38,25 +85,30 @@ def math(data, operator=None, operator_name=None, axis=None):
     TypeError
         If you pass both operator and operator_name.
     ValueError
-        When you try to operate on an axis that has already been removed.
+        When you try to operate on an axis that has already been removed, or
+        when operator_name is not in OPERATORS.
 
     Notes
     -----
     operator and operator_name are mutually exclusive. operator_name is given
-    as shortcut for most common operations.
+    as shortcut for most common operations (see OPERATORS).
 
     If a function accepts an 'axis' argument, you need to pass 'axis' to the
     constructor. In this way, it'll apply the function to the correct
     dimension.
 
     The possible point-wise operator_name are:
-    'absolute', 'angle', 'exp', 'log', 'sqrt', 'square', 'unwrap'
+    'absolute', 'angle', 'exp', 'log', 'sqrt', 'square'
 
     The operator_name's that need an axis, but do not remove it:
-    'hilbert', 'diff', 'detrend'
+    'hilbert', 'diff', 'detrend', 'unwrap'
 
     The operator_name's that need an axis and remove it:
-    'mean', 'median', 'mode', 'std'
+    'mean', 'median', 'mode', 'std', 'sum'
+
+    Consecutive point-wise numpy ufuncs (f.e. 'square' and 'sqrt') run in
+    place on the output of the previous operator, so that a chain of them
+    only allocates one array per trial. The input data is never modified.
 
     Examples
     --------
@@ -97,88 +149,196 @@ def math(data, operator=None, operator_name=None, axis=None):
 
         operators = []
         for one_operator_name in operator_name:
-            operators.append(eval(one_operator_name))
-        operator = tuple(operators)
-
-    # make it an iterable
-    if callable(operator):
-        operator = (operator, )
+            if one_operator_name not in OPERATORS:
+                raise ValueError('Unknown operator "' + one_operator_name +
+                                 '", choose one of: ' +
+                                 ', '.join(OPERATORS))
+            operators.append(OPERATORS[one_operator_name])
+
+    else:
+        # make it an iterable
+        if callable(operator):
+            operator = (operator, )
+        operators = [_describe_operator(one_operator)
+                     for one_operator in operator]
 
     operations = []
-    for one_operator in operator:
-        on_axis = False
-        keepdims = True
-
-        try:
-            args = getfullargspec(one_operator).args
-        except TypeError:
-            lg.debug('func ' + str(one_operator) + ' is not a Python '
-                     'function')
-        else:
-            if 'axis' in args:
-                on_axis = True
+    for one_operator in operators:
+        one_func = one_operator['func']
+        if one_operator['on_axis'] and axis is None:
+            raise TypeError('You need to specify an axis if you use ' +
+                            one_func.__name__ + ' (which applies to an axis)')
 
-                if axis is None:
-                    raise TypeError('You need to specify an axis if you '
-                                    'use ' + one_operator.__name__ +
-                                    ' (which applies to an axis)')
+        if one_func == mode:
+            one_func = lambda x, axis: mode(x, axis=axis)[0]
 
-            if 'keepdims' in args or one_operator in NOKEEPDIM:
-                keepdims = False
-
-        operations.append({'name': one_operator.__name__,
-                           'func': one_operator,
-                           'on_axis': on_axis,
-                           'keepdims': keepdims,
-                           })
+        operation = dict(one_operator)
+        operation.update({'name': one_operator['func'].__name__,
+                          'func': one_func})
+        operations.append(operation)
 
     output = data._copy()
 
+    idx_axis = None
     if axis is not None:
         idx_axis = data.index_of(axis)
 
-    first_op = True
-    for op in operations:
-        lg.info('running operator: ' + op['name'])
-        func = op['func']
-
-        if func == mode:
-            func = lambda x, axis: mode(x, axis=axis)[0]
+    lg.info('running operators: ' + ', '.join(op['name'] for op in operations))
+    for i in range(output.number_of('trial')):
+        x = data.data[i]
+        j = 0
+        while j < len(operations):
+            op = operations[j]
+
+            k = j
+            while k < len(operations) and operations[k]['pointwise']:
+                k += 1
+            if (chunk is not None and k < len(operations) and
+                    operations[k]['func'] in CHUNKED_REDUCTIONS):
+                lg.debug('running ' + ', '.join(one_op['name'] for one_op
+                                                in operations[j:k + 1]) +
+                         ' in chunks of ' + str(chunk))
+                x = _chunked_reduction(x, operations[j:k], operations[k],
+                                       idx_axis, chunk, axis, data)
+                j = k + 1
+                continue
+
+            if op['pointwise']:
+                lg.debug('running ' + op['name'] + ' on each datapoint')
+                x = _run_pointwise(op['func'], x, data.data[i])
 
-        for i in range(output.number_of('trial')):
-            
-            # don't copy original data, but use data if it's the first operation
-            if first_op:
-                x = data(trial=i)
-            else:
-                x = output(trial=i)
-            
-            if op['on_axis']:
+            elif op['on_axis']:
                 lg.debug('running ' + op['name'] + ' on ' + str(idx_axis))
-               
-                try:
-                    if func == diff:
-                        lg.debug('Diff has one-point of zero padding')
-                        x = _pad_one_axis_one_value(x, idx_axis)
-                    output.data[i] = func(x, axis=idx_axis)
-
-                except IndexError:
-                    raise ValueError('The axis ' + axis + ' does not '
-                                     'exist in [' +
-                                     ', '.join(list(data.axis.keys())) + ']')
+                x = _run_on_axis(op['func'], x, idx_axis, axis, data)
 
             else:
                 lg.debug('running ' + op['name'] + ' on each datapoint')
-                output.data[i] = func(x)
+                x = op['func'](x)
+
+            j += 1
+
+        output.data[i] = x
 
-        first_op = False 
-        
+    for op in operations:
         if op['on_axis'] and not op['keepdims']:
             del output.axis[axis]
 
     return output
 
 
+def _describe_operator(func):
+    """Describe a function passed as operator (see _operator).
+
+    Parameters
+    ----------
+    func : function
+        function to run on the data
+
+    Returns
+    -------
+    dict
+        description of the operator
+
+    Notes
+    -----
+    The functions in OPERATORS are described there. The other functions need
+    an axis if they have an argument called 'axis', and they remove the axis
+    if they have an argument called 'keepdims'. Only the numpy ufuncs with
+    one input run in place.
+    """
+    for one_operator in OPERATORS.values():
+        if one_operator['func'] is func:
+            return one_operator
+
+    if isinstance(func, ufunc):
+        return _operator(func, pointwise=func.nin == 1)
+
+    try:
+        args = signature(func).parameters
+    except (TypeError, ValueError):
+        lg.debug('func ' + str(func) + ' has no signature')
+        return _operator(func)
+
+    return _operator(func, on_axis='axis' in args,
+                     keepdims='keepdims' not in args)
+
+
+def _run_pointwise(func, x, original):
+    """Run a point-wise ufunc, in place if x is an array which is not the
+    original data."""
+    if (isinstance(x, ndarray) and x.dtype.kind == 'f' and
+            not may_share_memory(x, original)):
+        return func(x, out=x)
+    else:
+        return func(x)
+
+
+def _run_on_axis(func, x, idx_axis, axis, data):
+    """Run a function which operates on one axis."""
+    try:
+        if func == diff:
+            lg.debug('Diff has one-point of zero padding')
+            x = _pad_one_axis_one_value(x, idx_axis)
+        return func(x, axis=idx_axis)
+
+    except IndexError:
+        raise ValueError('The axis ' + axis + ' does not '
+                         'exist in [' +
+                         ', '.join(list(data.axis.keys())) + ']')
+
+
+def _chunked_reduction(x, pointwise, reduction, idx_axis, chunk, axis, data):
+    """Run point-wise operators and sum or mean, in chunks along one axis.
+
+    Parameters
+    ----------
+    x : ndarray
+        data of one trial
+    pointwise : list of dict
+        point-wise operations to run on each chunk
+    reduction : dict
+        operation which sums or averages over the axis
+    idx_axis : int
+        index of the axis to reduce
+    chunk : int
+        number of samples along the axis in each chunk
+    axis : str
+        name of the axis (for the error message)
+    data : instance of Data
+        original data (for the error message)
+
+    Returns
+    -------
+    ndarray
+        data with the axis removed
+    """
+    if idx_axis is None or idx_axis >= x.ndim:
+        return _run_on_axis(reduction['func'], x, idx_axis, axis, data)
+
+    n_smp = x.shape[idx_axis]
+    total = None
+    index = [slice(None)] * x.ndim
+    for begsam in range(0, n_smp, chunk):
+        index[idx_axis] = slice(begsam, begsam + chunk)
+        y = x[tuple(index)]
+        for op in pointwise:
+            y = _run_pointwise(op['func'], y, x)
+
+        if total is None:
+            total = y.sum(axis=idx_axis)
+        else:
+            total += y.sum(axis=idx_axis)
+
+    if total is None:
+        shape = x.shape[:idx_axis] + x.shape[idx_axis + 1:]
+        total = zeros(shape, dtype=x.dtype)
+
+    if reduction['func'] == mean:
+        total = total / n_smp
+
+    return total
+
+
 def _pad_one_axis_one_value(x, idx_axis):
     pad_width = [(0, 0)] * x.ndim
     pad_width[idx_axis] = (1, 0)
@@ -4,13 +4,13 @@ It does not merge two instances of Data together (TODO).
 """
 from logging import getLogger
 
-from numpy import asarray, empty, expand_dims, unique
+from numpy import asarray, empty, moveaxis, result_type, unique
 from numpy import concatenate as cat
 
 lg = getLogger(__name__)
 
 
-def concatenate(data, axis):
+def concatenate(data, axis, check_unique=True):
     """Concatenate multiple trials into one trials, according to any dimension.
 
     Parameters
@@ -19,6 +19,9 @@ def concatenate(data, axis):
 
     axis : str
         axis that you want to concatenate (it can be 'trial')
+    check_unique : bool
+        warn if the values of the axes are not unique (this requires sorting
+        the values, so you can skip it for many trials)
 
     Returns
     -------
@@ -34,6 +37,10 @@ def concatenate(data, axis):
     If you want to concatenate across trials, you need:
 
     >>> expand_dims(data1.data[0], axis=1).shape
+
+    When axis is 'trial', the trials are copied once into an array with trial
+    as the first dimension, which is then returned with trial as the last
+    dimension (as a view, so it's not C-contiguous).
     """
     output = data._copy(axis=False)
 
@@ -45,7 +52,8 @@ def concatenate(data, axis):
         else:
             output.axis[dataaxis][0] = data.axis[dataaxis][0]
 
-        if len(unique(output.axis[dataaxis][0])) != len(output.axis[dataaxis][0]):
+        if (check_unique and len(unique(output.axis[dataaxis][0])) !=
+                len(output.axis[dataaxis][0])):
             lg.warning('Axis ' + dataaxis + ' does not have unique values')
 
     output.data = empty(1, dtype='O')
@@ -58,11 +66,16 @@ def concatenate(data, axis):
         new_axis[0] = asarray(trial_name, dtype='U')
         output.axis['trial_axis'] = new_axis
 
-        # concatenate along the extra dimension
-        all_trial = []
-        for one_trial in data.data:
-            all_trial.append(expand_dims(one_trial, -1))
-        output.data[0] = cat(all_trial, axis=-1)
+        # copy each trial into the preallocated output
+        shape = data.data[0].shape
+        if any(one_trial.shape != shape for one_trial in data.data):
+            raise ValueError('All the trials should have the same shape to '
+                             'concatenate them along "trial"')
+        stacked = empty((n_trial, ) + shape,
+                        dtype=result_type(*data.data))
+        for i, one_trial in enumerate(data.data):
+            stacked[i] = one_trial
+        output.data[0] = moveaxis(stacked, 0, -1)
 
     else:
         output.data[0] = cat(data.data, axis=output.index_of(axis))
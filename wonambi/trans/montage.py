@@ -1,7 +1,10 @@
+from functools import lru_cache
 from logging import getLogger
 
-from numpy import asarray, dot, zeros, where, c_, mean
+from numpy import asarray, c_, cumsum, hstack, lexsort, mean, moveaxis, ones
 from numpy.linalg import norm
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 
 from ..attr import Channels
 
@@ -31,6 +34,11 @@ def montage(data, ref_chan=None, ref_to_avg=False, bipolar=None):
     Notes
     -----
     If you don't change anything, it returns the same instance of data.
+
+    The montage is compiled into a sparse matrix once per set of channels (see
+    compile_reference), so that calling montage repeatedly on the same
+    channels (f.e. when scrolling through a recording) does not recompute it.
+    All the trials are transformed with one sparse matrix multiplication.
     """
     if ref_to_avg and ref_chan is not None:
         raise TypeError('You cannot specify reference to the average and '
@@ -44,43 +52,128 @@ def montage(data, ref_chan=None, ref_to_avg=False, bipolar=None):
     if ref_chan is None:
         ref_chan = []  # TODO: check bool for ref_chan
 
-    if bipolar:
+    if not (ref_to_avg or ref_chan or bipolar):
+        return data
+
+    _assert_equal_channels(data.axis['chan'])
+    chan_in_data = data.axis['chan'][0]
+
+    if ref_to_avg or ref_chan:
+        trans = compile_reference(tuple(chan_in_data), tuple(ref_chan),
+                                  ref_to_avg)
+        labels = chan_in_data
+
+    else:
         if not data.attr['chan']:
             raise ValueError('Data should have Chan information in attr')
 
-        _assert_equal_channels(data.axis['chan'])
-        chan_in_data = data.axis['chan'][0]
         chan = data.attr['chan']
         chan = chan(lambda x: x.label in chan_in_data)
         chan, trans = create_bipolar_chan(chan, bipolar)
         data.attr['chan'] = chan
+        labels = asarray(chan.return_label(), dtype='U')
 
-    if ref_to_avg or ref_chan or bipolar:
-        mdata = data._copy()
+        if not data.index_of('chan') == 0:
+            raise ValueError('For matrix multiplication to work, '
+                             'the first dimension should be chan')
 
-        for i in range(mdata.number_of('trial')):
-            if ref_to_avg or ref_chan:
-                if ref_to_avg:
-                    ref_chan = data.axis['chan'][0]
+    mdata = data._copy()
+    mdata.data = apply_montage(data.data, trans, data.index_of('chan'))
+    for i in range(mdata.number_of('trial')):
+        mdata.axis['chan'][i] = labels
 
-                ref_data = data(trial=i, chan=ref_chan)
-                mdata.data[i] = (data(trial=i) -
-                                 mean(ref_data,
-                                      axis=mdata.index_of('chan')))
+    return mdata
 
-            elif bipolar:
 
-                if not data.index_of('chan') == 0:
-                    raise ValueError('For matrix multiplication to work, '
-                                     'the first dimension should be chan')
-                mdata.data[i] = dot(trans, data(trial=i))
-                mdata.axis['chan'][i] = asarray(chan.return_label(),
-                                                dtype='U')
+@lru_cache(maxsize=32)
+def compile_reference(chan, ref_chan=(), ref_to_avg=False):
+    """Compute the sparse matrix to re-reference the channels.
 
-    else:
-        mdata = data
+    Parameters
+    ----------
+    chan : tuple of str
+        labels of the channels in the data, in order
+    ref_chan : tuple of str
+        labels of the channels used as reference
+    ref_to_avg : bool
+        if re-reference to average of all the channels
 
-    return mdata
+    Returns
+    -------
+    instance of scipy.sparse.csr_matrix
+        nChan X nChan matrix, to multiply with the data (shared across calls,
+        do not modify it)
+
+    Raises
+    ------
+    ValueError
+        if one of the reference channels is not in the data
+
+    Notes
+    -----
+    The matrix is the identity minus the average of the reference channels,
+    stored as "identity" and "reference" rows, so that the number of
+    non-zero elements is nChan X nRef, not nChan X nChan.
+    """
+    chan = list(chan)
+    if ref_to_avg:
+        ref_chan = chan
+
+    missing = [x for x in ref_chan if x not in chan]
+    if missing:
+        raise ValueError('Reference channels not in the data: ' +
+                         ', '.join(missing))
+
+    n_chan = len(chan)
+    idx_ref = asarray([chan.index(x) for x in ref_chan], dtype=int)
+    n_ref = len(idx_ref)
+
+    rows = hstack((range(n_chan), ) + (range(n_chan), ) * n_ref)
+    cols = hstack((range(n_chan), ) + tuple([i] * n_chan for i in idx_ref))
+    vals = hstack((ones(n_chan), -ones(n_chan * n_ref) / n_ref))
+
+    trans = csr_matrix((vals, (rows, cols)), shape=(n_chan, n_chan))
+    trans.sum_duplicates()
+    return trans
+
+
+def apply_montage(data, trans, axis=0):
+    """Apply a montage matrix to all the trials at once.
+
+    Parameters
+    ----------
+    data : ndarray of ndarray
+        data of each trial (as in Data.data)
+    trans : ndarray or sparse matrix
+        nNewChan X nChan matrix
+    axis : int
+        index of the channel axis
+
+    Returns
+    -------
+    ndarray of ndarray
+        data of each trial after the montage, with nNewChan channels
+
+    Notes
+    -----
+    The trials are concatenated along the columns, so that there is only one
+    matrix multiplication, independent of the number of trials.
+    """
+    n_trial = len(data)
+    x = [moveaxis(data[i], axis, 0) for i in range(n_trial)]
+    x_2d = hstack([one_x.reshape(one_x.shape[0], -1) for one_x in x])
+
+    y_2d = trans.dot(x_2d)
+    if x_2d.dtype.kind in 'fc':
+        y_2d = y_2d.astype(x_2d.dtype, copy=False)
+
+    output = data.copy()
+    edges = cumsum([0] + [one_x[0].size for one_x in x])
+    for i, one_x in enumerate(x):
+        y = y_2d[:, edges[i]:edges[i + 1]].reshape((-1, ) + one_x.shape[1:])
+        output[i] = moveaxis(y, 0, axis)
+
+    return output
 
 
 def _assert_equal_channels(axis):
@@ -103,19 +196,32 @@ def _assert_equal_channels(axis):
 
 
 def create_bipolar_chan(chan, max_dist):
-    chan_dist = zeros((chan.n_chan, chan.n_chan), dtype='bool')
-    for i0, chan0 in enumerate(chan.chan):
-        for i1, chan1 in enumerate(chan.chan):
-            if i0 < i1 and norm(chan0.xyz - chan1.xyz) < max_dist:
-                chan_dist[i0, i1] = True
+    """Find the neighboring channels and compute the bipolar montage.
 
-    x_all, y_all = where(chan_dist)
+    Parameters
+    ----------
+    chan : instance of Channels
+        channels with their location
+    max_dist : float
+        distance in mm to consider two channels as neighbors
+
+    Returns
+    -------
+    instance of Channels
+        bipolar channels, located between the two channels
+    instance of scipy.sparse.csr_matrix
+        nBipolar X nChan matrix, to multiply with the data
+    """
+    chan_xyz = chan.return_xyz()
+    pairs = cKDTree(chan_xyz).query_pairs(max_dist, output_type='ndarray')
+    dist = norm(chan_xyz[pairs[:, 0]] - chan_xyz[pairs[:, 1]], axis=1)
+    pairs = pairs[dist < max_dist, :]
+    pairs = pairs[lexsort((pairs[:, 1], pairs[:, 0])), :]
 
     bipolar_labels = []
     bipolar_xyz = []
-    bipolar_trans = []
 
-    for x0, x1 in zip(x_all, y_all):
+    for x0, x1 in pairs:
 
         new_label = chan.chan[x0].label + '-' + chan.chan[x1].label
         bipolar_labels.append(new_label)
@@ -123,13 +229,14 @@ def create_bipolar_chan(chan, max_dist):
         xyz = mean(c_[chan.chan[x0].xyz, chan.chan[x1].xyz], axis=1)
         bipolar_xyz.append(xyz)
 
-        trans = zeros(chan.n_chan)
-        trans[x0] = 1
-        trans[x1] = -1
-        bipolar_trans.append(trans)
+    n_bipolar = pairs.shape[0]
+    bipolar_trans = csr_matrix(
+        (hstack((ones(n_bipolar), -ones(n_bipolar))),
+         (hstack((range(n_bipolar), range(n_bipolar))),
+          hstack((pairs[:, 0], pairs[:, 1])))),
+        shape=(n_bipolar, chan.n_chan))
 
     bipolar_xyz = c_[bipolar_xyz]
-    bipolar_trans = c_[bipolar_trans]
 
     bipolar = Channels(bipolar_labels, bipolar_xyz)
 
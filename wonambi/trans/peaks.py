@@ -1,5 +1,5 @@
 from logging import getLogger
-from numpy import nan, nanargmax, nanargmin
+from numpy import nanargmax, nanargmin
 
 lg = getLogger(__name__)
 
@@ -37,14 +37,12 @@ def peaks(data, method='max', axis='time', limits=None):
 
     for trl in range(data.number_of('trial')):
         values = data.axis[axis][trl]
-        dat = data(trial=trl)
+        dat = data.data[trl]
 
         if limits is not None:
-            limits = (values < limits[0]) | (values > limits[1])
-
-            idx = [slice(None)] * len(data.list_of_axes)
-            idx[idx_axis] = limits
-            dat[idx] = nan
+            in_limits = (limits[0] <= values) & (values <= limits[1])
+            values = values[in_limits]
+            dat = dat.compress(in_limits, axis=idx_axis)
 
         if method == 'max':
             peak_val = nanargmax(dat, axis=idx_axis)
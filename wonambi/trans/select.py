@@ -10,12 +10,17 @@ Select should be as flexible as possible. There are quite a few cases, which
 will be added as we need them.
 """
 from collections import Iterable
+from fractions import Fraction
+from functools import lru_cache
 from logging import getLogger
+from math import ceil
 
-from numpy import asarray, empty, linspace, ones, setdiff1d
-from scipy.signal import decimate
+from numpy import (arange, asarray, diff, empty, ones, result_type,
+                   searchsorted, setdiff1d)
+from scipy.signal import decimate, firwin, resample_poly
 
 lg = getLogger(__name__)
+MAX_DENOMINATOR = 1000  # largest up / down factor for resampling
 
 
 def select(data, trial=None, invert=False, **axes_to_select):
@@ -40,6 +45,13 @@ def select(data, trial=None, invert=False, **axes_to_select):
     -------
     instance, same class as input
         data where selection has been applied.
+
+    Notes
+    -----
+    If the numeric axes are non-decreasing and the labels are all present, the
+    ranges are converted into slices with searchsorted and the data is not
+    copied (the output shares memory with the input). Otherwise, the values
+    are matched one by one, which is much slower, and the output is a copy.
     """
     if trial is not None and not isinstance(trial, Iterable):
         raise TypeError('Trial needs to be iterable.')
@@ -65,6 +77,7 @@ def select(data, trial=None, invert=False, **axes_to_select):
     to_select = {}
     for cnt, i in enumerate(trial):
         lg.debug('Selection on trial {0: 6}'.format(i))
+        index = []  # fast path, if all the axes can be indexed directly
         for one_axis in output.axis:
             values = data.axis[one_axis][i]
 
@@ -73,11 +86,23 @@ def select(data, trial=None, invert=False, **axes_to_select):
 
                 if len(values_to_select) == 0:
                     selected_values = ()
+                    index = None
 
                 elif isinstance(values_to_select[0], str):
                     selected_values = asarray(values_to_select, dtype='U')
+                    if index is not None and not invert:
+                        index = _append_labels(index, values, selected_values)
+                    else:
+                        index = None
+
+                elif not invert and _is_monotonic(values):
+                    idx = _range_to_slice(values, values_to_select)
+                    selected_values = values[idx]
+                    if index is not None:
+                        index.append(idx)
 
                 else:
+                    index = None
                     if (values_to_select[0] is None and
                         values_to_select[1] is None):
                         bool_values = ones(len(values), dtype=bool)
@@ -101,50 +126,242 @@ def select(data, trial=None, invert=False, **axes_to_select):
                 lg.debug('In axis ' + one_axis + ', selecting all the '
                          'values')
                 selected_values = data.axis[one_axis][i]
+                if index is not None:
+                    index.append(slice(None))
 
             output.axis[one_axis][cnt] = selected_values
 
-        output.data[cnt] = data(trial=i, **to_select)
+        if index is not None:
+            output.data[cnt] = _index_data(data.data[i], index)
+        else:
+            output.data[cnt] = data(trial=i, **to_select)
 
     return output
 
 
-def resample(data, s_freq=None, axis='time', ftype='fir', n=None):
-    """Downsample the data after applying a filter.
+def _is_monotonic(values):
+    """Check if the values of an axis are numeric and non-decreasing."""
+    if values.dtype.kind not in 'iuf':
+        return False
+    return bool((values[1:] >= values[:-1]).all())
+
+
+def _range_to_slice(values, values_to_select):
+    """Convert a range of values into a slice, for non-decreasing values.
+
+    Parameters
+    ----------
+    values : ndarray
+        non-decreasing values of one axis
+    values_to_select : tuple or list
+        first (included) and last (excluded) value, which can be None
+
+    Returns
+    -------
+    slice
+        indices of the values which are within the range
+    """
+    begin, end = 0, len(values)
+    if values_to_select[0] is not None:
+        begin = searchsorted(values, values_to_select[0], side='left')
+    if values_to_select[1] is not None:
+        end = max(searchsorted(values, values_to_select[1], side='left'),
+                  begin)
+    return slice(int(begin), int(end))
+
+
+def _append_labels(index, values, selected_values):
+    """Add the indices of the labels, if they are all present and unique.
+
+    Returns
+    -------
+    list or None
+        index with the indices of the labels or None, if the labels cannot be
+        indexed directly (and missing labels should be filled with NaN).
+    """
+    position = {label: i for i, label in enumerate(values)}
+    if (len(position) != len(values) or
+            not all(label in position for label in selected_values)):
+        return None
+
+    idx = asarray([position[label] for label in selected_values], dtype=int)
+    if len(idx) > 0 and (diff(idx) == 1).all():
+        idx = slice(int(idx[0]), int(idx[-1]) + 1)
+    index.append(idx)
+    return index
+
+
+def _index_data(x, index):
+    """Index the data with one slice or array of indices per axis.
+
+    Notes
+    -----
+    Slices are applied first, so that they return a view, then each array of
+    indices is applied separately, along its own axis.
+    """
+    x = x[tuple(idx if isinstance(idx, slice) else slice(None)
+                for idx in index)]
+    for axis, idx in enumerate(index):
+        if not isinstance(idx, slice):
+            x = x.take(idx, axis=axis)
+    return x
+
+
+def resample(data, s_freq=None, axis='time', ftype='fir', n=None,
+             chunk=None):
+    """Resample the data after applying a filter.
 
     Parameters
     ----------
     data : instance of Data
-        data to downsample
+        data to resample
     s_freq : int or float
         desired sampling frequency
     axis : str
-        axis you want to apply downsample on (most likely 'time')
+        axis you want to apply resample on (most likely 'time')
     ftype : str
         filter type to apply. The default here is 'fir', like Matlab but unlike
-        the default in scipy, because it works better
+        the default in scipy, because it works better. 'fir' uses a polyphase
+        filter, so the ratio between the sampling frequencies can be any
+        rational number. 'iir' only works for integer downsampling.
     n : int
         The order of the filter (1 less than the length for ‘fir’).
+    chunk : float, optional
+        if specified, the data is resampled in chunks of this duration (in s),
+        with enough overlap that the results are identical to resampling the
+        whole trial at once (only for 'fir')
 
     Returns
     -------
     instance of Data
-        downsampled data
+        resampled data
+
+    Raises
+    ------
+    ValueError
+        if ftype is 'iir' and the ratio is not an integer downsampling
+
+    Notes
+    -----
+    The time axis is exact: the first sample of each trial does not change and
+    the following samples are spaced by 1 / s_freq.
     """
+    ratio = Fraction(s_freq / data.s_freq).limit_denominator(MAX_DENOMINATOR)
+    up, down = ratio.numerator, ratio.denominator
+
+    if ftype == 'iir' and up != 1:
+        raise ValueError('"iir" only works for integer downsampling (ratio '
+                         'is {}/{}), use "fir" instead'.format(up, down))
+    if ftype == 'fir':
+        h = _design_poly_filter(up, down, n)
+
     output = data._copy()
-    ratio = int(data.s_freq / s_freq)
+    idx_axis = data.index_of(axis)
 
     for i in range(data.number_of('trial')):
-        output.data[i] = decimate(data.data[i], ratio,
-                                  axis=data.index_of(axis),
-                                  zero_phase=True)
+        if ftype == 'fir':
+            chunk_smp = None
+            if chunk is not None:
+                chunk_smp = int(chunk * data.s_freq)
+            output.data[i] = _resample_poly(data.data[i], up, down, h,
+                                            idx_axis, chunk_smp)
+        else:
+            output.data[i] = decimate(data.data[i], down, n=n, ftype=ftype,
+                                      axis=idx_axis, zero_phase=True)
 
-        n_samples = output.data[i].shape[data.index_of(axis)]
-        output.axis[axis][i] = linspace(data.axis[axis][i][0],
-                                        data.axis[axis][i][-1] +
-                                        1 / data.s_freq,
-                                        n_samples)
+        n_samples = output.data[i].shape[idx_axis]
+        output.axis[axis][i] = (data.axis[axis][i][0] +
+                                arange(n_samples) / s_freq)
 
     output.s_freq = s_freq
 
     return output
+
+
+@lru_cache(maxsize=32)
+def _design_poly_filter(up, down, n=None):
+    """Design the anti-aliasing filter for polyphase resampling.
+
+    Parameters
+    ----------
+    up : int
+        upsampling factor
+    down : int
+        downsampling factor
+    n : int, optional
+        order of the filter. If None, it uses the same design as
+        scipy.signal.resample_poly
+
+    Returns
+    -------
+    ndarray
+        read-only FIR coefficients (shared across calls, do not modify them)
+    """
+    max_rate = max(up, down)
+    if n is None:
+        h = firwin(20 * max_rate + 1, 1 / max_rate, window=('kaiser', 5.0))
+    else:
+        h = firwin(n + 1, 1 / max_rate, window='hamming')
+    h.setflags(write=False)
+    return h
+
+
+def _resample_poly(x, up, down, h, axis, chunk_smp=None):
+    """Polyphase resampling, optionally in overlapping chunks.
+
+    Parameters
+    ----------
+    x : ndarray
+        data to resample
+    up : int
+        upsampling factor
+    down : int
+        downsampling factor
+    h : ndarray
+        FIR coefficients
+    axis : int
+        axis to resample
+    chunk_smp : int, optional
+        number of input samples in each chunk (if None, all at once)
+
+    Returns
+    -------
+    ndarray
+        resampled data
+
+    Notes
+    -----
+    Each chunk starts at a multiple of "down" input samples, so that the
+    output samples of each chunk fall on the same grid as the whole signal.
+    The chunks are padded with the input samples within the length of the
+    filter, so that the values are identical to resampling all at once.
+    """
+    n_in = x.shape[axis]
+    if chunk_smp is None or chunk_smp >= n_in:
+        return resample_poly(x, up, down, axis=axis, window=h)
+
+    chunk_smp = max(chunk_smp // down, 1) * down
+    pad = int(ceil((len(h) - 1) / 2 / up / down)) * down
+
+    n_out = int(ceil(n_in * up / down))
+    shape = list(x.shape)
+    shape[axis] = n_out
+    y = empty(shape, dtype=result_type(x.dtype, h.dtype))
+
+    idx_in = [slice(None)] * x.ndim
+    idx_out = [slice(None)] * x.ndim
+    for begsam in range(0, n_in, chunk_smp):
+        endsam = min(begsam + chunk_smp, n_in)
+        padbeg = max(begsam - pad, 0)
+        idx_in[axis] = slice(padbeg, min(endsam + pad, n_in))
+        chunk = resample_poly(x[tuple(idx_in)], up, down, axis=axis,
+                              window=h)
+
+        first = (begsam - padbeg) * up // down
+        out_beg = begsam * up // down
+        out_end = min(int(ceil(endsam * up / down)), n_out)
+        idx_in[axis] = slice(first, first + out_end - out_beg)
+        idx_out[axis] = slice(out_beg, out_end)
+        y[tuple(idx_out)] = chunk[tuple(idx_in)]
+
+    return y
@@ -1910,18 +1910,7 @@ class MergeDialog(QDialog):
                 events = merge_close(events, min_interval)
                 
             else:
-                channels = set([x['chan'] for x in events])
-                events = []
-                chan_events = []
-                
-                for chan in channels:
-                    
-                    for etype in evt_types:
-                        
-                        chan_events.extend(self.parent.notes.annot.get_events(
-                                name=etype, chan=chan, qual='Good'))
-                        
-                    events.extend(merge_close(chan_events, min_interval))
+                events = merge_close(events, min_interval, by='chan')
                     
             for etype in evt_types:
                 self.parent.notes.annot.remove_event_type(etype)